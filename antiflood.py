@@ -0,0 +1,122 @@
+import time
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+import metrics
+
+# تعداد فراخوانی‌ها بین هر پاک‌سازی وضعیت کاربران بی‌فعالیت
+PRUNE_EVERY = 1000
+THROTTLE_NOTICE = "⏳ درخواست‌های شما زیاد است؛ لطفاً چند لحظه صبر کنید و دوباره تلاش کنید."
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, rate, capacity, now):
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class FloodGuard:
+    # Middleware پیش از Handlerها: هر کاربر یک سطل توکن دارد و کارهای سنگین یک فاصله‌ی حداقلی
+    # سطل فقط Callbackها، فرمان‌ها و دکمه‌های menu را می‌شمارد؛ رسید، شماره تلفن و متن تیکت هرگز دور ریخته نمی‌شوند.
+    # پیام رد شده یک بار (تا پذیرفته شدن Update بعدی کاربر) با THROTTLE_NOTICE پاسخ می‌گیرد.
+    def __init__(self, rate=1.0, burst=5, cooldown=2.0, duplicate_window=1.0,
+                 expensive=(), menu=(), exempt=(), idle_ttl=600, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.cooldown = cooldown
+        self.duplicate_window = duplicate_window
+        self.expensive = frozenset(expensive)
+        self.menu = frozenset(menu)
+        self.exempt = frozenset(exempt)
+        self.idle_ttl = idle_ttl
+        self.clock = clock
+        self._buckets = {}
+        self._last_action = {}
+        self._last_callback = {}
+        self._notified = set()
+        self._calls = 0
+
+    def action_key(self, update):
+        # متن منو یا نام فرمان برای اعمال Cooldown
+        message = update.message
+        if message and message.text:
+            text = message.text.strip()
+            return text.split()[0].split("@")[0] if text.startswith("/") else text
+        return None
+
+    def check(self, update):
+        # None یعنی Update پذیرفته شد؛ در غیر این صورت دلیل رد شدن برگردانده می‌شود
+        user = update.effective_user
+        if user is None or user.id in self.exempt:
+            return None
+        now = self.clock()
+        self._calls += 1
+        if self._calls % PRUNE_EVERY == 0:
+            self.prune(now)
+
+        query = update.callback_query
+        if query is not None and query.message is not None:
+            # ضربه‌های تکراری روی همان دکمه‌ی همان پیام یکی می‌شوند
+            key = (user.id, query.message.message_id, query.data)
+            last = self._last_callback.get(key)
+            self._last_callback[key] = now
+            if last is not None and now - last < self.duplicate_window:
+                return "duplicate_callback"
+
+        action = self.action_key(update)
+        if query is None and not (action and (action.startswith("/") or action in self.menu)):
+            return None
+        bucket = self._buckets.get(user.id)
+        if bucket is None:
+            bucket = self._buckets[user.id] = TokenBucket(self.burst, now)
+        if not bucket.take(self.rate, self.burst, now):
+            return "rate_limited"
+
+        if action in self.expensive:
+            key = (user.id, action)
+            last = self._last_action.get(key)
+            if last is not None and now - last < self.cooldown:
+                return "cooldown"
+            self._last_action[key] = now
+        self._notified.discard(user.id)
+        return None
+
+    def prune(self, now):
+        for user_id in [u for u, b in self._buckets.items() if now - b.updated > self.idle_ttl]:
+            del self._buckets[user_id]
+        self._notified.intersection_update(self._buckets)
+        for table, ttl in ((self._last_action, self.cooldown), (self._last_callback, self.duplicate_window)):
+            for key in [k for k, t in table.items() if now - t > ttl]:
+                del table[key]
+
+    async def filter_update(self, update, context):
+        reason = self.check(update)
+        if reason is None:
+            return
+        metrics.DROPPED_UPDATES.inc(reason)
+        try:
+            if update.callback_query is not None:
+                # بدون پاسخ، دکمه در کلاینت کاربر در حالت بارگذاری می‌ماند؛ ضربه‌ی تکراری پیام نمی‌خواهد
+                await update.callback_query.answer(None if reason == "duplicate_callback" else THROTTLE_NOTICE)
+            elif update.effective_message is not None and update.effective_user.id not in self._notified:
+                self._notified.add(update.effective_user.id)
+                await update.effective_message.reply_text(THROTTLE_NOTICE)
+        except TelegramError:
+            pass
+        raise ApplicationHandlerStop
+
+    def install(self, application, group=-1):
+        # گروه منفی پیش از همه‌ی Handlerهای گروه 0 اجرا می‌شود
+        application.add_handler(TypeHandler(Update, self.filter_update), group=group)
@@ -0,0 +1,276 @@
+# بنچمارک مقیاس داده برای کوئری‌های دیتابیس
+# یک bot.db واقعی‌نما در چند مقیاس ساخته می‌شود و هر تابع دیتابیس و کوئری Handlerها
+# چند بار زمان‌سنجی و طرح اجرای (EXPLAIN QUERY PLAN) آن ثبت می‌شود.
+#
+# استفاده:
+#   python bench_db.py --scales 10000,100000,1000000 --output bench_db.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from bench_handlers import git_revision, percentile
+from storage import SQLiteStorage
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "999:bench-token")
+os.environ.setdefault("ADMIN_ID", "1000")
+os.environ.setdefault("METRICS_PORT", "0")
+
+FIRST_USER_ID = 100000
+BATCH_SIZE = 50000
+
+# توزیع وضعیت تراکنش‌ها در داده‌ی تولیدی
+STATUS_WEIGHTS = (
+    ("completed", 70),
+    ("expired", 20),
+    ("rejected", 6),
+    ("pending_review", 2),
+    ("pending", 2),
+)
+
+
+def _batched(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def create_schema(path):
+    import main
+    storage = SQLiteStorage(path)
+    await storage.init()
+    await main.load_initial_prices(storage)
+    prices = await storage.get_prices()
+    await storage.close()
+    return prices
+
+
+def generate_database(path, transactions, rng, days=365):
+    # نسبت‌ها: هر کاربر به‌طور میانگین ۱۰ تراکنش، یک تیکت به ازای هر ۲۰ تراکنش
+    prices = asyncio.run(create_schema(path))
+
+    users = max(1, transactions // 10)
+    tickets = max(1, transactions // 20)
+    feedbacks = max(1, transactions // 20)
+    now = datetime.now()
+    statuses = [s for s, _ in STATUS_WEIGHTS]
+    weights = [w for _, w in STATUS_WEIGHTS]
+
+    def fmt(moment):
+        return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+    def random_time():
+        # تراکنش‌های اخیر پرتکرارترند (توزیع نمایی روی روزهای گذشته)
+        offset = min(days * 86400, int(rng.expovariate(1 / (days * 86400 / 4))))
+        return now - timedelta(seconds=offset)
+
+    # آمار مجموع کاربران مانند update_user_transaction از تراکنش‌های موفق جمع می‌شود
+    completed_count = [0] * users
+    completed_total = [0] * users
+
+    def user_rows():
+        for i in range(users):
+            yield (FIRST_USER_ID + i, f"user{FIRST_USER_ID + i}", fmt(now - timedelta(days=rng.randint(0, days))),
+                   completed_count[i], completed_total[i], completed_count[i])
+
+    def transaction_rows():
+        for n in range(transactions):
+            # چند کاربر پرمصرف سهم بیشتری از تراکنش‌ها دارند
+            index = min(users - 1, int(rng.paretovariate(1.2)) - 1) if rng.random() < 0.2 else rng.randrange(users)
+            user_id = FIRST_USER_ID + index
+            _, name, amount, _ = rng.choice(prices)
+            status = rng.choices(statuses, weights)[0]
+            if status == "completed":
+                completed_count[index] += 1
+                completed_total[index] += amount
+            created = random_time() if status not in ("pending", "pending_review") else now - timedelta(seconds=rng.randint(0, 3600))
+            created_at = fmt(created)
+            done_at = fmt(created + timedelta(minutes=rng.randint(1, 30)))
+            yield (
+                f"TX{int(created.timestamp())}{n:08X}", user_id, amount, name, status, f"9379{rng.randint(0, 9999999):07d}",
+                created_at,
+                done_at if status in ("completed", "rejected", "pending_review") else None,
+                done_at if status == "completed" else None,
+                done_at if status == "rejected" else None,
+                done_at if status == "expired" else None,
+            )
+
+    def ticket_rows():
+        for n in range(tickets):
+            yield (f"TK{n:08X}", FIRST_USER_ID + rng.randrange(users), "پیام آزمایشی پشتیبانی",
+                   rng.choices(["pending", "answered"], [1, 9])[0], fmt(random_time()))
+
+    def reply_rows():
+        for n in range(tickets):
+            for _ in range(rng.randint(0, 3)):
+                yield (f"TK{n:08X}", rng.random() < 0.5, "پاسخ آزمایشی", fmt(random_time()))
+
+    def feedback_rows():
+        for _ in range(feedbacks):
+            yield (FIRST_USER_ID + rng.randrange(users), rng.randint(1, 5), "نظر آزمایشی", fmt(random_time()))
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    inserts = (
+        ("transactions", "INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", transaction_rows()),
+        ("users", "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)", user_rows()),
+        ("tickets", "INSERT INTO tickets VALUES (?, ?, ?, ?, ?)", ticket_rows()),
+        ("ticket_replies", "INSERT INTO ticket_replies (ticket_id, from_admin, message, time) VALUES (?, ?, ?, ?)", reply_rows()),
+        ("feedbacks", "INSERT INTO feedbacks (user_id, rating, message, created_at) VALUES (?, ?, ?, ?)", feedback_rows()),
+    )
+    for _, sql, rows in inserts:
+        for batch in _batched(rows):
+            conn.executemany(sql, batch)
+    conn.commit()
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table, _, _ in inserts}
+    conn.close()
+    return counts
+
+
+# -------------------------------
+# زمان‌سنجی کوئری‌ها
+# -------------------------------
+def explain(storage, statements):
+    plans = []
+    seen = set()
+    for sql in statements:
+        sql = " ".join(sql.split())
+        if sql in seen or not sql.upper().startswith("SELECT"):
+            continue
+        seen.add(sql)
+        plans.append({"sql": sql, "plan": storage.query_plan(sql)})
+    return plans
+
+
+def query_suite(storage, rng, users):
+    def any_user():
+        return FIRST_USER_ID + rng.randrange(users)
+
+    conn = sqlite3.connect(storage.path)
+    sample_transaction = conn.execute("SELECT transaction_id FROM transactions ORDER BY RANDOM() LIMIT 1").fetchone()[0]
+    # پرمصرف‌ترین کاربر بدترین حالت تاریخچه و تخفیف را نشان می‌دهد
+    heavy_user = conn.execute("SELECT user_id FROM transactions GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1").fetchone()[0]
+    sample_ticket = conn.execute("SELECT ticket_id FROM tickets LIMIT 1").fetchone()[0]
+    conn.close()
+
+    return {
+        "get_user": lambda: storage.get_user(any_user()),
+        "get_transactions_today": lambda: storage.get_transactions_today(any_user()),
+        "get_completed_transactions": lambda: storage.get_completed_transactions(any_user()),
+        "get_completed_transactions:heavy_user": lambda: storage.get_completed_transactions(heavy_user),
+        "get_transaction_history": lambda: storage.get_transaction_history(any_user()),
+        "get_transaction_history:heavy_user": lambda: storage.get_transaction_history(heavy_user),
+        "get_transaction": lambda: storage.get_transaction(sample_transaction),
+        "get_pending_orders": storage.get_pending_orders,
+        "get_pending_transactions": storage.get_pending_transactions,
+        "get_pending_tickets": storage.get_pending_tickets,
+        "get_detailed_stats": storage.get_detailed_stats,
+        "get_ticket": lambda: storage.get_ticket(sample_ticket),
+        "get_prices": storage.get_prices,
+    }
+
+
+async def time_queries(path, rng, users, repeats):
+    storage = SQLiteStorage(path)
+    await storage.init()
+    results = {}
+    for name, func in query_suite(storage, rng, users).items():
+        # اجرای اول متن کوئری‌ها را برای EXPLAIN ثبت می‌کند
+        statements = []
+        storage.set_trace_callback(statements.append)
+        await func()
+        storage.set_trace_callback(None)
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            await func()
+            samples.append(time.perf_counter() - start)
+        results[name] = {
+            "runs": repeats,
+            "min_ms": round(min(samples) * 1000, 3),
+            "p50_ms": round(percentile(samples, 50) * 1000, 3),
+            "p95_ms": round(percentile(samples, 95) * 1000, 3),
+            "max_ms": round(max(samples) * 1000, 3),
+            "statements": len(statements),
+            "plans": explain(storage, statements),
+        }
+    await storage.close()
+    return results
+
+
+def run_scale(transactions, args, workdir):
+    rng = random.Random(args.seed)
+    path = os.path.join(workdir, f"bot_{transactions}.db")
+    if os.path.exists(path):
+        os.remove(path)
+    start = time.perf_counter()
+    counts = generate_database(path, transactions, rng)
+    generate_s = time.perf_counter() - start
+    queries = asyncio.run(time_queries(path, rng, counts["users"], args.repeats))
+    return {
+        "rows": counts,
+        "db_size_bytes": os.path.getsize(path),
+        "generate_s": round(generate_s, 2),
+        "db_path": path,
+        "queries": queries,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Seed bot.db at scale and time every query helper.")
+    parser.add_argument("--scales", default="10000,100000,1000000",
+                        help="comma separated transaction row counts")
+    parser.add_argument("--repeats", type=int, default=20, help="timed runs per query")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--workdir", default=None, help="directory for generated databases (default: temp)")
+    parser.add_argument("--keep", action="store_true", help="keep generated databases")
+    parser.add_argument("--output", default="bench_db.json", help="JSON results file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_db_")
+    os.makedirs(workdir, exist_ok=True)
+    result = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "repeats": args.repeats,
+        },
+        "scales": {},
+    }
+    try:
+        for scale in (int(s) for s in args.scales.split(",")):
+            print(f"scale {scale:,}: generating...", flush=True)
+            data = run_scale(scale, args, workdir)
+            result["scales"][str(scale)] = data
+            print(f"  generated {data['rows']} in {data['generate_s']}s ({data['db_size_bytes'] / 1e6:.1f} MB)")
+            for name, row in data["queries"].items():
+                scans = sum(1 for p in row["plans"] for step in p["plan"] if step.startswith("SCAN"))
+                print(f"  {name:<42} p50 {row['p50_ms']:>9} ms  p95 {row['p95_ms']:>9} ms  scans {scans}")
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,235 @@
+# بنچمارک سرتاسری روی سرور جعلی Bot API
+# همان Application ساخته‌شده در main.py با Polling واقعی و از طریق HTTP به fake_bot_api وصل می‌شود؛
+# هزاران کاربر هم‌زمان جریان سفارش را تا تایید مدیر طی می‌کنند و زمان پاسخ هر مرحله از دید کاربر،
+# گذردهی و پاسخ‌های 429 اندازه‌گیری می‌شود.
+#
+# استفاده:
+#   python bench_e2e.py --users 2000 --concurrency 500 --output bench_e2e.json
+#   python bench_e2e.py --users 500 --chat-rate 1 --global-rate 30 --api-latency 0.05
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from bench_handlers import BENCH_ADMIN_ID, BENCH_TOKEN, FIRST_USER_ID, UpdateFactory, git_revision, percentile, seed_storage
+from catalog import TOKEN_PREFIX
+from fake_bot_api import FakeBotAPI
+from storage import MemoryStorage, SQLiteStorage
+
+
+def has_button(prefix):
+    return lambda message: any(b.startswith(prefix) for b in message["buttons"])
+
+
+def text_contains(fragment, method=None):
+    def predicate(message):
+        return (method is None or message["method"] == method) and fragment in (message.get("text") or "")
+    return predicate
+
+
+class E2EBench:
+    def __init__(self, api, rng, timeout, admin_delay):
+        self.api = api
+        self.rng = rng
+        self.timeout = timeout
+        self.admin_delay = admin_delay
+        self.factory = UpdateFactory()
+        self.samples = defaultdict(list)
+        self.timeouts = Counter()
+        self.orders = []
+        self.reviewed = 0
+
+    async def step(self, label, user_id, payload, predicate, timeout=None):
+        # زمان از قرار گرفتن Update در صف getUpdates تا رسیدن پاسخ ربات به همان چت
+        start = time.perf_counter()
+        self.api.push_update(BENCH_TOKEN, payload)
+        message = await self.api.wait_for(BENCH_TOKEN, user_id, predicate, timeout or self.timeout)
+        if message is None:
+            self.timeouts[label] += 1
+            return None
+        self.samples[label].append(time.perf_counter() - start)
+        return message
+
+    async def user_flow(self, user_id):
+        rng = self.rng
+        f = self.factory
+        started = time.perf_counter()
+        if not await self.step("start", user_id, f.text(user_id, "/start"), None):
+            return
+        menu = rng.choice(["📱 خرید شارژ", "📦 بسته‌های اینترنت"])
+        message = await self.step("menu", user_id, f.text(user_id, menu), has_button(TOKEN_PREFIX))
+        if not message:
+            return
+        package = rng.choice([b for b in message["buttons"] if b.startswith(TOKEN_PREFIX)])
+        if not await self.step("package", user_id, f.callback(user_id, package),
+                               lambda m: m["method"] == "editMessageText"):
+            return
+        message = await self.step("phone_number", user_id, f.text(user_id, f"9379{rng.randint(0, 9999999):07d}"),
+                                  has_button("confirm_invoice_"))
+        if not message:
+            return
+        confirm = next(b for b in message["buttons"] if b.startswith("confirm_invoice_"))
+        if not await self.step("confirm_invoice", user_id, f.callback(user_id, confirm),
+                               lambda m: m["method"] == "sendMessage"):
+            return
+        if not await self.step("receipt_photo", user_id, f.photo(user_id, rng.randint(20000, 900000)),
+                               text_contains("رسید پرداخت شما ثبت شد")):
+            return
+        # نتیجه‌ی بررسی مدیر از طریق outbox می‌رسد
+        result = await self.api.wait_for(BENCH_TOKEN, user_id, text_contains("سفارش شما"), self.timeout * 3)
+        if result is None:
+            self.timeouts["order_result"] += 1
+            return
+        self.orders.append(time.perf_counter() - started)
+
+    async def admin_loop(self):
+        # مدیر شبیه‌سازی‌شده: هر رسید را پس از admin_delay تایید یا رد می‌کند
+        f = self.factory
+        while True:
+            review = await self.api.wait_for(BENCH_TOKEN, BENCH_ADMIN_ID, has_button("approve_"), timeout=3600)
+            if review is None:
+                continue
+            action = "approve_" if self.rng.random() < 0.85 else "reject_"
+            data = next(b for b in review["buttons"] if b.startswith(action))
+            if self.admin_delay:
+                await asyncio.sleep(self.admin_delay)
+            self.api.push_update(BENCH_TOKEN, f.callback(BENCH_ADMIN_ID, data, caption=review.get("caption") or ""))
+            self.reviewed += 1
+
+    async def run(self, user_ids, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def guarded(user_id):
+            async with semaphore:
+                await self.user_flow(user_id)
+
+        admin = asyncio.create_task(self.admin_loop())
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(guarded(u) for u in user_ids))
+        finally:
+            admin.cancel()
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        steps = {}
+        for label, samples in sorted(self.samples.items()):
+            steps[label] = {
+                "count": len(samples),
+                "timeouts": self.timeouts.get(label, 0),
+                "p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "p95_ms": round(percentile(samples, 95) * 1000, 3),
+                "p99_ms": round(percentile(samples, 99) * 1000, 3),
+            }
+        updates = sum(len(s) for s in self.samples.values()) + self.reviewed
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "updates": updates,
+            "throughput_updates_per_s": round(updates / elapsed, 1) if elapsed else 0.0,
+            "orders_completed": len(self.orders),
+            "orders_per_s": round(len(self.orders) / elapsed, 2) if elapsed else 0.0,
+            "order_p50_s": round(percentile(self.orders, 50), 3),
+            "order_p95_s": round(percentile(self.orders, 95), 3),
+            "timeouts": dict(self.timeouts),
+            "steps": steps,
+            "api_calls": dict(self.api.calls),
+            "api_responses": {f"{method}:{code}": n for (method, code), n in sorted(self.api.responses.items())},
+        }
+
+
+async def run_benchmark(args):
+    rng = random.Random(args.seed)
+    api = FakeBotAPI(latency=args.api_latency, jitter=args.api_jitter, error_rate=args.error_rate,
+                     chat_rate=args.chat_rate, global_rate=args.global_rate, retry_after=args.retry_after,
+                     seed=args.seed)
+    await api.start()
+    # main.py نشانی Bot API را هنگام import از محیط می‌خواند
+    os.environ["BOT_API_URL"] = api.base_url
+    os.environ["BOT_FILE_URL"] = api.base_file_url
+    import main
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    main.RECEIPTS_DIR = os.path.join(workdir, "receipts")
+    storage = MemoryStorage() if args.storage == "memory" else SQLiteStorage(os.path.join(workdir, "bot.db"))
+
+    application = main.build_application(storage=storage)
+    for job in application.job_queue.jobs():
+        job.schedule_removal()
+    await application.initialize()
+    await main.post_init(application)
+    seeded_users, seeded_transactions = await seed_storage(storage, args.seed_users, rng)
+    await application.updater.start_polling(poll_interval=0, timeout=10)
+    await application.start()
+    bench = E2EBench(api, rng, args.timeout, args.admin_delay)
+    try:
+        user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+        elapsed = await bench.run(user_ids, args.concurrency)
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await main.post_shutdown(application)
+        await application.shutdown()
+        await api.stop()
+
+    result = bench.report(elapsed)
+    result["meta"] = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "storage": args.storage,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "api_latency_s": args.api_latency,
+        "api_jitter_s": args.api_jitter,
+        "error_rate": args.error_rate,
+        "chat_rate": args.chat_rate,
+        "global_rate": args.global_rate,
+        "seeded_users": seeded_users,
+        "seeded_transactions": seeded_transactions,
+    }
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="End-to-end load test against a local fake Bot API server.")
+    parser.add_argument("--users", type=int, default=1000, help="simulated users completing the order flow")
+    parser.add_argument("--concurrency", type=int, default=200, help="users active at the same time")
+    parser.add_argument("--seed-users", type=int, default=2000, help="users pre-seeded into the temp database")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="fake Bot API latency in seconds")
+    parser.add_argument("--api-jitter", type=float, default=0.0, help="extra random latency up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API calls failing with 500")
+    parser.add_argument("--chat-rate", type=float, default=0.0, help="messages/s per chat before 429 (0 = off)")
+    parser.add_argument("--global-rate", type=float, default=0.0, help="messages/s for the bot before 429 (0 = off)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in 429 responses")
+    parser.add_argument("--admin-delay", type=float, default=0.0, help="seconds the simulated admin takes per receipt")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds a user waits for each bot reply")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite", help="storage backend")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--output", default="bench_e2e.json", help="JSON results file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(f"{result['updates']} updates in {result['elapsed_s']}s ({result['throughput_updates_per_s']} updates/s), "
+          f"{result['orders_completed']} orders ({result['orders_per_s']}/s, p50 {result['order_p50_s']}s, "
+          f"p95 {result['order_p95_s']}s)")
+    print(f"{'step':<20} {'count':>6} {'t/o':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, row in result["steps"].items():
+        print(f"{label:<20} {row['count']:>6} {row['timeouts']:>5} {row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+    limited = {k: v for k, v in result["api_responses"].items() if not k.endswith(":200")}
+    if limited:
+        print(f"non-200 responses: {limited}")
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,394 @@
+# بنچمارک درون‌پردازه‌ای Handlerها
+# Application ساخته‌شده در main.py با یک Bot جعلی (بدون شبکه) اجرا می‌شود و
+# جریان‌های مصنوعی کاربران روی یک دیتابیس موقت پرشده پخش می‌شوند.
+#
+# استفاده:
+#   python bench_handlers.py --users 200 --output bench_handlers.json
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from telegram.request import BaseRequest
+
+from catalog import TOKEN_PREFIX
+from fake_bot_api import fake_receipt
+from storage import MemoryStorage, SQLiteStorage
+
+BENCH_ADMIN_ID = 1000
+BENCH_BOT_ID = 999
+BENCH_TOKEN = f"{BENCH_BOT_ID}:bench-token"
+FIRST_USER_ID = 100000
+
+# main.py تنظیمات را هنگام import از محیط می‌خواند
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", BENCH_TOKEN)
+os.environ.setdefault("ADMIN_ID", str(BENCH_ADMIN_ID))
+os.environ.setdefault("METRICS_PORT", "0")
+# کاربران شبیه‌سازی‌شده بدون مکث ضربه می‌زنند؛ محافظ Flood نباید جریان‌ها را قطع کند
+os.environ.setdefault("FLOOD_BURST", "1000000")
+os.environ.setdefault("FLOOD_COOLDOWN", "0")
+os.environ.setdefault("FLOOD_DUPLICATE_WINDOW", "0")
+os.environ.setdefault("OUTBOX_CHAT_INTERVAL", "0")
+os.environ.setdefault("OUTBOX_RATE", "100000")
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+# -------------------------------
+# Bot API جعلی
+# -------------------------------
+class FakeRequest(BaseRequest):
+    # به‌جای ارسال به Telegram، فراخوانی‌ها را ثبت و پاسخ معتبر جعلی برمی‌گرداند
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.last_buttons = {}
+        self.admin_reviews = []
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if "/file/bot" in url:
+            # دانلود فایل: محتوای ثابت بر اساس مسیر فایل (رسید تکراری = محتوای یکسان)
+            self.calls["downloadFile"] += 1
+            return 200, fake_receipt(endpoint)
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._record_markup(endpoint, params)
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _record_markup(self, endpoint, params):
+        markup = params.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if not isinstance(markup, dict) or "inline_keyboard" not in markup:
+            return
+        buttons = [b["callback_data"] for row in markup["inline_keyboard"] for b in row if "callback_data" in b]
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            self.last_buttons[int(chat_id)] = buttons
+        if endpoint == "sendPhoto" and chat_id is not None and int(chat_id) == BENCH_ADMIN_ID:
+            self.admin_reviews.append((buttons, params.get("caption") or ""))
+
+    def _result(self, endpoint, params):
+        if endpoint == "getMe":
+            return {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if endpoint == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": 1024,
+                    "file_path": f"photos/{file_id}.jpg"}
+        if endpoint.startswith(("send", "edit")):
+            try:
+                chat = {"id": int(params.get("chat_id", 0)), "type": "private"}
+            except ValueError:
+                chat = {"id": -1001, "type": "channel", "title": str(params["chat_id"])}
+            message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat,
+                       "from": {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench"}}
+            if "text" in params:
+                message["text"] = params["text"]
+            if "caption" in params:
+                message["caption"] = params["caption"]
+            return message
+        return True
+
+
+# -------------------------------
+# دیتابیس موقت پرشده
+# -------------------------------
+def seed_rows(users, prices, rng):
+    # کاربران با سابقه‌ی متفاوت؛ حدود یک‌پنجم بیش از آستانه‌ی تخفیف تراکنش موفق دارند
+    import main
+    now = datetime.now()
+    user_rows = []
+    trans_rows = []
+    for i in range(users):
+        user_id = FIRST_USER_ID + i
+        join = now - timedelta(days=rng.randint(1, 365))
+        completed = rng.randint(main.DISCOUNT_THRESHOLD, main.DISCOUNT_THRESHOLD + 10) if rng.random() < 0.2 else rng.randint(0, 5)
+        user_rows.append((user_id, f"user{user_id}", join.strftime("%Y-%m-%d %H:%M:%S"), completed, 0, completed))
+        for n in range(completed + rng.randint(0, 3)):
+            _, name, amount, _ = rng.choice(prices)
+            status = "completed" if n < completed else rng.choice(["rejected", "expired"])
+            created = join + timedelta(minutes=rng.randint(0, max(1, int((now - join).total_seconds() // 60))))
+            trans_rows.append((f"SEED{user_id}_{n}", user_id, amount, name, status, "93791234567",
+                               created.strftime("%Y-%m-%d %H:%M:%S"), None, None, None, None))
+    return user_rows, trans_rows
+
+
+async def seed_storage(storage, users, rng):
+    user_rows, trans_rows = seed_rows(users, await storage.get_prices(), rng)
+    if isinstance(storage, MemoryStorage):
+        storage.load(users=user_rows, transactions=trans_rows)
+    else:
+        conn = sqlite3.connect(storage.path)
+        conn.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?, ?)", user_rows)
+        conn.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", trans_rows)
+        conn.commit()
+        conn.close()
+    return len(user_rows), len(trans_rows)
+
+
+# -------------------------------
+# تولید Updateهای مصنوعی
+# -------------------------------
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"U{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id, **fields):
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        message.update(fields)
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def text(self, user_id, text):
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._message(user_id, **fields)
+
+    def photo(self, user_id, file_size, reused=None):
+        # reused: شناسه‌ی یک عکس قبلی برای شبیه‌سازی رسید تکراری
+        unique = reused or f"{user_id}{next(self._message_ids)}"
+        return self._message(user_id, photo=[
+            {"file_id": f"small{unique}", "file_unique_id": f"s{unique}", "width": 90, "height": 160, "file_size": 2048},
+            {"file_id": f"photo{unique}", "file_unique_id": f"p{unique}", "width": 720, "height": 1280, "file_size": file_size},
+        ])
+
+    def callback(self, user_id, data, caption=None):
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench"}}
+        if caption is not None:
+            message["caption"] = caption
+        else:
+            message["text"] = "menu"
+        return {"update_id": next(self._update_ids), "callback_query": {
+            "id": str(next(self._update_ids)), "from": self._user(user_id), "chat_instance": str(user_id),
+            "data": data, "message": message}}
+
+
+class HandlerBench:
+    def __init__(self, application, request, rng):
+        self.application = application
+        self.request = request
+        self.rng = rng
+        self.factory = UpdateFactory()
+        self.samples = defaultdict(list)
+        self.db_queries = Counter()
+        self.errors = Counter()
+        self.sent_receipts = []
+        self._labels = {}
+
+    async def count_error(self, update, context):
+        label = self._labels.get(getattr(update, "update_id", None), "unknown")
+        self.errors[label] += 1
+
+    async def send(self, label, payload):
+        import metrics
+        from telegram import Update
+        update = Update.de_json(payload, self.application.bot)
+        self._labels[update.update_id] = label
+        queries_before = sum(v for _, _, v in metrics.DB_CALLS.samples())
+        start = time.perf_counter()
+        await self.application.process_update(update)
+        self.samples[label].append(time.perf_counter() - start)
+        self.db_queries[label] += sum(v for _, _, v in metrics.DB_CALLS.samples()) - queries_before
+        self._labels.pop(update.update_id, None)
+
+    def buttons(self, chat_id, prefix):
+        return [b for b in self.request.last_buttons.get(chat_id, []) if b.startswith(prefix)]
+
+    async def user_flow(self, user_id):
+        rng = self.rng
+        f = self.factory
+        await self.send("start", f.text(user_id, "/start"))
+        for tap in rng.sample(["💰 تعرفه‌ها", "👤 پروفایل من", "📄 تاریخچه تراکنش‌ها", "📞 پشتیبانی"], rng.randint(0, 2)):
+            await self.send(f"menu:{tap}", f.text(user_id, tap))
+        # حدود یک‌سوم کاربران فقط منو را مرور می‌کنند
+        if rng.random() < 0.3:
+            return
+        menu, kind = rng.choice([("📱 خرید شارژ", "charge"), ("📦 بسته‌های اینترنت", "net")])
+        await self.send(f"menu:{menu}", f.text(user_id, menu))
+        packages = self.buttons(user_id, TOKEN_PREFIX)
+        if not packages:
+            return
+        await self.send(f"callback:{kind}", f.callback(user_id, rng.choice(packages)))
+        if rng.random() < 0.05:
+            await self.send("phone_number:invalid", f.text(user_id, "12345678901"))
+        await self.send("phone_number", f.text(user_id, f"9379{rng.randint(0, 9999999):07d}"))
+        confirm = self.buttons(user_id, "confirm_invoice_")
+        if not confirm or rng.random() < 0.1:
+            return
+        await self.send("callback:confirm_invoice_", f.callback(user_id, confirm[0]))
+        transaction_id = confirm[0][len("confirm_invoice_"):]
+        reused = rng.choice(self.sent_receipts) if self.sent_receipts and rng.random() < 0.05 else None
+        payload = f.photo(user_id, rng.randint(20000, 900000), reused=reused)
+        self.sent_receipts.append(payload["message"]["photo"][-1]["file_id"][len("photo"):])
+        await self.send("receipt_photo" if not reused else "receipt_photo:duplicate", payload)
+        review = next((r for r in reversed(self.request.admin_reviews) if any(transaction_id in b for b in r[0])), None)
+        if not review:
+            return
+        buttons, caption = review
+        action = "approve_" if rng.random() < 0.85 else "reject_"
+        data = next((b for b in buttons if b.startswith(action)), None)
+        if data:
+            await self.send(f"admin:{action}", f.callback(BENCH_ADMIN_ID, data, caption=caption))
+
+    async def run(self, user_ids, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def guarded(user_id):
+            async with semaphore:
+                await self.user_flow(user_id)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(guarded(u) for u in user_ids))
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        total = sum(len(s) for s in self.samples.values())
+        handlers = {}
+        for label, samples in sorted(self.samples.items()):
+            handlers[label] = {
+                "count": len(samples),
+                "errors": self.errors.get(label, 0),
+                "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+                "p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "p95_ms": round(percentile(samples, 95) * 1000, 3),
+                "p99_ms": round(percentile(samples, 99) * 1000, 3),
+                "db_queries_per_update": round(self.db_queries[label] / len(samples), 2),
+            }
+        return {
+            "updates": total,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_updates_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+            "handlers": handlers,
+            "api_calls": dict(self.request.calls),
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+async def run_benchmark(args):
+    import main
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bench_handlers_")
+    main.RECEIPTS_DIR = os.path.join(workdir, "receipts")
+    if args.storage == "memory":
+        db_path = None
+        storage = MemoryStorage()
+    else:
+        db_path = os.path.join(workdir, "bot.db")
+        storage = SQLiteStorage(db_path)
+
+    request = FakeRequest(latency=args.api_latency)
+    application = main.build_application(request=request, storage=storage)
+    for job in application.job_queue.jobs():
+        job.schedule_removal()
+    bench = HandlerBench(application, request, rng)
+    application.add_error_handler(bench.count_error)
+    await application.initialize()
+    await main.post_init(application)
+    seeded_users, seeded_transactions = await seed_storage(storage, args.seed_users, rng)
+    await application.start()
+    try:
+        user_ids = [FIRST_USER_ID + rng.randrange(args.seed_users) for _ in range(args.users)]
+        # چند کاربر جدید که در دیتابیس نیستند
+        user_ids += [FIRST_USER_ID + args.seed_users + i for i in range(max(1, args.users // 10))]
+        rng.shuffle(user_ids)
+        elapsed = await bench.run(user_ids, args.concurrency)
+        pipeline = application.bot_data.get("receipt_pipeline")
+        if pipeline:
+            await pipeline.queue.join()
+        # مشترکان رویدادها پیام‌های outbox را ثبت می‌کنند؛ پیش از تخلیه‌ی outbox
+        await application.bot_data["events"].drain()
+        outbox = application.bot_data.get("outbox")
+        if outbox:
+            await outbox.drain()
+    finally:
+        await application.stop()
+        await main.post_shutdown(application)
+        await application.shutdown()
+
+    result = bench.report(elapsed)
+    result["meta"] = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "storage": args.storage,
+        "flows": len(user_ids),
+        "concurrency": args.concurrency,
+        "api_latency_s": args.api_latency,
+        "seeded_users": seeded_users,
+        "seeded_transactions": seeded_transactions,
+        "db_path": db_path,
+    }
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="In-process handler benchmark against a fake Bot API.")
+    parser.add_argument("--users", type=int, default=200, help="number of synthetic user flows")
+    parser.add_argument("--seed-users", type=int, default=2000, help="users pre-seeded into the temp database")
+    parser.add_argument("--concurrency", type=int, default=1, help="flows processed concurrently")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency in seconds")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite", help="storage backend")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--output", default="bench_handlers.json", help="JSON results file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(f"{result['updates']} updates in {result['elapsed_s']}s "
+          f"({result['throughput_updates_per_s']} updates/s)")
+    print(f"{'handler':<32} {'count':>6} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'db/upd':>7}")
+    for label, row in result["handlers"].items():
+        print(f"{label:<32} {row['count']:>6} {row['errors']:>4} {row['p50_ms']:>8} "
+              f"{row['p95_ms']:>8} {row['p99_ms']:>8} {row['db_queries_per_update']:>7}")
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
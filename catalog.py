@@ -0,0 +1,161 @@
+import csv
+import zlib
+from bisect import bisect_right
+from collections import namedtuple
+from types import MappingProxyType
+
+# پیشوند callback_data انتخاب بسته: pkg_<نسخه>_<شناسه>
+TOKEN_PREFIX = "pkg_"
+
+# base: مبلغ پایه به تومان، amount: مبلغ نهایی پس از تخفیف سطح وفاداری
+Quote = namedtuple('Quote', 'base amount discount_percentage')
+# ستون‌های فایل CSV فهرست بسته‌ها
+CSV_COLUMNS = ('package_name', 'amount', 'description')
+# ردیف معتبر فایل CSV و تفاوت آن با فهرست فعلی (changed: جفت (قبلی، جدید))
+CatalogRow = namedtuple('CatalogRow', CSV_COLUMNS)
+CatalogDiff = namedtuple('CatalogDiff', 'added changed removed')
+
+
+def is_charge(package):
+    return 'شارژ' in package.package_name
+
+
+def is_internet(package):
+    return 'GB' in package.package_name
+
+
+def parse_tiers(spec):
+    # "10:10,25:15" -> ((0, 0), (10, 10), (25, 15)): (حداقل تراکنش موفق، درصد تخفیف)
+    # پیام ValueError برای نمایش به مدیر است
+    tiers = {0: 0}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        threshold, _, percentage = item.partition(":")
+        try:
+            threshold, percentage = int(threshold), int(percentage)
+        except ValueError:
+            raise ValueError(f"سطح نامعتبر: {item}") from None
+        if threshold < 0:
+            raise ValueError(f"تعداد تراکنش نمی‌تواند منفی باشد: {item}")
+        if not 0 <= percentage < 100:
+            raise ValueError(f"درصد تخفیف باید بین 0 و 99 باشد: {item}")
+        tiers[threshold] = percentage
+    return tuple(sorted(tiers.items()))
+
+
+def format_tiers(tiers):
+    # سطح پیش‌فرض (0, 0) که parse_tiers خودش اضافه می‌کند نوشته نمی‌شود؛ تخفیف پایه‌ی 0:<درصد> حفظ می‌شود
+    return ",".join(f"{threshold}:{percentage}" for threshold, percentage in tiers if threshold or percentage)
+
+
+class Catalog:
+    # تصویر تغییرناپذیر قیمت‌ها: با هر تغییر قیمت یا تنظیمات یک نمونه‌ی جدید ساخته و جایگزین می‌شود،
+    # بنابراین Handlerها بدون قفل از آن می‌خوانند
+    def __init__(self, prices=(), settings=None):
+        settings = settings or {}
+        self.packages = tuple(prices)
+        self.conversion_rate = int(settings.get('conversion_rate', 1))
+        self.tiers = parse_tiers(settings.get('discount_tiers', ''))
+        self.by_id = MappingProxyType({p.package_id: p for p in self.packages})
+        self._thresholds = [threshold for threshold, _ in self.tiers]
+        # ماتریس قیمت (بسته × سطح وفاداری) یک بار و یکجا محاسبه می‌شود
+        self.quotes = MappingProxyType({
+            (package.package_id, tier): self._quote(package, percentage)
+            for package in self.packages
+            for tier, (_, percentage) in enumerate(self.tiers)
+        })
+        # نسخه از محتوای فهرست ساخته می‌شود تا پس از راه‌اندازی مجدد هم برای دکمه‌های قدیمی معتبر بماند
+        digest = zlib.crc32(repr((self.conversion_rate, self.tiers, self.packages)).encode("utf-8"))
+        self.version = f"{digest & 0xFFFFFF:x}"
+
+    @classmethod
+    async def load(cls, storage, defaults=None):
+        settings = dict(defaults or {})
+        settings.update(await storage.get_settings())
+        return cls(await storage.get_prices(), settings)
+
+    def _quote(self, package, percentage):
+        # مبلغ بسته‌های شارژ به افغانی ذخیره شده و به تومان تبدیل می‌شود
+        base = package.amount * self.conversion_rate if is_charge(package) else package.amount
+        return Quote(base, base - int(base * (percentage / 100)), percentage)
+
+    @property
+    def discount_threshold(self):
+        # حداقل تراکنش موفق برای اولین سطح تخفیف
+        return self.tiers[1][0] if len(self.tiers) > 1 else None
+
+    def tier_for(self, completed_transactions):
+        return bisect_right(self._thresholds, completed_transactions) - 1
+
+    def quote(self, package, tier=0):
+        return self.quotes[(package.package_id, tier)]
+
+    def token(self, package):
+        return f"{TOKEN_PREFIX}{self.version}_{package.package_id}"
+
+    def resolve(self, data):
+        # None اگر دکمه متعلق به نسخه‌ی دیگری از فهرست باشد یا بسته حذف شده باشد
+        try:
+            version, package_id = data[len(TOKEN_PREFIX):].split("_")
+            package_id = int(package_id)
+        except ValueError:
+            return None
+        if version != self.version:
+            return None
+        return self.by_id.get(package_id)
+
+
+def catalog_csv(packages, out):
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    for package in packages:
+        writer.writerow((package.package_name, package.amount, package.description or ''))
+
+
+def parse_catalog_csv(lines, max_errors=20):
+    # یک گذر روی خطوط؛ فایل باید کل فهرست مطلوب باشد. خروجی: (ردیف‌ها به ترتیب فایل، خطاها با شماره‌ی خط)
+    rows = {}
+    errors = []
+    reader = csv.reader(lines)
+    header = [column.strip().lower() for column in next(reader, [])]
+    if tuple(header[:len(CSV_COLUMNS)]) != CSV_COLUMNS:
+        return [], [f"سطر 1: ستون‌ها باید {','.join(CSV_COLUMNS)} باشند"]
+    for record in reader:
+        if len(errors) >= max_errors:
+            break
+        line = reader.line_num
+        if not any(field.strip() for field in record):
+            continue
+        if len(record) < 2:
+            errors.append(f"سطر {line}: تعداد ستون‌ها کم است")
+            continue
+        name = record[0].strip()
+        amount = record[1].strip().replace(',', '').replace('٬', '')
+        description = record[2].strip() if len(record) > 2 else ''
+        amount = amount.translate(str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789'))
+        if not name:
+            errors.append(f"سطر {line}: نام بسته خالی است")
+        elif name in rows:
+            errors.append(f"سطر {line}: بسته‌ی «{name}» تکراری است")
+        elif not amount.isdigit() or not int(amount):
+            errors.append(f"سطر {line}: مبلغ «{record[1].strip()}» عدد صحیح مثبت نیست")
+        else:
+            rows[name] = CatalogRow(name, int(amount), description)
+    return list(rows.values()), errors
+
+
+def diff_catalog(packages, rows):
+    current = {p.package_name: p for p in packages}
+    wanted = {row.package_name for row in rows}
+    added, changed = [], []
+    for row in rows:
+        old = current.get(row.package_name)
+        if old is None:
+            added.append(row)
+        elif (old.amount, old.description or '') != (row.amount, row.description):
+            changed.append((old, row))
+    removed = [p for p in packages if p.package_name not in wanted]
+    return CatalogDiff(added, changed, removed)
+
+
+def discount_message(quote):
+    return f"{quote.discount_percentage}% تخفیف ویژه" if quote.discount_percentage else None
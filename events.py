@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from collections import namedtuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# رویدادهای چرخه‌ی عمر تراکنش و تیکت؛ پس از ثبت تغییر در دیتابیس منتشر می‌شوند
+TransactionCreated = namedtuple('TransactionCreated', 'transaction_id user_id amount package_name')
+ReceiptSubmitted = namedtuple('ReceiptSubmitted', 'transaction_id user_id reviewer_id duplicate_of')
+TransactionApproved = namedtuple('TransactionApproved', 'transaction_id user_id amount reviewer_id')
+TransactionRejected = namedtuple('TransactionRejected', 'transaction_id user_id amount reviewer_id')
+TransactionExpired = namedtuple('TransactionExpired', 'transaction_id user_id')
+TicketOpened = namedtuple('TicketOpened', 'ticket_id user_id reviewer_id')
+TicketAnswered = namedtuple('TicketAnswered', 'ticket_id user_id reviewer_id')
+
+
+class Subscriber:
+    __slots__ = ("name", "callback", "queue", "task")
+
+    def __init__(self, name, callback, queue_size):
+        self.name = name
+        self.callback = callback
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+
+
+class EventBus:
+    # هر مشترک صف محدود و Task خودش را دارد؛ publish هرگز منتظر نمی‌ماند، پس کندی یک مشترک نه Handler را
+    # کند می‌کند و نه مشترکان دیگر را. با پر شدن صف رویداد برای همان مشترک دور ریخته و شمارش می‌شود.
+    # callback(event, context): context همان bot_data برنامه است
+    def __init__(self, context=None, queue_size=1000):
+        self.context = context
+        self.queue_size = queue_size
+        self._subscribers = []
+        self._routes = {}
+
+    def subscribe(self, callback, *event_types, name=None, queue_size=None):
+        name = name or callback.__name__
+        subscriber = Subscriber(name, metrics.instrument_callback(callback, kind="event", name=name),
+                                queue_size or self.queue_size)
+        self._subscribers.append(subscriber)
+        for event_type in event_types:
+            self._routes.setdefault(event_type, []).append(subscriber)
+        return subscriber
+
+    def publish(self, event):
+        event_name = type(event).__name__
+        metrics.EVENTS.inc(event_name, "published")
+        for subscriber in self._routes.get(type(event), ()):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                metrics.EVENTS.inc(event_name, "dropped")
+                logger.warning("Event queue of %s full, dropping %s", subscriber.name, event_name)
+
+    async def start(self):
+        for subscriber in self._subscribers:
+            subscriber.task = asyncio.create_task(self._worker(subscriber), name=f"events-{subscriber.name}")
+            metrics.QUEUE_DEPTH.set_function(subscriber.queue.qsize,
+                                             metrics.tenant_label(self.context, f"events:{subscriber.name}"))
+
+    async def stop(self, timeout=5.0):
+        # رویدادهای باقی‌مانده تا سقف timeout پردازش می‌شوند
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Event bus stopped with undelivered events")
+        for subscriber in self._subscribers:
+            if subscriber.task:
+                subscriber.task.cancel()
+        await asyncio.gather(*(s.task for s in self._subscribers if s.task), return_exceptions=True)
+        for subscriber in self._subscribers:
+            subscriber.task = None
+
+    async def drain(self):
+        for subscriber in self._subscribers:
+            if subscriber.task:
+                await subscriber.queue.join()
+
+    async def _worker(self, subscriber):
+        while True:
+            event = await subscriber.queue.get()
+            try:
+                await subscriber.callback(event, self.context)
+            except Exception as e:
+                metrics.EVENTS.inc(type(event).__name__, "failed")
+                logger.error("Event subscriber %s failed on %s: %s", subscriber.name, type(event).__name__, e)
+            finally:
+                subscriber.queue.task_done()
@@ -0,0 +1,409 @@
+# سرور جعلی Bot API برای آزمون بار بدون تماس با Telegram
+# ربات با BOT_API_URL=http://127.0.0.1:8081/bot (و BOT_FILE_URL) به این سرور وصل می‌شود؛ Updateها با push_update
+# در صف getUpdates (یا Webhook) قرار می‌گیرند و پیام‌های ربات در صندوق هر چت برای شبیه‌ساز کاربران ثبت می‌شوند.
+#
+# استفاده‌ی مستقل:
+#   python fake_bot_api.py --port 8081 --latency 0.05 --chat-rate 1 --global-rate 30
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl, urlsplit
+
+from antiflood import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# فیلدهایی که PTB به صورت JSON در فرم ارسال می‌کند
+JSON_FIELDS = ('reply_markup', 'entities', 'caption_entities', 'allowed_updates', 'media')
+# متدهایی که مثل Telegram محدودیت نرخ پیام دارند
+RATE_LIMITED_PREFIXES = ('send', 'edit')
+# متدهایی که خطای تزریقی نمی‌گیرند تا راه‌اندازی ربات مختل نشود
+NO_FAULT_METHODS = ('getMe', 'getUpdates', 'deleteWebhook', 'setWebhook', 'getWebhookInfo')
+
+
+def fake_receipt(name):
+    # تصویر PGM کوچک و یکتا برای هر فایل تا dHash رسیدها در بنچمارک هم اجرا شود
+    rnd = random.Random(name)
+    return b"P5\n64 64\n255\n" + bytes(rnd.randrange(256) for _ in range(64 * 64))
+
+
+class ApiError(Exception):
+    def __init__(self, code, description, parameters=None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+
+class BotState:
+    # وضعیت هر توکن: صف Updateها برای getUpdates یا Webhook
+    def __init__(self, bot_id):
+        self.bot_id = bot_id
+        self.updates = []
+        self.next_update_id = 1
+        self.new_update = asyncio.Event()
+        self.webhook_url = ""
+        self.webhook_secret = None
+
+
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_code=500,
+                 chat_rate=0.0, chat_burst=3, global_rate=0.0, retry_after=1, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        # سقف پیام در ثانیه برای هر چت و کل ربات (0 = بدون محدودیت)؛ عبور از آن پاسخ 429 با retry_after دارد
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_rate = global_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.responses = Counter()
+        self._rng = random.Random(seed)
+        self._bots = {}
+        self._inboxes = {}
+        self._chat_buckets = {}
+        self._global_buckets = {}
+        self._message_ids = itertools.count(1)
+        self._webhook_tasks = set()
+        self._connections = set()
+        self._server = None
+        self._http = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/bot"
+
+    @property
+    def base_file_url(self):
+        return f"http://{self.host}:{self.port}/file/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Fake Bot API listening on %s", self.base_url)
+        return self
+
+    async def stop(self):
+        # درخواست‌های getUpdates در حال انتظار و اتصال‌های باز بسته می‌شوند
+        tasks = self._webhook_tasks | self._connections
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._http is not None:
+            await self._http.aclose()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _bot(self, token):
+        state = self._bots.get(token)
+        if state is None:
+            bot_id = int(token.split(":", 1)[0]) if token.split(":", 1)[0].isdigit() else len(self._bots) + 1
+            state = self._bots[token] = BotState(bot_id)
+        return state
+
+    # -------------------------------
+    # رابط شبیه‌ساز کاربران
+    # -------------------------------
+    def push_update(self, token, update):
+        # update_id مثل Telegram توسط سرور و به ترتیب داده می‌شود
+        state = self._bot(token)
+        update = dict(update, update_id=state.next_update_id)
+        state.next_update_id += 1
+        if state.webhook_url:
+            task = asyncio.create_task(self._post_webhook(state, update))
+            self._webhook_tasks.add(task)
+            task.add_done_callback(self._webhook_tasks.discard)
+        else:
+            state.updates.append(update)
+            state.new_update.set()
+        return update["update_id"]
+
+    def inbox(self, token, chat_id):
+        key = (token, int(chat_id))
+        queue = self._inboxes.get(key)
+        if queue is None:
+            queue = self._inboxes[key] = asyncio.Queue()
+        return queue
+
+    async def wait_for(self, token, chat_id, predicate=None, timeout=10.0):
+        # اولین پیام ربات به این چت که با predicate بخواند؛ پیام‌های دیگر کنار گذاشته می‌شوند
+        queue = self.inbox(token, chat_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                message = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if predicate is None or predicate(message):
+                return message
+
+    # -------------------------------
+    # HTTP
+    # -------------------------------
+    async def _handle_connection(self, reader, writer):
+        # اتصال‌ها Keep-Alive هستند (httpx اتصال‌ها را نگه می‌دارد)
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                status, content_type, payload = await self._route(target, headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            logger.debug("Fake Bot API connection closed: %s", e)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    @staticmethod
+    def _parse_body(headers, body):
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename():
+                    params[name] = {"filename": part.get_filename(), "size": len(part.get_payload(decode=True))}
+                else:
+                    params[name] = part.get_payload(decode=True).decode("utf-8")
+            return params
+        return dict(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+
+    async def _route(self, target, headers, body):
+        path = urlsplit(target).path
+        if path.startswith("/file/bot"):
+            # محتوای ثابت بر اساس مسیر فایل: رسید تکراری محتوای یکسان دارد
+            self.calls["downloadFile"] += 1
+            return "200 OK", "image/x-portable-graymap", fake_receipt(path.rsplit("/", 1)[-1])
+        if not path.startswith("/bot"):
+            return "404 Not Found", "text/plain", b"not found\n"
+        token, _, api_method = path[len("/bot"):].partition("/")
+        self.calls[api_method] += 1
+        try:
+            params = self._parse_body(headers, body)
+            for field in JSON_FIELDS:
+                if isinstance(params.get(field), str):
+                    params[field] = json.loads(params[field])
+            result = await self._call(token, api_method, params)
+            code, payload = 200, {"ok": True, "result": result}
+        except ApiError as e:
+            code, payload = e.code, {"ok": False, "error_code": e.code, "description": e.description}
+            if e.parameters:
+                payload["parameters"] = e.parameters
+        self.responses[(api_method, code)] += 1
+        return f"{code} {'OK' if code == 200 else 'Error'}", "application/json", json.dumps(payload).encode()
+
+    def _check_rate(self, token, chat_id):
+        now = time.monotonic()
+        if self.global_rate:
+            bucket = self._global_buckets.setdefault(token, TokenBucket(self.global_rate, now))
+            if not bucket.take(self.global_rate, self.global_rate, now):
+                raise self._too_many()
+        if self.chat_rate and chat_id is not None:
+            bucket = self._chat_buckets.setdefault((token, chat_id), TokenBucket(self.chat_burst, now))
+            if not bucket.take(self.chat_rate, self.chat_burst, now):
+                raise self._too_many()
+
+    def _too_many(self):
+        return ApiError(429, f"Too Many Requests: retry after {self.retry_after}", {"retry_after": self.retry_after})
+
+    async def _call(self, token, api_method, params):
+        if api_method == "getUpdates":
+            return await self._get_updates(token, params)
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._rng.random() * self.jitter)
+        if self.error_rate and api_method not in NO_FAULT_METHODS and self._rng.random() < self.error_rate:
+            raise ApiError(self.error_code, "Injected error")
+        chat_id = self._chat_id(params)
+        if api_method.startswith(RATE_LIMITED_PREFIXES):
+            self._check_rate(token, chat_id)
+        handler = getattr(self, f"_api_{api_method}", None)
+        if handler is None:
+            raise ApiError(404, "Not Found: method not found")
+        return handler(token, params, chat_id)
+
+    @staticmethod
+    def _chat_id(params):
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            return None
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return chat_id
+
+    async def _get_updates(self, token, params):
+        state = self._bot(token)
+        if state.webhook_url:
+            raise ApiError(409, "Conflict: can't use getUpdates method while webhook is active")
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        # Updateهای تایید‌شده (کمتر از offset) حذف می‌شوند
+        state.updates = [u for u in state.updates if u["update_id"] >= offset]
+        if not state.updates and timeout:
+            state.new_update.clear()
+            try:
+                await asyncio.wait_for(state.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return state.updates[:limit]
+
+    async def _post_webhook(self, state, update):
+        import httpx
+        if self._http is None:
+            self._http = httpx.AsyncClient()
+        headers = {"X-Telegram-Bot-Api-Secret-Token": state.webhook_secret} if state.webhook_secret else {}
+        try:
+            await self._http.post(state.webhook_url, json=update, headers=headers)
+        except httpx.HTTPError as e:
+            logger.warning("Webhook delivery of update %s failed: %s", update["update_id"], e)
+
+    # -------------------------------
+    # متدهای Bot API
+    # -------------------------------
+    def _api_getMe(self, token, params, chat_id):
+        return {"id": self._bot(token).bot_id, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    def _api_setWebhook(self, token, params, chat_id):
+        state = self._bot(token)
+        state.webhook_url = params.get("url", "")
+        state.webhook_secret = params.get("secret_token")
+        return True
+
+    def _api_deleteWebhook(self, token, params, chat_id):
+        state = self._bot(token)
+        state.webhook_url = ""
+        if str(params.get("drop_pending_updates", "")).lower() == "true":
+            state.updates = []
+        return True
+
+    def _api_getWebhookInfo(self, token, params, chat_id):
+        state = self._bot(token)
+        return {"url": state.webhook_url, "has_custom_certificate": False,
+                "pending_update_count": len(state.updates)}
+
+    def _api_answerCallbackQuery(self, token, params, chat_id):
+        return True
+
+    def _api_getFile(self, token, params, chat_id):
+        file_id = params["file_id"]
+        return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": 1024,
+                "file_path": f"photos/{file_id}.jpg"}
+
+    def _message(self, token, api_method, params, chat_id, **fields):
+        if isinstance(chat_id, int):
+            chat = {"id": chat_id, "type": "private"}
+        else:
+            chat = {"id": -1001, "type": "channel", "title": str(chat_id)}
+        message_id = int(params["message_id"]) if "message_id" in params else next(self._message_ids)
+        message = {"message_id": message_id, "date": int(time.time()), "chat": chat,
+                   "from": {"id": self._bot(token).bot_id, "is_bot": True, "first_name": "Fake"}}
+        for key in ("text", "caption"):
+            if key in params:
+                message[key] = params[key]
+        message.update(fields)
+        if isinstance(chat_id, int):
+            markup = params.get("reply_markup") or {}
+            buttons = [b["callback_data"] for row in markup.get("inline_keyboard", ()) for b in row if "callback_data" in b]
+            self.inbox(token, chat_id).put_nowait(dict(message, method=api_method, buttons=buttons))
+        return message
+
+    def _api_sendMessage(self, token, params, chat_id):
+        return self._message(token, "sendMessage", params, chat_id)
+
+    def _api_sendPhoto(self, token, params, chat_id):
+        photo = params.get("photo")
+        file_id = photo if isinstance(photo, str) else f"upload{next(self._message_ids)}"
+        return self._message(token, "sendPhoto", params, chat_id, photo=[
+            {"file_id": file_id, "file_unique_id": f"u{file_id}", "width": 720, "height": 1280}])
+
+    def _api_sendDocument(self, token, params, chat_id):
+        document = params.get("document")
+        file_id = document if isinstance(document, str) else f"upload{next(self._message_ids)}"
+        return self._message(token, "sendDocument", params, chat_id,
+                             document={"file_id": file_id, "file_unique_id": f"u{file_id}"})
+
+    def _api_editMessageText(self, token, params, chat_id):
+        return self._message(token, "editMessageText", params, chat_id)
+
+    def _api_editMessageCaption(self, token, params, chat_id):
+        return self._message(token, "editMessageCaption", params, chat_id)
+
+    def _api_editMessageReplyMarkup(self, token, params, chat_id):
+        return self._message(token, "editMessageReplyMarkup", params, chat_id)
+
+
+async def serve(args):
+    api = FakeBotAPI(args.host, args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                     error_code=args.error_code, chat_rate=args.chat_rate, global_rate=args.global_rate,
+                     retry_after=args.retry_after)
+    await api.start()
+    print(f"Fake Bot API: BOT_API_URL={api.base_url} BOT_FILE_URL={api.base_file_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="base response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with an error")
+    parser.add_argument("--error-code", type=int, default=500, help="HTTP/Bot API code of injected errors")
+    parser.add_argument("--chat-rate", type=float, default=0.0, help="messages/s per chat before 429 (0 = off)")
+    parser.add_argument("--global-rate", type=float, default=0.0, help="messages/s per bot before 429 (0 = off)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in 429 responses")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+import metrics
+
+
+class IdempotencyGuard:
+    # Telegram پس از قطعی یا خطای Webhook همان Update را دوباره تحویل می‌دهد؛ update_id و شناسه‌ی Callback
+    # تا ttl ثانیه در یک حافظه‌ی محدود (حداکثر max_keys، قدیمی‌ترین اول حذف) نگه داشته می‌شوند و تکرار آن‌ها
+    # پیش از هر Handler کنار گذاشته می‌شود. پس از راه‌اندازی مجدد، انتقال وضعیت Compare-and-set در دیتابیس
+    # همان تضمین را می‌دهد.
+    def __init__(self, max_keys=10000, ttl=3600.0, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.clock = clock
+        self._seen = OrderedDict()
+
+    def seen(self, key):
+        # True اگر key در ttl اخیر ثبت شده باشد؛ در غیر این صورت ثبت می‌شود
+        now = self.clock()
+        while self._seen:
+            oldest, at = next(iter(self._seen.items()))
+            if now - at < self.ttl and len(self._seen) < self.max_keys:
+                break
+            del self._seen[oldest]
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        return False
+
+    def check(self, update):
+        # None یعنی Update تازه است؛ در غیر این صورت دلیل کنار گذاشتن برگردانده می‌شود
+        if self.seen(("update", update.update_id)):
+            return "redelivered_update"
+        query = update.callback_query
+        if query is not None and self.seen(("callback", query.id)):
+            return "redelivered_callback"
+        return None
+
+    async def filter_update(self, update, context):
+        reason = self.check(update)
+        if reason is None:
+            return
+        metrics.DROPPED_UPDATES.inc(reason)
+        if update.callback_query is not None:
+            try:
+                await update.callback_query.answer()
+            except TelegramError:
+                pass
+        raise ApplicationHandlerStop
+
+    def __len__(self):
+        return len(self._seen)
+
+    def install(self, application, group=-2):
+        # پیش از FloodGuard تا Update تکراری سهمیه‌ی کاربر را مصرف نکند
+        application.add_handler(TypeHandler(Update, self.filter_update), group=group)
@@ -0,0 +1,117 @@
+import atexit
+import contextvars
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+
+# زمینه‌ی Update در حال پردازش؛ توسط metrics.instrument_callback مقداردهی می‌شود
+log_context = contextvars.ContextVar("log_context", default={})
+
+CONTEXT_FIELDS = ("update_id", "user_id", "handler", "latency_ms")
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    # در Thread فراخواننده اجرا می‌شود تا مقدار contextvar در دسترس باشد
+    def filter(self, record):
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _file_handler(path, max_bytes, backup_count, when):
+    # چرخش بر اساس زمان (LOG_ROTATE_WHEN مثل midnight) یا حجم؛ نسخه‌های قدیمی فشرده می‌شوند
+    if when:
+        handler = logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count, encoding="utf-8")
+    else:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    handler.namer = lambda name: f"{name}.gz"
+    handler.rotator = _gzip_rotator
+    return handler
+
+
+def parse_levels(spec):
+    # "httpx=WARNING,receipts=DEBUG" -> {"httpx": "WARNING", "receipts": "DEBUG"}
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level=None, path=None, json_format=None, levels=None):
+    global _listener
+    level = level or os.getenv("LOG_LEVEL", "INFO")
+    path = path or os.getenv("LOG_FILE", "bot.log")
+    if json_format is None:
+        json_format = os.getenv("LOG_JSON", "0") == "1"
+    if levels is None:
+        levels = parse_levels(os.getenv("LOG_LEVELS", "httpx=WARNING,apscheduler=WARNING"))
+
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    file_handler = _file_handler(
+        path,
+        int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+        int(os.getenv("LOG_BACKUP_COUNT", "5")),
+        os.getenv("LOG_ROTATE_WHEN"),
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    # حلقه‌ی رویداد فقط رکورد را در صف می‌گذارد؛ نوشتن روی دیسک در Thread شنونده انجام می‌شود
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    for name, module_level in levels.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
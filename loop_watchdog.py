@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99, 1.0)
+
+
+class LoopWatchdog:
+    # یک Task در حلقه هر interval ثانیه ضربان ثبت می‌کند و تاخیر آن نسبت به زمان مورد انتظار همان lag حلقه است.
+    # یک Thread ناظر اگر ضربان بیش از threshold عقب بماند، پشته‌ی Thread حلقه را همان لحظه برمی‌دارد تا
+    # فراخوانی مسدودکننده (sqlite3، I/O فایل و...) همراه با Handler و Update مربوط لاگ شود.
+    # alert(text) اختیاری است و وقتی lag صدک ۹۵ پنجره به مدت alert_after ثانیه بالای alert_threshold بماند
+    # (حداکثر یک بار در هر alert_cooldown) فراخوانی می‌شود.
+    def __init__(self, interval=0.1, threshold=0.5, window=300.0, alert=None, alert_threshold=1.0,
+                 alert_after=60.0, alert_cooldown=900.0, clock=time.monotonic):
+        self.interval = interval
+        self.threshold = threshold
+        self.window = window
+        self.alert = alert
+        self.alert_threshold = alert_threshold
+        self.alert_after = alert_after
+        self.alert_cooldown = alert_cooldown
+        self.clock = clock
+        self.loop = None
+        self._loop_thread = None
+        self._samples = deque()
+        self._beat = None
+        self._stalled_beat = None
+        self._high_since = None
+        self._alerted_at = None
+        self._checked_at = 0.0
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = self.clock()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-watchdog")
+        self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        for q in QUANTILES:
+            metrics.LOOP_LAG_RECENT.set_function(lambda q=q: self.percentile(q), "max" if q == 1.0 else f"p{q * 100:g}")
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def percentile(self, q):
+        lags = sorted(lag for _, lag in self._samples)
+        if not lags:
+            return 0.0
+        return lags[min(len(lags) - 1, int(q * len(lags)))]
+
+    async def _heartbeat(self):
+        while True:
+            expected = self.clock() + self.interval
+            await asyncio.sleep(self.interval)
+            now = self.clock()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            metrics.LOOP_LAG.observe(lag)
+            self._samples.append((now, lag))
+            while self._samples[0][0] < now - self.window:
+                self._samples.popleft()
+            if lag >= self.threshold:
+                logger.warning("Event loop lagged %.0f ms", lag * 1000)
+            if self.alert is not None and now - self._checked_at >= 1.0:
+                self._checked_at = now
+                await self._check_alert(now)
+
+    async def _check_alert(self, now):
+        p95 = self.percentile(0.95)
+        if p95 < self.alert_threshold:
+            self._high_since = None
+            return
+        if self._high_since is None:
+            self._high_since = now
+        if now - self._high_since < self.alert_after:
+            return
+        if self._alerted_at is not None and now - self._alerted_at < self.alert_cooldown:
+            return
+        self._alerted_at = now
+        try:
+            await self.alert(
+                f"⚠️ تاخیر حلقه‌ی رویداد به مدت {now - self._high_since:.0f} ثانیه بالای آستانه است\n"
+                f"p50 {self.percentile(0.5) * 1000:.0f} ms | p95 {p95 * 1000:.0f} ms | "
+                f"max {self.percentile(1.0) * 1000:.0f} ms"
+            )
+        except Exception as e:
+            logger.error("Loop lag alert failed: %s", e)
+
+    def _monitor(self):
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            blocked = self.clock() - beat - self.interval
+            if blocked < self.threshold or beat == self._stalled_beat:
+                continue
+            # برای هر توقف فقط یک بار پشته گرفته می‌شود
+            self._stalled_beat = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)[-25:]) if frame is not None else ""
+            context = metrics.ACTIVE_CALLBACKS.get(asyncio.current_task(self.loop)) or {}
+            metrics.LOOP_STALLS.inc(context.get("handler") or "unknown")
+            logger.warning("Event loop blocked for %.0f ms in %s (update %s)\n%s",
+                           blocked * 1000, context.get("handler") or "unknown", context.get("update_id"), stack,
+                           extra=context)
@@ -1,10 +1,14 @@
 import os
-import sqlite3
+import asyncio
 import logging
 import csv
+import io
+import json
+import secrets
 from datetime import datetime, timedelta
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,260 +18,196 @@ from telegram.ext import (
     filters,
 )
 
+import metrics
+from antiflood import FloodGuard
+from idempotency import IdempotencyGuard
+from log_config import setup_logging
+from loop_watchdog import LoopWatchdog
+from outbox import OutboxDispatcher, outbox_message
+from priority import PriorityUpdateProcessor
+from profiling import CProfiler, SamplingProfiler
+from receipts import ReceiptPipeline, check_image_support, duplicate_flag
+from reviews import TICKET, TRANSACTION, ReviewQueue
+from events import (
+    EventBus,
+    ReceiptSubmitted,
+    TicketAnswered,
+    TicketOpened,
+    TransactionApproved,
+    TransactionCreated,
+    TransactionExpired,
+    TransactionRejected,
+)
+from catalog import (
+    TOKEN_PREFIX,
+    Catalog,
+    catalog_csv,
+    diff_catalog,
+    discount_message,
+    format_tiers,
+    is_charge,
+    is_internet,
+    parse_catalog_csv,
+    parse_tiers,
+)
+from segments import build_segments
+from storage import SQLiteStorage, Storage
+from tenants import SharedResources, Tenant, load_tenants, run_applications
+from ticket_inbox import INBOX_FILTERS, TicketThreadCache
+from user_state import UserState, UserStateStore
+
 # تنظیمات اولیه
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN")
+# نشانی Bot API؛ برای آزمون بار به سرور جعلی محلی اشاره می‌کند (fake_bot_api.py)
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
+BOT_FILE_URL = os.getenv("BOT_FILE_URL", "https://api.telegram.org/file/bot")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "YOUR_ADMIN_ID"))
+# مدیران بررسی رسید و پاسخ تیکت (جدا با کاما)؛ ADMIN_ID همچنان مدیر اصلی تنظیمات و گزارش‌هاست
+REVIEWER_IDS = tuple(int(i) for i in os.getenv("REVIEWER_IDS", str(ADMIN_ID)).split(",") if i.strip())
+REVIEW_ASSIGNMENT = os.getenv("REVIEW_ASSIGNMENT", "round_robin")  # round_robin یا load
+REVIEW_LEASE = int(os.getenv("REVIEW_LEASE", "600"))  # ثانیه تا واگذاری مورد بی‌پاسخ به مدیر دیگر
 BANK_CARD = os.getenv("BANK_CARD", "YOUR_BANK_CARD_NUMBER")
 CHANNEL_ID = os.getenv("CHANNEL_ID", "YOUR_CHANNEL_ID")  # شناسه کانال جهت ارسال پست تبلیغاتی
+# فایل JSON چند نمونه‌ی منطقه‌ای در یک Process (tenants.py)؛ با آن تنظیمات تکی بالا استفاده نمی‌شوند
+TENANTS_CONFIG = os.getenv("TENANTS_CONFIG", "")
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))  # Threadهای مشترک SQLite در اجرای چند Tenant
 DAILY_TRANSACTION_LIMIT = 5
+# مقادیر پیش‌فرض قیمت‌گذاری؛ مقدار جاری در جدول settings ذخیره و از Catalog خوانده می‌شود
 DISCOUNT_THRESHOLD = 10
 DISCOUNT_PERCENTAGE = 10
 CONVERSION_RATE = 1300
+DEFAULT_SETTINGS = {
+    'conversion_rate': str(CONVERSION_RATE),
+    'discount_tiers': f"{DISCOUNT_THRESHOLD}:{DISCOUNT_PERCENTAGE}",
+}
 TRANSACTION_EXPIRE_TIME = 15 * 60  # 15 دقیقه به ثانیه
-
-# تنظیم لاگ
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('bot.log'), logging.StreamHandler()]
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+# بایگانی تراکنش‌های پایان‌یافته‌ی قدیمی (0 = غیرفعال)؛ بدون ARCHIVE_DB_PATH جداول ماهانه در همان bot.db ساخته می‌شوند
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "")
+SNAPSHOT_DB_PATH = os.getenv("SNAPSHOT_DB_PATH", "snapshot.db")  # کپی خواندنی برای گزارش‌های سنگین (خالی = غیرفعال)
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", "300"))  # حداکثر قدیمی بودن Snapshot به ثانیه
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv("CHANGE_LOG_RETENTION_DAYS", "30"))  # فشرده‌سازی فید تغییرات (0 = غیرفعال)
+CHANGES_BATCH_SIZE = 500
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # پورت محلی متریک‌ها (0 = غیرفعال)
+RECEIPTS_DIR = os.getenv("RECEIPTS_DIR", "receipts")  # ذخیره‌ی رسیدها بر اساس محتوا
+RECEIPT_WORKERS = int(os.getenv("RECEIPT_WORKERS", "2"))  # 0 = بدون بررسی پیش از مدیر
+RECEIPT_QUEUE_SIZE = 100
+# بیت‌های متفاوت dHash دو رسید مشابه (حداکثر 7)؛ تطابق فقط تصویری «احتمال تکرار» علامت می‌خورد
+RECEIPT_PHASH_DISTANCE = int(os.getenv("RECEIPT_PHASH_DISTANCE", "2"))
+EVENT_QUEUE_SIZE = 1000  # صف هر مشترک رویدادها (events.py)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))  # ارسال پیام‌های اطلاع‌رسانی در پس‌زمینه
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", "1"))  # ثانیه بین دو پیام به یک چت
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "25"))  # سقف کلی پیام در ثانیه
+# محدودیت ارسال هر کاربر (antiflood.py)
+SEGMENT_ACTIVE_DAYS = int(os.getenv("SEGMENT_ACTIVE_DAYS", "7"))  # بخش active_<N>d: سفارش در N روز گذشته
+SEGMENT_LOYALTY_MIN = int(os.getenv("SEGMENT_LOYALTY_MIN", "10"))  # بخش loyal: حداقل امتیاز وفاداری
+SEGMENT_REFRESH_INTERVAL = 300  # ثانیه بین به‌روزرسانی‌های افزایشی بخش‌ها
+BROADCAST_BATCH_SIZE = 500  # گیرندگان هر دسته‌ی پیام تبلیغاتی بخش‌ها
+USER_STATE_MAX_USERS = int(os.getenv("USER_STATE_MAX_USERS", "10000"))  # سقف کاربران دارای وضعیت گفت‌وگو در حافظه
+USER_STATE_IDLE_TTL = 24 * 3600  # حذف وضعیت کاربر پس از این مدت بی‌فعالیتی
+# مهلت هر کلید وضعیت؛ جریان رهاشده پس از آن به جریان بعدی نشت نمی‌کند
+USER_STATE_TTLS = {
+    'current_transaction': TRANSACTION_EXPIRE_TIME,
+    'expecting_phone': TRANSACTION_EXPIRE_TIME,
+    'expecting_payment': TRANSACTION_EXPIRE_TIME,
+    'awaiting_ticket_message': 3600,
+    'replying_to_ticket': REVIEW_LEASE,
+    'changing_conversion_rate': 1800,
+    'admin_add_package': 1800,
+    'admin_delete_package': 1800,
+    'catalog_import': 1800,
+}
+CATALOG_CSV_MAX_BYTES = 1024 * 1024
+INBOX_PAGE_SIZE = 8  # تیکت‌های هر صفحه‌ی /inbox
+TICKET_THREAD_CACHE_SIZE = 256  # رشته‌های تیکت نگه‌داشته‌شده در حافظه
+# وضعیت نهایی سفارشی که پیش از تصمیم مدیر بررسی شده است
+REVIEWED_LABELS = {'completed': "✅ قبلاً تایید شده است", 'rejected': "❌ قبلاً رد شده است", 'expired': "⌛ منقضی شده است"}
+INBOX_LABELS = {'open': "باز", 'answered': "پاسخ‌داده", 'all': "همه"}
+CATALOG_DIFF_LINES = 30  # حداکثر سطرهای پیش‌نمایش تغییرات فهرست
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.5"))  # ثانیه توقف حلقه تا ثبت پشته (0 = غیرفعال)
+LOOP_LAG_ALERT = float(os.getenv("LOOP_LAG_ALERT", "1"))  # هشدار به مدیر برای lag صدک ۹۵ بالاتر از این (0 = بدون هشدار)
+LOOP_LAG_ALERT_AFTER = 60  # ثانیه ماندگاری lag بالا پیش از هشدار
+PROFILE_SECONDS = 30  # مدت پیش‌فرض /profiling
+PROFILE_MAX_SECONDS = 300
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # فاصله‌ی نمونه‌برداری پروفایلر (ثانیه)
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))  # Update در ثانیه
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "5"))
+FLOOD_COOLDOWN = float(os.getenv("FLOOD_COOLDOWN", "2"))  # فاصله‌ی حداقل بین تکرار کارهای سنگین
+FLOOD_DUPLICATE_WINDOW = float(os.getenv("FLOOD_DUPLICATE_WINDOW", "1"))
+# Updateها و Callbackهای اخیر برای کنار گذاشتن تحویل دوباره (تعداد و مدت نگهداری به ثانیه)
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "20000"))
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "3600"))
+# زمان‌بندی Updateها بر اساس کلاس اولویت (priority.py)؛ با یک Worker ترتیب اجرای Handlerها مثل قبل ترتیبی است
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "1"))
+UPDATE_SHED_THRESHOLD = int(os.getenv("UPDATE_SHED_THRESHOLD", "500"))  # Updateهای در صف تا دور ریختن کلاس browsing
+UPDATE_WEIGHTS = json.loads(os.getenv("UPDATE_WEIGHTS", "{}"))  # مثال: {"admin": 8, "payment": 4}
+# دکمه‌های منوی کاربر؛ سهمیه‌ی FloodGuard فقط روی این دکمه‌ها، فرمان‌ها و Callbackها اعمال می‌شود
+USER_MENU = (
+    ('📱 خرید شارژ', '📦 بسته‌های اینترنت'),
+    ('💰 تعرفه‌ها', '📞 پشتیبانی'),
+    ('👤 پروفایل من', '🎫 تیکت جدید'),
+    ('📄 تاریخچه تراکنش‌ها', '✍️ ثبت بازخورد'),
+)
+# منوها و فرمان‌هایی که هر بار چند کوئری دیتابیس اجرا می‌کنند
+EXPENSIVE_ACTIONS = (
+    '📱 خرید شارژ', '📦 بسته‌های اینترنت', '💰 تعرفه‌ها', '👤 پروفایل من',
+    '📄 تاریخچه تراکنش‌ها', '/history', '/start',
 )
+
+# تنظیم لاگ در main() با log_config.setup_logging انجام می‌شود (LOG_LEVEL, LOG_FILE, LOG_JSON, LOG_LEVELS)
 logger = logging.getLogger(__name__)
 
 # -------------------------------
-# راه‌اندازی دیتابیس و جداول
+# لایه‌ی داده
 # -------------------------------
-def init_db():
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    # جدول کاربران (با ستون loyalty_points برای برنامه وفاداری)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            join_date TEXT,
-            transactions_count INTEGER DEFAULT 0,
-            total_spent INTEGER DEFAULT 0,
-            loyalty_points INTEGER DEFAULT 0
-        )
-    ''')
-    # جدول تراکنش‌ها
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            transaction_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            amount INTEGER,
-            package_name TEXT,
-            status TEXT,
-            phone_number TEXT,
-            created_at TEXT,
-            payment_time TEXT,
-            completed_at TEXT,
-            rejected_at TEXT,
-            expired_at TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
-    ''')
-    # جدول تیکت‌ها
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tickets (
-            ticket_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            message TEXT,
-            status TEXT,
-            created_at TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
-    ''')
-    # جدول پاسخ‌های تیکت‌ها
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ticket_replies (
-            reply_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ticket_id TEXT,
-            from_admin BOOLEAN,
-            message TEXT,
-            time TEXT,
-            FOREIGN KEY(ticket_id) REFERENCES tickets(ticket_id)
-        )
-    ''')
-    # جدول قیمت‌ها
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS prices (
-            package_name TEXT PRIMARY KEY,
-            amount INTEGER,
-            description TEXT
-        )
-    ''')
-    # جدول بازخورد
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS feedbacks (
-            feedback_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            rating INTEGER,
-            message TEXT,
-            created_at TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+def get_storage(context) -> Storage:
+    # هر Application مخزن داده‌ی خودش را در bot_data نگه می‌دارد (storage.py)
+    return context.bot_data['storage']
+
+def get_catalog(context) -> Catalog:
+    return context.bot_data['catalog']
+
+def get_user_state(update, context) -> UserState:
+    # به جای context.user_data که برای هر کاربر تا ابد می‌ماند (user_state.py)
+    return context.bot_data['user_state'].get(update.effective_user.id)
+
+def get_review_queue(context) -> ReviewQueue:
+    return context.bot_data['review_queue']
+
+def get_event_bus(context) -> EventBus:
+    return context.bot_data['events']
+
+def get_ticket_threads(context) -> TicketThreadCache:
+    return context.bot_data['ticket_threads']
+
+def get_tenant(context) -> Tenant:
+    # تنظیمات همین نمونه‌ی ربات (مدیر، کارت، کانال)؛ در اجرای چند Tenant هر Application مقدار خودش را دارد
+    return context.bot_data['tenant']
+
+async def refresh_catalog(bot_data):
+    # پس از هر تغییر در جداول prices یا settings فراخوانی شود؛ تصویر قبلی یکجا جایگزین می‌شود
+    bot_data['catalog'] = await Catalog.load(bot_data['storage'], DEFAULT_SETTINGS)
 
-def load_initial_prices():
+async def load_initial_prices(storage: Storage):
     initial_prices = {
         "شارژ 50 افغانی": {"amount": 50, "description": "شارژ سریع و مستقیم 50 افغانی"},
         "شارژ 100 افغانی": {"amount": 100, "description": "شارژ سریع و مستقیم 100 افغانی"},
         "بسته 1GB": {"amount": 35000, "description": "بسته اینترنت 1 گیگابایتی با سرعت بالا"},
         "بسته 3GB": {"amount": 85000, "description": "بسته اینترنت 3 گیگابایتی با ظرفیت بیشتر"}
     }
-    if not get_prices():
+    if not await storage.get_prices():
         for name, details in initial_prices.items():
-            add_price(name, details['amount'], details['description'])
-
-# -------------------------------
-# توابع دیتابیس
-# -------------------------------
-def add_user(user_id, username):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO users (user_id, username, join_date) VALUES (?, ?, ?)',
-                   (user_id, username, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
-
-def get_user(user_id):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
-
-def update_user_transaction(user_id, amount):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users
-        SET transactions_count = transactions_count + 1,
-            total_spent = total_spent + ?,
-            loyalty_points = loyalty_points + 1
-        WHERE user_id = ?
-    ''', (amount, user_id))
-    conn.commit()
-    conn.close()
-
-def add_transaction(transaction_id, user_id, amount, package_name):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO transactions (transaction_id, user_id, amount, package_name, status, created_at)
-        VALUES (?, ?, ?, ?, 'pending', ?)
-    ''', (transaction_id, user_id, amount, package_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
-    notify_admin_new_transaction(transaction_id, user_id, amount, package_name)
-
-def update_transaction_status(transaction_id, status, field):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute(f'''
-        UPDATE transactions
-        SET status = ?, {field} = ?
-        WHERE transaction_id = ?
-    ''', (status, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), transaction_id))
-    conn.commit()
-    conn.close()
-
-def expire_transaction(transaction_id):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE transactions SET status = "expired", expired_at = ? WHERE transaction_id = ?',
-                   (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), transaction_id))
-    conn.commit()
-    conn.close()
-
-def get_transactions_today(user_id):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM transactions WHERE user_id = ? AND created_at LIKE ?', (user_id, f"{datetime.now().strftime('%Y-%m-%d')}%"))
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
-
-def get_completed_transactions(user_id):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*), SUM(amount) FROM transactions WHERE user_id = ? AND status = "completed"', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result if result else (0, 0)
-
-def add_ticket(ticket_id, user_id, message):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO tickets (ticket_id, user_id, message, status, created_at)
-        VALUES (?, ?, ?, 'pending', ?)
-    ''', (ticket_id, user_id, message, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
-    notify_admin_new_ticket(ticket_id, user_id, message)
-
-def get_ticket(ticket_id):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM tickets WHERE ticket_id = ?', (ticket_id,))
-    ticket = cursor.fetchone()
-    conn.close()
-    return ticket
-
-def add_ticket_reply(ticket_id, from_admin, message):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO ticket_replies (ticket_id, from_admin, message, time) VALUES (?, ?, ?, ?)',
-                   (ticket_id, from_admin, message, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
-
-def update_ticket_status(ticket_id, status):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE tickets SET status = ? WHERE ticket_id = ?', (status, ticket_id))
-    conn.commit()
-    conn.close()
-
-def get_prices():
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM prices')
-    prices = cursor.fetchall()
-    conn.close()
-    return prices
-
-def add_price(package_name, amount, description):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO prices (package_name, amount, description) VALUES (?, ?, ?)',
-                   (package_name, amount, description))
-    conn.commit()
-    conn.close()
-
-def delete_price(package_name):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM prices WHERE package_name = ?', (package_name,))
-    conn.commit()
-    conn.close()
-
-def add_feedback(user_id, rating, message):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO feedbacks (user_id, rating, message, created_at) VALUES (?, ?, ?, ?)',
-                   (user_id, rating, message, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
+            await storage.add_price(name, details['amount'], details['description'])
 
 # -------------------------------
 # توابع کمکی عمومی
 # -------------------------------
+def generate_id(prefix: str) -> str:
+    # پسوند تصادفی از تکرار شناسه برای چند سفارش در یک ثانیه جلوگیری می‌کند
+    return f"{prefix}{int(datetime.now().timestamp())}{secrets.token_hex(2).upper()}"
+
 def convert_to_english_digits(text: str) -> str:
     persian_digits = '۰۱۲۳۴۵۶۷۸۹'
     english_digits = '0123456789'
@@ -285,121 +225,73 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     logger.error("Exception while handling an update:", exc_info=context.error)
     try:
         if update and hasattr(update, 'effective_user'):
-            if update.effective_user.id != ADMIN_ID:
+            if update.effective_user.id != get_tenant(context).admin_id:
                 await context.bot.send_message(chat_id=update.effective_user.id, text="❌ متأسفانه خطایی رخ داده است. لطفاً چند لحظه دیگر تلاش کنید.")
             else:
-                await context.bot.send_message(chat_id=ADMIN_ID, text=f"❌ خطا: {context.error}")
+                await context.bot.send_message(chat_id=get_tenant(context).admin_id, text=f"❌ خطا: {context.error}")
     except Exception as e:
-        logger.error(f"Error in error_handler: {e}")
+        logger.error("Error in error_handler: %s", e)
 
 # -------------------------------
 # توابع اطلاع‌رسانی به مدیر (گزارش‌های لحظه‌ای)
 # -------------------------------
-def notify_admin_new_transaction(transaction_id, user_id, amount, package_name):
+# پیام‌ها از طریق outbox و همراه تغییر وضعیت در دیتابیس ثبت و در پس‌زمینه ارسال می‌شوند (outbox.py)
+# گزارش‌های صرفاً اطلاعاتی مشترک رویدادها هستند و خارج از مسیر Handler اجرا می‌شوند (events.py)
+async def notify_admin_new_transaction(event: TransactionCreated, bot_data):
     msg = (f"🆕 *تراکنش جدید:*\n"
-           f"شناسه: `{transaction_id}`\n"
-           f"کاربر: `{user_id}`\n"
-           f"مبلغ: {amount:,} تومان\n"
-           f"سرویس: {package_name}")
-    app = Application.get_current()
-    app.bot.send_message(chat_id=ADMIN_ID, text=msg, parse_mode=ParseMode.MARKDOWN)
-
-def notify_admin_new_ticket(ticket_id, user_id, message):
-    msg = (f"🆕 *تیکت جدید:*\n"
-           f"شناسه: `{ticket_id}`\n"
-           f"کاربر: `{user_id}`\n"
-           f"پیام: {message}")
-    app = Application.get_current()
-    app.bot.send_message(chat_id=ADMIN_ID, text=msg, parse_mode=ParseMode.MARKDOWN)
+           f"شناسه: `{event.transaction_id}`\n"
+           f"کاربر: `{event.user_id}`\n"
+           f"مبلغ: {event.amount:,} تومان\n"
+           f"سرویس: {event.package_name}")
+    await bot_data['storage'].enqueue_messages([admin_notification(bot_data, msg)])
 
-# -------------------------------
-# توابع Broadcast و ارسال پست کانال
-# -------------------------------
-async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("🚫 شما اجازه استفاده از این فرمان را ندارید.")
-        return
-    if not context.args:
-        await update.message.reply_text("❌ لطفاً متن پیام تبلیغاتی را وارد کنید.\nفرمت: /broadcast <پیام>")
-        return
-    message_text = " ".join(context.args)
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users")
-    users = cursor.fetchall()
-    conn.close()
-    count = 0
-    for user in users:
-        try:
-            await context.bot.send_message(chat_id=user[0], text=message_text)
-            count += 1
-        except Exception as e:
-            logger.error(f"Broadcast error for user {user[0]}: {e}")
-    await update.message.reply_text(f"✅ پیام تبلیغاتی به {count} کاربر ارسال شد.", parse_mode=ParseMode.MARKDOWN)
+def register_subscribers(events: EventBus):
+    events.subscribe(notify_admin_new_transaction, TransactionCreated)
 
-async def post_to_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("🚫 شما اجازه ارسال پست به کانال را ندارید.")
-        return
-    if not context.args:
-        await update.message.reply_text("❌ لطفاً متن پست را وارد کنید.\nفرمت: /post <متن پست>")
-        return
-    post_text = " ".join(context.args)
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("بازدید از سایت", url="https://example.com")]
-    ])
-    try:
-        await context.bot.send_message(chat_id=CHANNEL_ID, text=post_text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
-        await update.message.reply_text("✅ پست به کانال ارسال شد.", parse_mode=ParseMode.MARKDOWN)
-    except Exception as e:
-        await update.message.reply_text(f"❌ خطا در ارسال پست به کانال: {e}")
+def admin_notification(bot_data, msg, **kwargs):
+    return outbox_message(bot_data['tenant'].admin_id, text=msg, parse_mode=ParseMode.MARKDOWN, **kwargs)
 
 # -------------------------------
 # منوی اصلی
 # -------------------------------
-def build_main_menu(user_id: int):
-    keyboard = [
-        ['📱 خرید شارژ', '📦 بسته‌های اینترنت'],
-        ['💰 تعرفه‌ها', '📞 پشتیبانی'],
-        ['👤 پروفایل من', '🎫 تیکت جدید'],
-        ['📄 تاریخچه تراکنش‌ها', '✍️ ثبت بازخورد']
-    ]
-    if user_id == ADMIN_ID:
+def build_main_menu(user_id: int, admin_id: int):
+    keyboard = [list(row) for row in USER_MENU]
+    if user_id == admin_id:
         keyboard.append(['📊 آمار', '💾 بکاپ گیری', '📋 گزارش‌ها'])
         keyboard.append(['➕ افزودن بسته', '➖ حذف بسته'])
         keyboard.append(['تغییر نرخ تبدیل', '🔍 جستجو'])
         keyboard.append(['📣 پیام تبلیغاتی', '📢 پست کانال'])
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-async def check_user_limits(user_id):
-    count = get_transactions_today(user_id)
+async def check_user_limits(storage, user_id):
+    count = await storage.get_transactions_today(user_id)
     if count >= DAILY_TRANSACTION_LIMIT:
         return False, "🚫 امروز به حداکثر تعداد تراکنش (۵ تراکنش) رسیده‌اید. لطفاً فردا امتحان کنید."
     return True, None
 
-def calculate_discount(user_id, amount):
-    completed_trans, _ = get_completed_transactions(user_id)
-    if completed_trans >= DISCOUNT_THRESHOLD:
-        discount = int(amount * (DISCOUNT_PERCENTAGE / 100))
-        return amount - discount, f"{DISCOUNT_PERCENTAGE}% تخفیف ویژه"
-    return amount, None
+async def get_user_tier(storage, catalog, user_id):
+    # سطح وفاداری یک بار برای هر درخواست؛ قیمت‌ها از ماتریس از پیش محاسبه‌شده‌ی Catalog خوانده می‌شوند
+    completed_trans, _ = await storage.get_completed_transactions(user_id)
+    return catalog.tier_for(completed_trans)
 
 # -------------------------------
 # دستورات اصلی ربات
 # -------------------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.pop("admin_add_package", None)
-    context.user_data.pop("admin_delete_package", None)
-    context.user_data.pop("changing_conversion_rate", None)
+    get_user_state(update, context).pop("admin_add_package", None)
+    get_user_state(update, context).pop("admin_delete_package", None)
+    get_user_state(update, context).pop("changing_conversion_rate", None)
     
     user = update.effective_user
     user_id = user.id
     username = user.username or str(user_id)
-    add_user(user_id, username)
+    storage = get_storage(context)
+    await storage.add_user(user_id, username)
     
-    reply_markup = build_main_menu(user_id)
-    user_data = get_user(user_id)
+    reply_markup = build_main_menu(user_id, get_tenant(context).admin_id)
+    user_data = await storage.get_user(user_id)
     transactions_count = user_data[3]
+    threshold = get_catalog(context).discount_threshold
     welcome_text = (
         "🌟 سلام! به ربات شارژ و اینترنت مستقیم خوش آمدید.\n\n"
         "📌 امکانات:\n"
@@ -407,18 +299,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• بسته اینترنت دلخواه\n"
         "• پشتیبانی ۲۴ ساعته\n"
         "• ثبت بازخورد\n\n"
-        f"{'🎁 مشتری وفادار، امتیاز شما افزایش یافت!' if transactions_count >= DISCOUNT_THRESHOLD else '💡 به 10 تراکنش موفق نزدیک شوید تا تخفیف ویژه بگیرید.'}"
+        f"{'🎁 مشتری وفادار، امتیاز شما افزایش یافت!' if threshold is None or transactions_count >= threshold else f'💡 به {threshold} تراکنش موفق نزدیک شوید تا تخفیف ویژه بگیرید.'}"
     )
     await update.message.reply_text(welcome_text, reply_markup=reply_markup)
 
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_data = get_user(user_id)
+    storage = get_storage(context)
+    user_data = await storage.get_user(user_id)
     if not user_data:
         await update.message.reply_text("❌ اطلاعات کاربری یافت نشد.")
         return
-    completed_trans, total_spent = get_completed_transactions(user_id)
+    completed_trans, total_spent = await storage.get_completed_transactions(user_id)
     loyalty = user_data[5]
+    threshold = get_catalog(context).discount_threshold
     profile_text = (
         f"👤 *پروفایل شما:*\n"
         f"🆔 شناسه: `{user_id}`\n"
@@ -426,23 +320,13 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"✅ تراکنش‌های موفق: {completed_trans}\n"
         f"💰 مجموع خرید: {total_spent:,} تومان\n"
         f"⭐ امتیاز وفاداری: {loyalty}\n\n"
-        f"{'🌟 شما مشتری ویژه ما هستید!' if completed_trans >= DISCOUNT_THRESHOLD else f'🎯 تنها {DISCOUNT_THRESHOLD - completed_trans} تراکنش تا تخفیف ویژه!'}"
+        f"{'🌟 شما مشتری ویژه ما هستید!' if threshold is None or completed_trans >= threshold else f'🎯 تنها {threshold - completed_trans} تراکنش تا تخفیف ویژه!'}"
     )
     await update.message.reply_text(profile_text, parse_mode=ParseMode.MARKDOWN)
 
 async def transaction_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT transaction_id, amount, package_name, status, created_at
-        FROM transactions
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-        LIMIT 10
-    ''', (user_id,))
-    transactions = cursor.fetchall()
-    conn.close()
+    transactions = await get_storage(context).get_transaction_history(user_id)
     if not transactions:
         await update.message.reply_text("📄 تاکنون تراکنشی ثبت نشده است.")
         return
@@ -459,21 +343,21 @@ async def transaction_history(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def charge_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    can_order, limit_msg = await check_user_limits(user_id)
+    storage = get_storage(context)
+    can_order, limit_msg = await check_user_limits(storage, user_id)
     if not can_order:
         await update.message.reply_text(limit_msg)
         return
-    prices = get_prices()
+    catalog = get_catalog(context)
+    tier = await get_user_tier(storage, catalog, user_id)
     keyboard = []
-    for price in prices:
-        name, amount, description = price
-        if 'شارژ' in name:
-            converted_price = amount * CONVERSION_RATE
-            final_amount, discount_msg = calculate_discount(user_id, converted_price)
-            btn_text = f"{name} - {final_amount:,} تومان"
-            if discount_msg:
-                btn_text += f" ({discount_msg})"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"charge_{converted_price}_{name}")])
+    for package in catalog.packages:
+        if is_charge(package):
+            quote = catalog.quote(package, tier)
+            btn_text = f"{package.package_name} - {quote.amount:,} تومان"
+            if quote.discount_percentage:
+                btn_text += f" ({discount_message(quote)})"
+            keyboard.append([InlineKeyboardButton(btn_text, callback_data=catalog.token(package))])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         "*📱 لطفاً مبلغ شارژ مد نظر خود را انتخاب کنید:*\n\n⚠️ توجه: پس از انتخاب، شماره تماس مقصد را وارد خواهید کرد.",
@@ -483,20 +367,21 @@ async def charge_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def internet_packages_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    can_order, limit_msg = await check_user_limits(user_id)
+    storage = get_storage(context)
+    can_order, limit_msg = await check_user_limits(storage, user_id)
     if not can_order:
         await update.message.reply_text(limit_msg)
         return
-    prices = get_prices()
+    catalog = get_catalog(context)
+    tier = await get_user_tier(storage, catalog, user_id)
     keyboard = []
-    for price in prices:
-        name, amount, description = price
-        if 'GB' in name:
-            final_amount, discount_msg = calculate_discount(user_id, amount)
-            btn_text = f"{name} - {final_amount:,} تومان"
-            if discount_msg:
-                btn_text += f" ({discount_msg})"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"net_{amount}_{name}")])
+    for package in catalog.packages:
+        if is_internet(package):
+            quote = catalog.quote(package, tier)
+            btn_text = f"{package.package_name} - {quote.amount:,} تومان"
+            if quote.discount_percentage:
+                btn_text += f" ({discount_message(quote)})"
+            keyboard.append([InlineKeyboardButton(btn_text, callback_data=catalog.token(package))])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         "*📦 بسته‌های اینترنت موجود:*\n\n⚠️ توجه: پس از انتخاب، شماره تماس مقصد را وارد نمایید.",
@@ -506,17 +391,16 @@ async def internet_packages_menu(update: Update, context: ContextTypes.DEFAULT_T
 
 async def show_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    prices = get_prices()
+    storage = get_storage(context)
+    catalog = get_catalog(context)
+    tier = await get_user_tier(storage, catalog, user_id)
     text = "*💰 تعرفه‌های خدمات:*\n\n"
-    for price in prices:
-        name, amount, description = price
-        if 'شارژ' in name:
-            amount = amount * CONVERSION_RATE
-        final_amount, discount_msg = calculate_discount(user_id, amount)
-        text += f"*{name}*\n💵 قیمت: {final_amount:,} تومان"
-        if discount_msg:
-            text += f" ({discount_msg})"
-        text += f"\n📝 {description}\n\n"
+    for package in catalog.packages:
+        quote = catalog.quote(package, tier)
+        text += f"*{package.package_name}*\n💵 قیمت: {quote.amount:,} تومان"
+        if quote.discount_percentage:
+            text += f" ({discount_message(quote)})"
+        text += f"\n📝 {package.description}\n\n"
     await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
 async def support(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -531,7 +415,7 @@ async def support(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def support_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    context.user_data['awaiting_ticket_message'] = True
+    get_user_state(update, context)['awaiting_ticket_message'] = True
     keyboard = [[InlineKeyboardButton("❌ لغو", callback_data="cancel_ticket")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
@@ -542,9 +426,9 @@ async def support_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_ticket_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not context.user_data.get('awaiting_ticket_message'):
+    if not get_user_state(update, context).get('awaiting_ticket_message'):
         return
-    ticket_id = f"TK{int(datetime.now().timestamp())}"
+    ticket_id = generate_id("TK")
     if update.message.text:
         msg = update.message.text
     elif update.message.photo:
@@ -552,7 +436,6 @@ async def handle_ticket_message(update: Update, context: ContextTypes.DEFAULT_TY
     else:
         await update.message.reply_text("❌ لطفاً متن یا تصویر تیکت را ارسال کنید.")
         return
-    add_ticket(ticket_id, user_id, msg)
     admin_msg = (
         f"*🎫 تیکت جدید:*\n\n"
         f"شناسه: `{ticket_id}`\n"
@@ -563,30 +446,38 @@ async def handle_ticket_message(update: Update, context: ContextTypes.DEFAULT_TY
         [InlineKeyboardButton("📨 پاسخ به تیکت", callback_data=f"reply_ticket_{ticket_id}")]
     ])
     if update.message.photo:
-        await context.bot.send_photo(chat_id=ADMIN_ID, photo=update.message.photo[-1].file_id, caption=admin_msg,
-                                       reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+        notice = outbox_message(None, 'send_photo', photo=update.message.photo[-1].file_id, caption=admin_msg,
+                                reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
     else:
-        await context.bot.send_message(chat_id=ADMIN_ID, text=admin_msg, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+        notice = outbox_message(None, text=admin_msg, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    # تیکت به یکی از مدیران سپرده می‌شود (reviews.py)
+    reviewer_id = await get_review_queue(context).assign(TICKET, ticket_id, notice)
+    await get_storage(context).add_ticket(ticket_id, user_id, msg, outbox=[notice._replace(chat_id=reviewer_id or get_tenant(context).admin_id)])
+    get_event_bus(context).publish(TicketOpened(ticket_id, user_id, reviewer_id))
     await update.message.reply_text(f"✅ تیکت شما با شناسه `{ticket_id}` ثبت شد.\nپشتیبانی در اسرع وقت پاسخ می‌دهد.", parse_mode=ParseMode.MARKDOWN)
-    context.user_data.pop('awaiting_ticket_message', None)
+    get_user_state(update, context).pop('awaiting_ticket_message', None)
 
 async def cancel_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     if query.data == "cancel_ticket":
-        context.user_data.pop('awaiting_ticket_message', None)
+        get_user_state(update, context).pop('awaiting_ticket_message', None)
         await query.edit_message_text("❌ ساخت تیکت لغو شد.", parse_mode=ParseMode.MARKDOWN)
 
 async def handle_ticket_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    if update.effective_user.id != ADMIN_ID:
+    queue = get_review_queue(context)
+    if not queue.is_reviewer(update.effective_user.id):
         return
     ticket_id = query.data.split('_')[2]
-    if not get_ticket(ticket_id):
+    if not await get_storage(context).get_ticket(ticket_id):
         await query.edit_message_text("❌ تیکت یافت نشد.", parse_mode=ParseMode.MARKDOWN)
         return
-    context.user_data['replying_to_ticket'] = ticket_id
+    if not await queue.claim(TICKET, ticket_id, update.effective_user.id):
+        await query.edit_message_text("⚠️ این تیکت به مدیر دیگری سپرده شده است.", parse_mode=ParseMode.MARKDOWN)
+        return
+    get_user_state(update, context)['replying_to_ticket'] = ticket_id
     await query.edit_message_text(
         f"✍️ لطفاً پاسخ خود برای تیکت `{ticket_id}` را ارسال کنید:",
         reply_markup=InlineKeyboardMarkup([
@@ -596,24 +487,119 @@ async def handle_ticket_reply(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
 async def send_ticket_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ticket_id = context.user_data.get('replying_to_ticket')
-    if not ticket_id or not get_ticket(ticket_id):
+    ticket_id = get_user_state(update, context).get('replying_to_ticket')
+    storage = get_storage(context)
+    ticket = await storage.get_ticket(ticket_id) if ticket_id else None
+    if not ticket:
         return
     reply_msg = update.message.text
-    add_ticket_reply(ticket_id, True, reply_msg)
-    update_ticket_status(ticket_id, 'answered')
-    user_id = get_ticket(ticket_id)[1]
-    await context.bot.send_message(
-        chat_id=user_id,
+    get_user_state(update, context).pop('replying_to_ticket', None)
+    # پاسخ همراه تغییر وضعیت ثبت می‌شود تا رشته‌ی تیکت هیچ‌گاه بدون آن «پاسخ‌داده» دیده نشود
+    answered = await storage.update_ticket_status(ticket_id, 'answered', reviewer_id=update.effective_user.id, reply=(True, reply_msg), outbox=[outbox_message(
+        ticket.user_id,
         text=(
             f"*📨 پاسخ تیکت `{ticket_id}`:*\n\n"
             f"{reply_msg}\n\n"
             "برای ارسال تیکت جدید از دکمه `🎫 تیکت جدید` استفاده کنید."
         ),
         parse_mode=ParseMode.MARKDOWN
-    )
+    )])
+    if not answered:
+        await update.message.reply_text("⚠️ مهلت پاسخ شما به پایان رسیده و تیکت به مدیر دیگری سپرده شده است.")
+        return
+    # همین‌جا و نه از طریق EventBus: صف مشترک‌ها ممکن است پر شود و رویداد را دور بریزد
+    get_ticket_threads(context).invalidate(ticket_id)
+    get_event_bus(context).publish(TicketAnswered(ticket_id, ticket.user_id, update.effective_user.id))
     await update.message.reply_text("✅ پاسخ شما ارسال شد.", parse_mode=ParseMode.MARKDOWN)
-    context.user_data.pop('replying_to_ticket', None)
+
+def can_triage(update, context):
+    user_id = update.effective_user.id
+    return user_id == get_tenant(context).admin_id or get_review_queue(context).is_reviewer(user_id)
+
+async def render_inbox_page(context, name, before):
+    # یک ردیف بیشتر خوانده می‌شود تا وجود صفحه‌ی بعد بدون COUNT مشخص شود
+    tickets = await get_storage(context).get_tickets_page(INBOX_FILTERS[name], before, INBOX_PAGE_SIZE + 1)
+    has_next = len(tickets) > INBOX_PAGE_SIZE
+    tickets = tickets[:INBOX_PAGE_SIZE]
+    rows = []
+    for t in tickets:
+        preview = " ".join(t.message.split())[:30]
+        rows.append([InlineKeyboardButton(f"{'🟡' if t.status == 'pending' else '✅'} {t.created_at[5:16]} · {preview}",
+                                          callback_data=f"inbox_open_{name}_{t.ticket_id}_{before or ''}")])
+    rows.append([InlineKeyboardButton(("• " if key == name else "") + label, callback_data=f"inbox_page_{key}_")
+                 for key, label in INBOX_LABELS.items()])
+    navigation = []
+    if before:
+        navigation.append(InlineKeyboardButton("⏮ صفحه‌ی اول", callback_data=f"inbox_page_{name}_"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("صفحه‌ی بعد ⏭", callback_data=f"inbox_page_{name}_{tickets[-1].ticket_id}"))
+    if navigation:
+        rows.append(navigation)
+    text = f"📥 صندوق تیکت‌ها ({INBOX_LABELS[name]})"
+    if not tickets:
+        text += "\n\nتیکتی وجود ندارد."
+    return text, InlineKeyboardMarkup(rows)
+
+def render_ticket_thread(ticket, replies, limit=4000):
+    # متن کاربر بدون Markdown نمایش داده می‌شود؛ اگر رشته از سقف پیام بلندتر باشد پاسخ‌های قدیمی حذف می‌شوند
+    header = (f"🎫 تیکت {ticket.ticket_id}\n"
+              f"👤 کاربر: {ticket.user_id}\n"
+              f"📌 وضعیت: {'در انتظار پاسخ' if ticket.status == 'pending' else 'پاسخ داده شده'}\n\n"
+              f"🗨 {ticket.created_at}\n{ticket.message}")
+    lines = [f"\n\n{'🛠 پشتیبانی' if r.from_admin else '🗨 کاربر'} {r.time}\n{r.message}" for r in replies]
+    size = len(header)
+    shown = []
+    for line in reversed(lines):
+        if size + len(line) > limit:
+            break
+        shown.append(line)
+        size += len(line)
+    hidden = len(lines) - len(shown)
+    return header + (f"\n\n… {hidden} پاسخ قدیمی‌تر" if hidden else "") + "".join(reversed(shown))
+
+async def ticket_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not can_triage(update, context):
+        await update.message.reply_text("🚫 شما اجازه استفاده از این فرمان را ندارید.")
+        return
+    name = context.args[0] if context.args else 'open'
+    if name not in INBOX_FILTERS:
+        await update.message.reply_text(f"❌ فیلتر نامعتبر. فیلترها: {'، '.join(INBOX_FILTERS)}")
+        return
+    text, keyboard = await render_inbox_page(context, name, None)
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+async def handle_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if not can_triage(update, context):
+        return
+    parts = query.data.split('_')
+    if len(parts) < 4 or parts[2] not in INBOX_FILTERS:
+        return
+    action, name = parts[1], parts[2]
+    if action == 'open' and len(parts) == 5:
+        ticket_id, before = parts[3], parts[4]
+        # رفت‌وبرگشت بین فهرست و تیکت از حافظه خوانده می‌شود؛ ثبت پاسخ همان تیکت را باطل می‌کند
+        thread = await get_ticket_threads(context).get(ticket_id)
+        if thread is None:
+            await query.edit_message_text("❌ تیکت یافت نشد.")
+            return
+        ticket, replies = thread
+        rows = []
+        if ticket.status == 'pending':
+            rows.append([InlineKeyboardButton("📨 پاسخ به تیکت", callback_data=f"reply_ticket_{ticket_id}")])
+        rows.append([InlineKeyboardButton("🔙 بازگشت به فهرست", callback_data=f"inbox_page_{name}_{before}")])
+        text, keyboard = render_ticket_thread(ticket, replies), InlineKeyboardMarkup(rows)
+    elif action == 'page':
+        text, keyboard = await render_inbox_page(context, name, parts[3] or None)
+    else:
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest as e:
+        # ضربه‌ی دوباره روی همان صفحه
+        if "not modified" not in str(e):
+            raise
 
 async def cancel_ticket_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -622,7 +608,7 @@ async def cancel_ticket_reply(update: Update, context: ContextTypes.DEFAULT_TYPE
     if len(parts) != 4:
         return
     ticket_id = parts[3]
-    context.user_data.pop('replying_to_ticket', None)
+    get_user_state(update, context).pop('replying_to_ticket', None)
     await query.edit_message_text(f"❌ پاسخ به تیکت `{ticket_id}` لغو شد.", parse_mode=ParseMode.MARKDOWN)
 
 # -------------------------------
@@ -634,19 +620,15 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     if data.startswith("confirm_invoice_"):
         transaction_id = data.split("_", 2)[-1]
-        conn = sqlite3.connect('bot.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT amount, package_name, phone_number FROM transactions WHERE transaction_id = ?', (transaction_id,))
-        trans = cursor.fetchone()
-        conn.close()
+        trans = await get_storage(context).get_transaction(transaction_id)
         if not trans:
             await query.edit_message_text("❌ سفارش شما یافت نشد.", parse_mode=ParseMode.MARKDOWN)
             return
-        amount, package_name, phone_number = trans
+        amount = trans.amount
         payment_msg = (
             f"*💳 اطلاعات نهایی پرداخت:*\n\n"
             f"💰 مبلغ: `{amount:,} تومان`\n"
-            f"💳 شماره کارت: `{BANK_CARD}`\n"
+            f"💳 شماره کارت: `{get_tenant(context).bank_card}`\n"
             f"🔢 شناسه تراکنش: `{transaction_id}`\n\n"
             "لطفاً پس از واریز وجه، رسید پرداخت را ارسال کنید."
         )
@@ -665,15 +647,22 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith(('approve_', 'reject_')):
         await handle_admin_action(update, context)
         return
-    if data.startswith(('charge_', 'net_')):
-        parts = data.split('_')
-        service_type = parts[0]
-        amount = int(parts[1])
-        package_name = '_'.join(parts[2:])
+    if data.startswith(TOKEN_PREFIX):
+        # مبلغ از فهرست سرور خوانده می‌شود، نه از داده‌ی دکمه
+        catalog = get_catalog(context)
+        package = catalog.resolve(data)
+        if package is None:
+            await query.edit_message_text("⚠️ فهرست بسته‌ها به‌روزرسانی شده است. لطفاً دوباره از منو انتخاب کنید.", parse_mode=ParseMode.MARKDOWN)
+            return
         user_id = update.effective_user.id
-        transaction_id = f"TX{int(datetime.now().timestamp())}"
-        add_transaction(transaction_id, user_id, amount, package_name)
-        context.user_data['current_transaction'] = transaction_id
+        storage = get_storage(context)
+        # مبلغ نهایی (با تخفیف) هنگام ایجاد روی تراکنش ثابت می‌شود و تغییرات بعدی قیمت روی آن اثری ندارد
+        amount = catalog.quote(package, await get_user_tier(storage, catalog, user_id)).amount
+        package_name = package.package_name
+        transaction_id = generate_id("TX")
+        await storage.add_transaction(transaction_id, user_id, amount, package_name)
+        get_event_bus(context).publish(TransactionCreated(transaction_id, user_id, amount, package_name))
+        get_user_state(update, context)['current_transaction'] = transaction_id
         msg = (
             f"🔰 *اطلاعات سفارش:*\n\n"
             f"📦 سرویس: {package_name}\n"
@@ -681,28 +670,41 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "لطفاً شماره تماس مقصد (مثال: 93791234567) را وارد نمایید."
         )
         await query.edit_message_text(msg, parse_mode=ParseMode.MARKDOWN)
-        context.user_data['expecting_phone'] = True
+        get_user_state(update, context)['expecting_phone'] = True
         return
     await query.edit_message_text("❌ عملیات نامعتبر. لطفاً مجدداً تلاش کنید.", parse_mode=ParseMode.MARKDOWN)
 
+async def show_review_conflict(query, storage, transaction_id):
+    # Compare-and-set از pending_review انجام نشد: یا سفارش قبلاً بررسی شده (Callback تکراری یا مدیر دیگر)
+    # یا Lease این مدیر تمام شده و مورد به مدیر دیگری رسیده است؛ وضعیت فعلی از دیتابیس خوانده می‌شود
+    trans = await storage.get_transaction(transaction_id)
+    note = REVIEWED_LABELS.get(trans.status if trans else None, "⚠️ به مدیر دیگری سپرده شده است")
+    await query.edit_message_caption(query.message.caption + f"\n\n{note}", reply_markup=None)
+
 async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    if update.effective_user.id != ADMIN_ID:
+    reviewer_id = update.effective_user.id
+    queue = get_review_queue(context)
+    if not queue.is_reviewer(reviewer_id):
+        await query.answer()
         return
     action, transaction_id = query.data.split('_', 1)
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, amount, phone_number, package_name FROM transactions WHERE transaction_id = ?', (transaction_id,))
-    trans = cursor.fetchone()
-    conn.close()
+    storage = get_storage(context)
+    trans = await storage.get_transaction(transaction_id)
+    if trans and trans.status != 'pending_review':
+        # ضربه‌ی دوباره روی دکمه: انتقال قبلاً انجام شده و بدون نوشتن در دیتابیس فقط پاسخ داده می‌شود
+        await query.answer("ℹ️ این سفارش قبلاً بررسی شده است.")
+        return
+    await query.answer()
     if not trans:
         await query.edit_message_caption("❌ این تراکنش دیگر معتبر نیست.", reply_markup=None)
         return
-    user_id, amount, phone_number, package_name = trans
+    # Claim در دیتابیس؛ رسیدی که به مدیر دیگری سپرده شده یا بررسی شده پردازش نمی‌شود
+    if not await queue.claim(TRANSACTION, transaction_id, reviewer_id):
+        await query.edit_message_caption(query.message.caption + "\n\n⚠️ به مدیر دیگری سپرده شده است", reply_markup=None)
+        return
+    user_id, amount, phone_number, package_name = trans.user_id, trans.amount, trans.phone_number, trans.package_name
     if action == 'approve':
-        update_transaction_status(transaction_id, 'completed', 'completed_at')
-        update_user_transaction(user_id, amount)
         success_msg = (
             f"✅ *سفارش شما با موفقیت انجام شد!*\n\n"
             f"🔢 شناسه: `{transaction_id}`\n"
@@ -711,39 +713,48 @@ async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"📦 سرویس: {package_name}\n\n"
             "🙏 از خرید شما سپاسگزاریم."
         )
-        await context.bot.send_message(chat_id=user_id, text=success_msg, parse_mode=ParseMode.MARKDOWN)
+        # Compare-and-set از pending_review؛ آمار کاربر در همان تراکنش دیتابیس و فقط یک بار اضافه می‌شود
+        if not await storage.update_transaction_status(transaction_id, 'completed', 'completed_at', reviewer_id=reviewer_id, outbox=[
+                outbox_message(user_id, text=success_msg, parse_mode=ParseMode.MARKDOWN)],
+                expected='pending_review', credit_user=True):
+            await show_review_conflict(query, storage, transaction_id)
+            return
+        get_event_bus(context).publish(TransactionApproved(transaction_id, user_id, amount, reviewer_id))
         await query.edit_message_caption(query.message.caption + "\n\n✅ تایید شد", reply_markup=None)
     elif action == 'reject':
-        update_transaction_status(transaction_id, 'rejected', 'rejected_at')
         reject_msg = (
             f"❌ *سفارش شما تایید نشد!*\n\n"
             f"🔢 شناسه: `{transaction_id}`\n"
             f"💰 مبلغ: `{amount:,} تومان`\n\n"
             "⚠️ جهت پیگیری با پشتیبانی تماس بگیرید."
         )
-        await context.bot.send_message(chat_id=user_id, text=reject_msg, parse_mode=ParseMode.MARKDOWN)
+        if not await storage.update_transaction_status(transaction_id, 'rejected', 'rejected_at', reviewer_id=reviewer_id, outbox=[
+                outbox_message(user_id, text=reject_msg, parse_mode=ParseMode.MARKDOWN)], expected='pending_review'):
+            await show_review_conflict(query, storage, transaction_id)
+            return
+        get_event_bus(context).publish(TransactionRejected(transaction_id, user_id, amount, reviewer_id))
         await query.edit_message_caption(query.message.caption + "\n\n❌ رد شد", reply_markup=None)
-    save_data()
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
     user_id = update.effective_user.id
+    admin_id = get_tenant(context).admin_id
     text = update.message.text.strip() if update.message.text else ""
 
-    if user_id == ADMIN_ID and context.user_data.get("changing_conversion_rate"):
+    if user_id == admin_id and get_user_state(update, context).get("changing_conversion_rate"):
         new_rate_str = convert_to_english_digits(text)
         try:
             new_rate = int(new_rate_str)
-            global CONVERSION_RATE
-            CONVERSION_RATE = new_rate
-            context.user_data.pop("changing_conversion_rate")
+            await get_storage(context).set_setting('conversion_rate', new_rate)
+            await refresh_catalog(context.bot_data)
+            get_user_state(update, context).pop("changing_conversion_rate")
             await update.message.reply_text(f"✅ نرخ تبدیل به *{new_rate} تومان* تغییر یافت.", parse_mode=ParseMode.MARKDOWN)
         except ValueError:
             await update.message.reply_text("❌ نرخ تبدیل باید یک عدد صحیح باشد.")
         return
 
-    if user_id == ADMIN_ID and context.user_data.get("admin_add_package"):
+    if user_id == admin_id and get_user_state(update, context).get("admin_add_package"):
         if "/" in text:
             parts = [p.strip() for p in text.split("/") if p.strip()]
             if len(parts) != 3:
@@ -760,18 +771,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             description = " ".join(args[2:])
         try:
             amount = int(amount_str)
-            add_price(package_name, amount, description)
+            await get_storage(context).add_price(package_name, amount, description)
+            await refresh_catalog(context.bot_data)
             await update.message.reply_text(f"✅ بسته *{package_name}* افزوده شد.", parse_mode=ParseMode.MARKDOWN)
-            context.user_data.pop("admin_add_package")
+            get_user_state(update, context).pop("admin_add_package")
         except ValueError:
             await update.message.reply_text("❌ مبلغ باید عدد صحیح باشد.")
         return
 
-    if user_id == ADMIN_ID and context.user_data.get("admin_delete_package"):
+    if user_id == admin_id and get_user_state(update, context).get("admin_delete_package"):
         package_name = text
-        delete_price(package_name)
+        await get_storage(context).delete_price(package_name)
+        await refresh_catalog(context.bot_data)
         await update.message.reply_text(f"✅ بسته *{package_name}* حذف شد.", parse_mode=ParseMode.MARKDOWN)
-        context.user_data.pop("admin_delete_package")
+        get_user_state(update, context).pop("admin_delete_package")
         return
 
     if text.startswith('/feedback'):
@@ -787,39 +800,35 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ امتیاز باید عددی بین 1 تا 5 باشد.")
             return
         fb_msg = parts[2]
-        add_feedback(user_id, rating, fb_msg)
+        await get_storage(context).add_feedback(user_id, rating, fb_msg)
         await update.message.reply_text("✅ بازخورد شما ثبت شد. متشکریم!")
         return
 
-    if update.message.photo and context.user_data.get('expecting_payment'):
+    if update.message.photo and get_user_state(update, context).get('expecting_payment'):
         await handle_payment_proof(update, context)
         return
 
-    if context.user_data.get('replying_to_ticket'):
+    if get_user_state(update, context).get('replying_to_ticket'):
         await send_ticket_reply(update, context)
         return
 
     if text.startswith('/'):
-        command = text.split('@')[0].lower()
+        command = text.split()[0].split('@')[0].lower()
         if command == '/start':
             await start(update, context)
         elif command == '/history':
             await transaction_history(update, context)
-        elif command == '/stats' and user_id == ADMIN_ID:
+        elif command == '/stats' and user_id == admin_id:
             await detailed_stats(update, context)
-        elif command == '/export' and user_id == ADMIN_ID:
+        elif command == '/export' and user_id == admin_id:
             await export_transactions(update, context)
-        elif command == '/search_transaction' and user_id == ADMIN_ID:
+        elif command == '/search_transaction' and user_id == admin_id:
             parts = text.split()
             if len(parts) < 2:
                 await update.message.reply_text("❌ لطفاً شناسه تراکنش را وارد کنید.")
                 return
             trans_id = parts[1]
-            conn = sqlite3.connect('bot.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM transactions WHERE transaction_id = ?', (trans_id,))
-            trans = cursor.fetchone()
-            conn.close()
+            trans = await get_storage(context).get_transaction(trans_id)
             if trans:
                 search_msg = (
                     f"*نتیجه جستجوی تراکنش:*\n\n"
@@ -834,17 +843,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(search_msg, parse_mode=ParseMode.MARKDOWN)
             else:
                 await update.message.reply_text("❌ تراکنشی با این شناسه یافت نشد.")
-        elif command == '/search_ticket' and user_id == ADMIN_ID:
+        elif command == '/search_ticket' and user_id == admin_id:
             parts = text.split()
             if len(parts) < 2:
                 await update.message.reply_text("❌ لطفاً شناسه تیکت را وارد کنید.")
                 return
             ticket_id = parts[1]
-            conn = sqlite3.connect('bot.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM tickets WHERE ticket_id = ?', (ticket_id,))
-            ticket = cursor.fetchone()
-            conn.close()
+            ticket = await get_storage(context).get_ticket(ticket_id)
             if ticket:
                 search_msg = (
                     f"*نتیجه جستجوی تیکت:*\n\n"
@@ -857,51 +862,24 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(search_msg, parse_mode=ParseMode.MARKDOWN)
             else:
                 await update.message.reply_text("❌ تیکتی با این شناسه یافت نشد.")
-        elif command == '/broadcast' and user_id == ADMIN_ID:
-            if not context.args:
-                await update.message.reply_text("❌ لطفاً متن پیام تبلیغاتی را وارد کنید.\nفرمت: /broadcast <پیام>")
-                return
-            b_msg = " ".join(context.args)
-            conn = sqlite3.connect('bot.db')
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM users")
-            users = cursor.fetchall()
-            conn.close()
-            count = 0
-            for u in users:
-                try:
-                    await context.bot.send_message(chat_id=u[0], text=b_msg)
-                    count += 1
-                except Exception as e:
-                    logger.error(f"Broadcast error for user {u[0]}: {e}")
-            await update.message.reply_text(f"✅ پیام تبلیغاتی به {count} کاربر ارسال شد.", parse_mode=ParseMode.MARKDOWN)
-        elif command == '/post' and user_id == ADMIN_ID:
-            if not context.args:
-                await update.message.reply_text("❌ لطفاً متن پست را وارد کنید.\nفرمت: /post <متن پست>")
-                return
-            post_text = " ".join(context.args)
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("بازدید از سایت", url="https://example.com")]
-            ])
-            try:
-                await context.bot.send_message(chat_id=CHANNEL_ID, text=post_text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
-                await update.message.reply_text("✅ پست به کانال ارسال شد.", parse_mode=ParseMode.MARKDOWN)
-            except Exception as e:
-                await update.message.reply_text(f"❌ خطا در ارسال پست به کانال: {e}")
-        return
-
-    if user_id == ADMIN_ID and text == "تغییر نرخ تبدیل":
-        context.user_data["changing_conversion_rate"] = True
+        elif command in ('/broadcast', '/post') and user_id == admin_id:
+            # همان Handlerهای فرمان (با --segment)؛ MessageHandler خودش context.args را پر نمی‌کند
+            context.args = text.split()[1:]
+            await (broadcast if command == '/broadcast' else post_to_channel)(update, context)
+        return
+
+    if user_id == admin_id and text == "تغییر نرخ تبدیل":
+        get_user_state(update, context)["changing_conversion_rate"] = True
         await update.message.reply_text("📝 لطفاً نرخ تبدیل جدید (به عدد صحیح) را وارد کنید (مثلاً 1300):")
         return
 
-    if user_id == ADMIN_ID and text == "➕ افزودن بسته":
-        context.user_data["admin_add_package"] = True
+    if user_id == admin_id and text == "➕ افزودن بسته":
+        get_user_state(update, context)["admin_add_package"] = True
         await update.message.reply_text("📝 لطفاً بسته را به صورت: *نام بسته / مبلغ / توضیحات* وارد کنید.", parse_mode=ParseMode.MARKDOWN)
         return
 
-    if user_id == ADMIN_ID and text == "➖ حذف بسته":
-        context.user_data["admin_delete_package"] = True
+    if user_id == admin_id and text == "➖ حذف بسته":
+        get_user_state(update, context)["admin_delete_package"] = True
         await update.message.reply_text("📝 لطفاً نام بسته مورد نظر را ارسال کنید:")
         return
 
@@ -922,7 +900,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         '📢 پست کانال': lambda u, c: u.message.reply_text("برای ارسال پست به کانال از فرمان /post استفاده کنید.", parse_mode=ParseMode.MARKDOWN)
     }
     if text in menu_handlers:
-        if text in ['📊 آمار', '💾 بکاپ گیری', '📋 گزارش‌ها', '🔍 جستجو', '📣 پیام تبلیغاتی', '📢 پست کانال'] and user_id != ADMIN_ID:
+        if text in ['📊 آمار', '💾 بکاپ گیری', '📋 گزارش‌ها', '🔍 جستجو', '📣 پیام تبلیغاتی', '📢 پست کانال'] and user_id != admin_id:
             await update.message.reply_text("🚫 شما دسترسی به این بخش را ندارید.")
             return
         await menu_handlers[text](update, context)
@@ -935,31 +913,24 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_phone_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
     phone = update.message.text.strip()
-    transaction_id = context.user_data.get('current_transaction')
+    transaction_id = get_user_state(update, context).get('current_transaction')
     if not transaction_id:
         await update.message.reply_text("❌ سفارش شما منقضی شده است. لطفاً دوباره تلاش کنید.")
         return
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT status FROM transactions WHERE transaction_id = ?', (transaction_id,))
-    trans = cursor.fetchone()
-    conn.close()
-    if not trans or trans[0] != 'pending':
+    storage = get_storage(context)
+    trans = await storage.get_transaction(transaction_id)
+    if not trans or trans.status != 'pending':
         await update.message.reply_text("❌ سفارش شما منقضی شده است. لطفاً دوباره اقدام کنید.")
         return
     if not (phone.startswith('93') and len(phone) == 11 and phone.isdigit()):
         await update.message.reply_text("❌ شماره تماس صحیح نیست!\nمثال: 93791234567")
         return
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE transactions SET phone_number = ? WHERE transaction_id = ?', (phone, transaction_id))
-    conn.commit()
-    conn.close()
-    amount = get_transaction_amount(transaction_id)
+    await storage.set_transaction_phone(transaction_id, phone)
+    amount = trans.amount
     preview_text = (
         "*🧾 پیش‌فاکتور سفارش:*\n\n"
         f"📞 شماره تماس مقصد: `{phone}`\n"
-        f"💳 شماره کارت: `{BANK_CARD}`\n"
+        f"💳 شماره کارت: `{get_tenant(context).bank_card}`\n"
         f"🔢 شناسه تراکنش: `{transaction_id}`\n"
         f"💰 مبلغ: `{amount:,} تومان`\n\n"
         "آیا مایل به ادامه پرداخت هستید؟"
@@ -968,31 +939,20 @@ async def handle_phone_number(update: Update, context: ContextTypes.DEFAULT_TYPE
         [InlineKeyboardButton("✅ تایید پرداخت", callback_data=f"confirm_invoice_{transaction_id}"),
          InlineKeyboardButton("❌ لغو", callback_data=f"cancel_invoice_{transaction_id}")]
     ])
-    context.user_data.pop('expecting_phone', None)
+    get_user_state(update, context).pop('expecting_phone', None)
     await update.message.reply_text(preview_text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
 
-def get_transaction_amount(transaction_id):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT amount FROM transactions WHERE transaction_id = ?', (transaction_id,))
-    amount = cursor.fetchone()
-    conn.close()
-    return amount[0] if amount else 0
-
 async def handle_payment_proof(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.photo:
         await update.message.reply_text("❌ لطفاً تصویر رسید پرداخت را ارسال کنید.")
         return
-    transaction_id = context.user_data.get('current_transaction')
+    transaction_id = get_user_state(update, context).get('current_transaction')
     if not transaction_id:
         await update.message.reply_text("❌ سفارش شما منقضی شده است. لطفاً دوباره تلاش کنید.")
         return
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT status, phone_number, user_id, amount, package_name, created_at FROM transactions WHERE transaction_id = ?', (transaction_id,))
-    trans = cursor.fetchone()
-    if not trans or trans[0] != 'pending':
-        conn.close()
+    storage = get_storage(context)
+    trans = await storage.get_transaction(transaction_id)
+    if not trans or trans.status != 'pending':
         await update.message.reply_text("❌ سفارش شما منقضی شده است. لطفاً دوباره اقدام کنید.")
         return
     photo = update.message.photo[-1]
@@ -1000,162 +960,207 @@ async def handle_payment_proof(update: Update, context: ContextTypes.DEFAULT_TYP
     if not is_valid:
         await update.message.reply_text(error_msg)
         return
-    cursor.execute('UPDATE transactions SET status = "pending_review", payment_time = ? WHERE transaction_id = ?',
-                   (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), transaction_id))
-    conn.commit()
-    conn.close()
+    if not await storage.submit_payment(transaction_id):
+        await update.message.reply_text("❌ سفارش شما منقضی شده است. لطفاً دوباره اقدام کنید.")
+        return
+    # همان فایل قبلاً برای سفارش دیگری ارسال شده؟ (جستجوی اندیس‌شده)
+    duplicate_of = await storage.find_duplicate_receipt(transaction_id, file_unique_id=photo.file_unique_id)
+    await storage.add_receipt(transaction_id, photo.file_unique_id)
     admin_msg = (
         f"*💫 سفارش جدید:*\n\n"
         f"🔢 شناسه: {transaction_id}\n"
         f"👤 کاربر: {update.effective_user.username or update.effective_user.id}\n"
-        f"📞 شماره تماس: {trans[1]}\n"
-        f"💰 مبلغ: {trans[3]:,} تومان\n"
-        f"📦 سرویس: {trans[4]}\n"
+        f"📞 شماره تماس: {trans.phone_number}\n"
+        f"💰 مبلغ: {trans.amount:,} تومان\n"
+        f"📦 سرویس: {trans.package_name}\n"
         f"⏰ زمان: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     )
+    if duplicate_of:
+        admin_msg += duplicate_flag(duplicate_of)
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ تایید", callback_data=f"approve_{transaction_id}"),
          InlineKeyboardButton("❌ رد", callback_data=f"reject_{transaction_id}")]
     ])
-    await context.bot.send_photo(chat_id=ADMIN_ID, photo=photo.file_id, caption=admin_msg, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    # رسید به یکی از مدیران سپرده می‌شود؛ پیام برای واگذاری مجدد پس از انقضای Lease هم ذخیره می‌شود
+    notice = outbox_message(None, 'send_photo', photo=photo.file_id, caption=admin_msg, reply_markup=keyboard,
+                            parse_mode=ParseMode.MARKDOWN)
+    reviewer_id = await get_review_queue(context).assign(TRANSACTION, transaction_id, notice) or get_tenant(context).admin_id
+    review = await context.bot.send_photo(chat_id=reviewer_id, photo=photo.file_id, caption=admin_msg, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    # دانلود و مقایسه‌ی محتوای رسید در پس‌زمینه؛ در صورت تکراری بودن هشدار در پاسخ به پیام مدیر فرستاده می‌شود
+    pipeline = context.bot_data.get('receipt_pipeline')
+    if pipeline:
+        pipeline.submit(transaction_id, photo.file_id, (reviewer_id, review.message_id, bool(duplicate_of)))
+    get_event_bus(context).publish(ReceiptSubmitted(transaction_id, trans.user_id, reviewer_id, duplicate_of))
     await update.message.reply_text("✅ رسید پرداخت شما ثبت شد.\n⏳ در حال بررسی توسط پشتیبانی...")
-    context.user_data.pop('current_transaction', None)
-    context.user_data.pop('expecting_payment', None)
+    get_user_state(update, context).pop('current_transaction', None)
+    get_user_state(update, context).pop('expecting_payment', None)
 
 # -------------------------------
 # وظایف زمان‌بندی شده (Job Queue)
 # -------------------------------
 async def payment_expiry_job(context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT transaction_id, created_at, status, user_id FROM transactions WHERE status = "pending"')
-    pending = cursor.fetchall()
-    conn.close()
+    storage = get_storage(context)
+    pending = await storage.get_pending_orders()
     now = datetime.now()
     for trans in pending:
-        transaction_id, created_at, status, user_id = trans
+        transaction_id, user_id, created_at = trans
         created_time = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
         if (now - created_time).total_seconds() > TRANSACTION_EXPIRE_TIME:
-            expire_transaction(transaction_id)
-            await context.bot.send_message(chat_id=user_id, text=(
+            # اگر در همین فاصله رسید ارسال شده باشد وضعیت دیگر pending نیست و منقضی نمی‌شود
+            if await storage.expire_transaction(transaction_id, outbox=[outbox_message(user_id, text=(
                 f"⏰ *توجه:* سفارش با شناسه `{transaction_id}` به دلیل عدم پرداخت در 15 دقیقه منقضی شده است.\n"
                 "در صورت تمایل، لطفاً مجدداً اقدام نمایید."
-            ), parse_mode=ParseMode.MARKDOWN)
+            ), parse_mode=ParseMode.MARKDOWN)]):
+                get_event_bus(context).publish(TransactionExpired(transaction_id, user_id))
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    before = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    moved = await get_storage(context).archive_transactions(before, ARCHIVE_BATCH_SIZE)
+    if moved:
+        logger.info("Archived %s transactions created before %s", moved, before)
+
+async def change_log_job(context: ContextTypes.DEFAULT_TYPE):
+    before = (datetime.now() - timedelta(days=CHANGE_LOG_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    removed = await get_storage(context).compact_changes(before)
+    if removed:
+        logger.info("Compacted %s change log entries older than %s", removed, before)
+
+async def segments_job(context: ContextTypes.DEFAULT_TYPE):
+    await get_storage(context).refresh_segments(context.bot_data['segments'])
+
+async def user_state_job(context: ContextTypes.DEFAULT_TYPE):
+    removed = context.bot_data['user_state'].sweep()
+    if removed:
+        logger.debug("Dropped %s idle user states", removed)
+
+async def review_lease_job(context: ContextTypes.DEFAULT_TYPE):
+    reassigned = await get_review_queue(context).release_expired()
+    if reassigned:
+        logger.info("Reassigned %s unanswered review items", reassigned)
 
 async def payment_reminder(context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT transaction_id, user_id, created_at, status FROM transactions WHERE status = "pending"')
-    pending = cursor.fetchall()
-    conn.close()
+    storage = get_storage(context)
+    pending = await storage.get_pending_orders()
     now = datetime.now()
+    reminders = []
     for trans in pending:
-        transaction_id, user_id, created_at, status = trans
+        transaction_id, user_id, created_at = trans
         created_time = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
         if (now - created_time).total_seconds() > 43200:
             continue
-        await context.bot.send_message(chat_id=user_id, text=(
+        reminders.append(outbox_message(user_id, text=(
             f"*⏰ یادآوری پرداخت:*\n\n"
             f"سفارش با شناسه `{transaction_id}` هنوز در انتظار پرداخت است.\n"
             "لطفاً در صورت پرداخت، رسید خود را ارسال نمایید."
-        ), parse_mode=ParseMode.MARKDOWN)
+        ), parse_mode=ParseMode.MARKDOWN))
+    if reminders:
+        await storage.enqueue_messages(reminders)
 
 async def admin_notifications(context: ContextTypes.DEFAULT_TYPE):
-    pending_trans = get_pending_transactions()
-    pending_tickets = get_pending_tickets()
+    storage = get_storage(context)
+    pending_trans = await storage.get_pending_transactions()
+    pending_tickets = await storage.get_pending_tickets()
     if pending_trans > 0 or pending_tickets > 0:
         note = "*🔔 یادآوری مدیر:*\n\n"
         if pending_trans > 0:
             note += f"• {pending_trans} تراکنش در انتظار بررسی\n"
         if pending_tickets > 0:
             note += f"• {pending_tickets} تیکت در انتظار پاسخ"
-        await context.bot.send_message(chat_id=ADMIN_ID, text=note, parse_mode=ParseMode.MARKDOWN)
-
-def get_pending_transactions():
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM transactions WHERE status = 'pending_review'")
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
-
-def get_pending_tickets():
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM tickets WHERE status = 'pending'")
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+        await storage.enqueue_messages([admin_notification(context.bot_data, note)])
+    # هر مدیر فقط موارد سپرده‌شده به خودش را یادآوری می‌گیرد
+    reminders = [outbox_message(reviewer_id, text=f"*🔔 یادآوری:* {count} مورد در انتظار بررسی شما", parse_mode=ParseMode.MARKDOWN)
+                 for reviewer_id, count in (await storage.get_review_load()).items()
+                 if count and reviewer_id != get_tenant(context).admin_id]
+    if reminders:
+        await storage.enqueue_messages(reminders)
 
 async def detailed_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        return
-    today = datetime.now().strftime("%Y-%m-%d")
-    week_start = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*), SUM(amount) FROM transactions WHERE created_at LIKE ?', (f"{today}%",))
-    today_trans, today_amount = cursor.fetchone()
-    cursor.execute('SELECT COUNT(*), SUM(amount) FROM transactions WHERE created_at >= ?', (week_start,))
-    week_trans, week_amount = cursor.fetchone()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(DISTINCT user_id) FROM transactions WHERE created_at LIKE ?', (f"{today}%",))
-    active_users_today = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM transactions WHERE status = "completed"')
-    completed_trans = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM transactions WHERE status = "pending_review"')
-    pending_review_trans = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM transactions WHERE status = "rejected"')
-    rejected_trans = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM tickets')
-    total_tickets = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM tickets WHERE status = "pending"')
-    pending_tickets = cursor.fetchone()[0]
-    conn.close()
+    if update.effective_user.id != get_tenant(context).admin_id:
+        return
+    stats = await get_storage(context).get_detailed_stats()
     stats_text = (
         f"*📊 گزارش تفصیلی:*\n\n"
-        f"*امروز:*\n• تراکنش: {today_trans}\n• مبلغ: {today_amount or 0:,} تومان\n\n"
-        f"*هفته:*\n• تراکنش: {week_trans}\n• مبلغ: {week_amount or 0:,} تومان\n\n"
-        f"*کاربران:*\n• کل: {total_users}\n• فعال امروز: {active_users_today}\n\n"
-        f"*تراکنش‌ها:*\n• موفق: {completed_trans}\n• در انتظار: {pending_review_trans}\n• ناموفق: {rejected_trans}\n\n"
-        f"*تیکت‌ها:*\n• کل: {total_tickets}\n• در انتظار پاسخ: {pending_tickets}\n\n"
-        f"🕒 بروزرسانی: {datetime.now().strftime('%H:%M:%S')}"
+        f"*امروز:*\n• تراکنش: {stats['today_trans']}\n• مبلغ: {stats['today_amount'] or 0:,} تومان\n\n"
+        f"*هفته:*\n• تراکنش: {stats['week_trans']}\n• مبلغ: {stats['week_amount'] or 0:,} تومان\n\n"
+        f"*کاربران:*\n• کل: {stats['total_users']}\n• فعال امروز: {stats['active_users_today']}\n\n"
+        f"*تراکنش‌ها:*\n• موفق: {stats['completed_trans']}\n• در انتظار: {stats['pending_review_trans']}\n• ناموفق: {stats['rejected_trans']}\n\n"
+        f"*تیکت‌ها:*\n• کل: {stats['total_tickets']}\n• در انتظار پاسخ: {stats['pending_tickets']}\n\n"
+        f"🕒 بروزرسانی: {stats['as_of'][11:]}"
     )
     await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
 
 async def export_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
+    if update.effective_user.id != get_tenant(context).admin_id:
         return
     filename = f"transactions_{datetime.now().strftime('%Y%m%d')}.csv"
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT created_at, transaction_id, user_id, amount, status, phone_number, package_name FROM transactions')
-    transactions = cursor.fetchall()
-    conn.close()
-    with open(filename, 'w', encoding='utf-8-sig', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(["تاریخ", "شناسه", "کاربر", "مبلغ", "وضعیت", "شماره تماس", "سرویس"])
-        for trans in transactions:
-            writer.writerow(trans)
-    await context.bot.send_document(chat_id=ADMIN_ID, document=open(filename, 'rb'), caption="*📊 گزارش تراکنش‌ها*", parse_mode=ParseMode.MARKDOWN)
-    os.remove(filename)
+    transactions = await get_storage(context).export_transactions()
+
+    def write_csv():
+        with open(filename, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["تاریخ", "شناسه", "کاربر", "مبلغ", "وضعیت", "شماره تماس", "سرویس"])
+            writer.writerows(transactions)
+    try:
+        # نوشتن فایل در Thread جدا تا حلقه‌ی رویداد پشت دیسک نماند
+        await asyncio.get_running_loop().run_in_executor(None, write_csv)
+        with open(filename, 'rb') as f:
+            await context.bot.send_document(chat_id=get_tenant(context).admin_id, document=f, caption="*📊 گزارش تراکنش‌ها*", parse_mode=ParseMode.MARKDOWN)
+    finally:
+        os.remove(filename)
+
+async def export_changes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # خروجی افزایشی: فقط تغییرات پس از cursor؛ بدون آرگومان از cursor ذخیره‌شده‌ی خروجی قبلی ادامه می‌دهد
+    if update.effective_user.id != get_tenant(context).admin_id:
+        return
+    storage = get_storage(context)
+    if context.args:
+        try:
+            after = int(convert_to_english_digits(context.args[0]))
+        except ValueError:
+            await update.message.reply_text("❌ فرمت: /changes <cursor>")
+            return
+    else:
+        after = int((await storage.get_settings()).get('changes_cursor', 0))
+    filename = f"changes_{after}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+    cursor, count = after, 0
+    loop = asyncio.get_running_loop()
+    try:
+        with open(filename, 'w', encoding='utf-8') as f:
+            async for changes, cursor in storage.iter_changes(after, CHANGES_BATCH_SIZE):
+                lines = "".join(json.dumps({
+                    "seq": change.seq,
+                    "table": change.table_name,
+                    "key": change.row_key,
+                    "row": change.row._asdict() if change.row else None,
+                }, ensure_ascii=False) + "\n" for change in changes)
+                # نوشتن هر دسته در Thread جدا تا حلقه‌ی رویداد پشت دیسک نماند
+                await loop.run_in_executor(None, f.write, lines)
+                count += len(changes)
+        if count:
+            with open(filename, 'rb') as f:
+                await context.bot.send_document(chat_id=get_tenant(context).admin_id, document=f,
+                                                caption=f"*🔄 تغییرات:* {count} ردیف\ncursor بعدی: `{cursor}`", parse_mode=ParseMode.MARKDOWN)
+        else:
+            await update.message.reply_text(f"✅ تغییری پس از cursor `{after}` ثبت نشده است.", parse_mode=ParseMode.MARKDOWN)
+    finally:
+        os.remove(filename)
+    if not context.args:
+        await storage.set_setting('changes_cursor', cursor)
 
 async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
+    if update.effective_user.id != get_tenant(context).admin_id:
         return
     filename = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-    conn = sqlite3.connect('bot.db')
-    with open(filename, 'wb') as f:
-        for chunk in conn.iterdump():
-            f.write(f"{chunk}\n".encode())
-    conn.close()
-    await context.bot.send_document(chat_id=ADMIN_ID, document=open(filename, 'rb'), caption="*💾 بکاپ دیتابیس*", parse_mode=ParseMode.MARKDOWN)
-    os.remove(filename)
+    await get_storage(context).backup(filename)
+    try:
+        with open(filename, 'rb') as f:
+            await context.bot.send_document(chat_id=get_tenant(context).admin_id, document=f, caption="*💾 بکاپ دیتابیس*", parse_mode=ParseMode.MARKDOWN)
+    finally:
+        os.remove(filename)
     await update.message.reply_text("✅ بکاپ گیری با موفقیت انجام شد.", parse_mode=ParseMode.MARKDOWN)
 
 async def add_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
+    if update.effective_user.id != get_tenant(context).admin_id:
         await update.message.reply_text("🚫 شما اجازه دسترسی به این بخش را ندارید.")
         return
     args = context.args
@@ -1170,11 +1175,12 @@ async def add_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ مقدار مبلغ باید عدد صحیح باشد.")
         return
     description = " ".join(args[2:])
-    add_price(package_name, amount, description)
+    await get_storage(context).add_price(package_name, amount, description)
+    await refresh_catalog(context.bot_data)
     await update.message.reply_text(f"✅ بسته *{package_name}* افزوده شد.", parse_mode=ParseMode.MARKDOWN)
 
 async def delete_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
+    if update.effective_user.id != get_tenant(context).admin_id:
         await update.message.reply_text("🚫 شما اجازه دسترسی به این بخش را ندارید.")
         return
     args = context.args
@@ -1182,11 +1188,12 @@ async def delete_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ لطفاً نام بسته را وارد کنید.\nفرمت: /deletepackage <نام بسته>")
         return
     package_name = args[0]
-    delete_price(package_name)
+    await get_storage(context).delete_price(package_name)
+    await refresh_catalog(context.bot_data)
     await update.message.reply_text(f"✅ بسته *{package_name}* حذف شد.", parse_mode=ParseMode.MARKDOWN)
 
 async def change_conversion_rate(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
+    if update.effective_user.id != get_tenant(context).admin_id:
         await update.message.reply_text("🚫 شما اجازه دسترسی به این بخش را ندارید.")
         return
     args = context.args
@@ -1196,12 +1203,188 @@ async def change_conversion_rate(update: Update, context: ContextTypes.DEFAULT_T
     new_rate_str = convert_to_english_digits(args[0])
     try:
         new_rate = int(new_rate_str)
-        global CONVERSION_RATE
-        CONVERSION_RATE = new_rate
+        await get_storage(context).set_setting('conversion_rate', new_rate)
+        await refresh_catalog(context.bot_data)
         await update.message.reply_text(f"✅ نرخ تبدیل به *{new_rate} تومان* تغییر یافت.", parse_mode=ParseMode.MARKDOWN)
     except ValueError:
         await update.message.reply_text("❌ نرخ تبدیل باید یک عدد صحیح باشد.")
 
+async def change_discount_tiers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != get_tenant(context).admin_id:
+        await update.message.reply_text("🚫 شما اجازه دسترسی به این بخش را ندارید.")
+        return
+    catalog = get_catalog(context)
+    if not context.args:
+        await update.message.reply_text(
+            f"🎯 سطوح تخفیف فعلی: `{format_tiers(catalog.tiers) or '-'}`\nفرمت: /discounts <تعداد تراکنش>:<درصد>,...",
+            parse_mode=ParseMode.MARKDOWN)
+        return
+    try:
+        tiers = parse_tiers(convert_to_english_digits(" ".join(context.args)))
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\nمثال: /discounts 10:10,25:15")
+        return
+    await get_storage(context).set_setting('discount_tiers', format_tiers(tiers))
+    await refresh_catalog(context.bot_data)
+    await update.message.reply_text(f"✅ سطوح تخفیف به `{format_tiers(tiers) or '-'}` تغییر یافت.", parse_mode=ParseMode.MARKDOWN)
+
+async def export_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # فهرست فعلی به صورت CSV؛ پس از ویرایش همین فایل برای ورود دسته‌جمعی فرستاده می‌شود
+    if update.effective_user.id != get_tenant(context).admin_id:
+        await update.message.reply_text("🚫 شما اجازه دسترسی به این بخش را ندارید.")
+        return
+    out = io.StringIO()
+    catalog_csv(get_catalog(context).packages, out)
+    await update.message.reply_document(
+        document=io.BytesIO(out.getvalue().encode('utf-8-sig')),
+        filename=f"catalog_{datetime.now().strftime('%Y%m%d')}.csv",
+        caption="📦 فهرست فعلی بسته‌ها\nفایل ویرایش‌شده را (با همین ستون‌ها) بفرستید؛ بسته‌هایی که در فایل نباشند حذف می‌شوند.",
+    )
+
+async def handle_catalog_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # ورود دسته‌جمعی: اعتبارسنجی در یک گذر، نمایش تفاوت‌ها و اعمال پس از تایید مدیر
+    document = update.message.document
+    if document.file_size and document.file_size > CATALOG_CSV_MAX_BYTES:
+        await update.message.reply_text("❌ حجم فایل بیش از حد مجاز است.")
+        return
+    data = await (await document.get_file()).download_as_bytearray()
+    try:
+        rows, errors = parse_catalog_csv(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline=''))
+    except (UnicodeDecodeError, csv.Error) as e:
+        await update.message.reply_text(f"❌ فایل CSV قابل خواندن نیست: {e}")
+        return
+    if errors:
+        await update.message.reply_text("❌ فایل اعمال نشد:\n" + "\n".join(errors))
+        return
+    if not rows:
+        await update.message.reply_text("❌ فایل هیچ بسته‌ای ندارد.")
+        return
+    catalog = get_catalog(context)
+    diff = diff_catalog(catalog.packages, rows)
+    if not (diff.added or diff.changed or diff.removed):
+        await update.message.reply_text("✅ فایل با فهرست فعلی تفاوتی ندارد.")
+        return
+    lines = [f"➕ {row.package_name}: {row.amount:,}" for row in diff.added]
+    for old, new in diff.changed:
+        change = f"{old.amount:,} → {new.amount:,}" if old.amount != new.amount else "توضیحات"
+        lines.append(f"✏️ {new.package_name}: {change}")
+    lines += [f"➖ {package.package_name}" for package in diff.removed]
+    if len(lines) > CATALOG_DIFF_LINES:
+        lines = lines[:CATALOG_DIFF_LINES] + [f"… و {len(lines) - CATALOG_DIFF_LINES} مورد دیگر"]
+    # تایید فقط روی همان نسخه‌ای از فهرست اعمال می‌شود که تفاوت‌ها با آن محاسبه شده است
+    get_user_state(update, context)['catalog_import'] = (catalog.version, rows)
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ اعمال", callback_data="catalog_import_apply"),
+        InlineKeyboardButton("❌ لغو", callback_data="catalog_import_cancel"),
+    ]])
+    await update.message.reply_text(
+        f"📥 فهرست جدید: {len(rows)} بسته\n"
+        f"افزوده: {len(diff.added)} | تغییر: {len(diff.changed)} | حذف: {len(diff.removed)}\n\n" + "\n".join(lines),
+        reply_markup=keyboard,
+    )
+
+async def handle_catalog_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if update.effective_user.id != get_tenant(context).admin_id:
+        return
+    pending = get_user_state(update, context).pop('catalog_import', None)
+    if pending is None:
+        await query.edit_message_text(query.message.text + "\n\n⌛ منقضی شده است؛ فایل را دوباره بفرستید.")
+        return
+    if query.data == 'catalog_import_cancel':
+        await query.edit_message_text(query.message.text + "\n\n❌ لغو شد.")
+        return
+    version, rows = pending
+    if version != get_catalog(context).version:
+        await query.edit_message_text(query.message.text + "\n\n⚠️ فهرست در این فاصله تغییر کرده است؛ فایل را دوباره بفرستید.")
+        return
+    # همه‌ی تغییرات در یک تراکنش و یک بار بازسازی Catalog
+    await get_storage(context).replace_prices([tuple(row) for row in rows])
+    await refresh_catalog(context.bot_data)
+    await query.edit_message_text(query.message.text + "\n\n✅ اعمال شد.")
+
+async def reviewer_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != get_tenant(context).admin_id:
+        await update.message.reply_text("🚫 شما اجازه دسترسی به این بخش را ندارید.")
+        return
+    storage = get_storage(context)
+    today = datetime.combine(datetime.now().date(), datetime.min.time()).timestamp()
+    week = {s.reviewer_id: s for s in await storage.get_review_stats(today - 6 * 86400)}
+    lines = ["*👥 عملکرد مدیران:*", "(امروز / ۷ روز | میانگین زمان رسیدگی | باز)", ""]
+    for stats in await storage.get_review_stats(today):
+        avg = week[stats.reviewer_id].avg_seconds
+        lines.append(f"`{stats.reviewer_id}`: {stats.completed or 0} / {week[stats.reviewer_id].completed or 0} | "
+                     f"{f'{avg / 60:.1f} دقیقه' if avg is not None else '-'} | {stats.active or 0}")
+    if len(lines) == 3:
+        lines.append("هنوز موردی بررسی نشده است.")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+async def metrics_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != get_tenant(context).admin_id:
+        await update.message.reply_text("🚫 شما اجازه دسترسی به این بخش را ندارید.")
+        return
+    summary = metrics.summary()
+    text = f"*📈 متریک‌ها:*\n```\n{summary}\n```"
+    if len(text) <= MessageLimit.MAX_TEXT_LENGTH:
+        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+        return
+    # با برچسب‌های زیاد خلاصه از سقف طول پیام تلگرام بیشتر می‌شود؛ به صورت فایل فرستاده می‌شود
+    await context.bot.send_document(chat_id=get_tenant(context).admin_id, document=summary.encode("utf-8"),
+                                    filename="metrics.txt", caption="*📈 متریک‌ها*", parse_mode=ParseMode.MARKDOWN)
+
+async def start_profiling(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /profiling [ثانیه] [cprofile]: پروفایل ربات در حال اجرا؛ Handler منتظر نمی‌ماند و Job پایانی نتیجه را می‌فرستد
+    if update.effective_user.id != get_tenant(context).admin_id:
+        await update.message.reply_text("🚫 شما اجازه دسترسی به این بخش را ندارید.")
+        return
+    if context.bot_data.get('profiler'):
+        await update.message.reply_text("⏳ پروفایل قبلی هنوز در حال اجراست.")
+        return
+    args = [convert_to_english_digits(a).lower() for a in context.args]
+    use_cprofile = 'cprofile' in args
+    try:
+        seconds = next((int(a) for a in args if a != 'cprofile'), PROFILE_SECONDS)
+    except ValueError:
+        await update.message.reply_text(f"❌ فرمت: /profiling [1-{PROFILE_MAX_SECONDS}] [cprofile]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    profiler = CProfiler() if use_cprofile else SamplingProfiler(PROFILE_INTERVAL)
+    profiler.start()
+    context.bot_data['profiler'] = profiler
+    context.job_queue.run_once(finish_profiling, seconds, chat_id=update.effective_chat.id)
+    await update.message.reply_text(f"⏱ پروفایل {'cProfile' if use_cprofile else 'نمونه‌برداری'} به مدت {seconds} ثانیه شروع شد.")
+
+async def finish_profiling(context: ContextTypes.DEFAULT_TYPE):
+    profiler = context.bot_data.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.stop()
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # فایل .prof با snakeviz یا flameprof و collapsed stacks با flamegraph.pl یا speedscope.app قابل مشاهده است
+    data_file = f"profile_{stamp}.prof" if isinstance(profiler, CProfiler) else f"profile_{stamp}.folded"
+    summary_file = f"profile_{stamp}.txt"
+
+    def write_files():
+        if isinstance(profiler, CProfiler):
+            profiler.dump(data_file)
+        else:
+            with open(data_file, 'w', encoding='utf-8') as f:
+                f.write(profiler.collapsed())
+        with open(summary_file, 'w', encoding='utf-8') as f:
+            f.write(profiler.summary())
+    try:
+        # ساخت خلاصه و نوشتن فایل‌ها در Thread جدا تا حلقه‌ی رویداد پشت دیسک نماند
+        await asyncio.get_running_loop().run_in_executor(None, write_files)
+        for filename in (summary_file, data_file):
+            with open(filename, 'rb') as f:
+                await context.bot.send_document(chat_id=context.job.chat_id, document=f,
+                                                caption=f"*🔥 پروفایل {profiler.elapsed:.0f} ثانیه*", parse_mode=ParseMode.MARKDOWN)
+    finally:
+        for filename in (summary_file, data_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
 async def auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message.text.lower()
     responses = {
@@ -1217,32 +1400,47 @@ async def auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return False
 
 # -------------------------------
-# فرمان‌های جدید: Broadcast و پست کانال
+# توابع Broadcast و ارسال پست کانال
 # -------------------------------
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
+    if update.effective_user.id != get_tenant(context).admin_id:
         await update.message.reply_text("🚫 شما اجازه استفاده از این فرمان را ندارید.")
         return
+    if context.args and context.args[0].startswith("--segment="):
+        await broadcast_segment(update, context, context.args[0][len("--segment="):], " ".join(context.args[1:]))
+        return
     if not context.args:
         await update.message.reply_text("❌ لطفاً متن پیام تبلیغاتی را وارد کنید.\nفرمت: /broadcast <پیام>")
         return
     b_msg = " ".join(context.args)
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users")
-    users = cursor.fetchall()
-    conn.close()
+    user_ids = await get_storage(context).get_user_ids()
     count = 0
-    for u in users:
+    for u in user_ids:
         try:
-            await context.bot.send_message(chat_id=u[0], text=b_msg)
+            await context.bot.send_message(chat_id=u, text=b_msg)
             count += 1
         except Exception as e:
-            logger.error(f"Broadcast error for user {u[0]}: {e}")
+            logger.error("Broadcast error for user %s: %s", u, e)
     await update.message.reply_text(f"✅ پیام تبلیغاتی به {count} کاربر ارسال شد.", parse_mode=ParseMode.MARKDOWN)
 
+async def broadcast_segment(update: Update, context: ContextTypes.DEFAULT_TYPE, name, text):
+    # فقط اعضای بخش؛ گیرندگان دسته‌دسته خوانده و هر دسته یکجا در outbox قرار می‌گیرد
+    storage = get_storage(context)
+    segments = context.bot_data['segments']
+    await storage.refresh_segments(segments)
+    if name not in segments or not text:
+        sizes = await storage.get_segment_sizes()
+        lines = [f"• {key}: {segment.description} ({sizes.get(key, 0)} نفر)" for key, segment in segments.items()]
+        await update.message.reply_text("❌ فرمت: /broadcast --segment=<بخش> <پیام>\n\nبخش‌ها:\n" + "\n".join(lines))
+        return
+    count = 0
+    async for user_ids in storage.iter_segment(name, BROADCAST_BATCH_SIZE):
+        await storage.enqueue_messages([outbox_message(user_id, text=text) for user_id in user_ids])
+        count += len(user_ids)
+    await update.message.reply_text(f"✅ پیام برای {count} کاربر بخش «{name}» در صف ارسال قرار گرفت.")
+
 async def post_to_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
+    if update.effective_user.id != get_tenant(context).admin_id:
         await update.message.reply_text("🚫 شما اجازه ارسال پست به کانال را ندارید.")
         return
     if not context.args:
@@ -1253,7 +1451,7 @@ async def post_to_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("بازدید از سایت", url="https://example.com")]
     ])
     try:
-        await context.bot.send_message(chat_id=CHANNEL_ID, text=post_text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+        await context.bot.send_message(chat_id=get_tenant(context).channel_id, text=post_text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
         await update.message.reply_text("✅ پست به کانال ارسال شد.", parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
         await update.message.reply_text(f"❌ خطا در ارسال پست به کانال: {e}")
@@ -1261,27 +1459,172 @@ async def post_to_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -------------------------------
 # تابع اصلی
 # -------------------------------
-def main():
-    init_db()
-    load_initial_prices()
-    application = Application.builder().token(TOKEN).build()
+async def post_init(application: Application):
+    storage = application.bot_data['storage']
+    await storage.init()
+    await load_initial_prices(storage)
+    await refresh_catalog(application.bot_data)
+    if RECEIPT_WORKERS:
+        pipeline = ReceiptPipeline(storage, application.bot, application.bot_data['tenant'].receipts_dir,
+                                   RECEIPT_WORKERS, RECEIPT_QUEUE_SIZE, RECEIPT_PHASH_DISTANCE)
+        await pipeline.start()
+        application.bot_data['receipt_pipeline'] = pipeline
+        metrics.QUEUE_DEPTH.set_function(pipeline.queue.qsize, metrics.tenant_label(application.bot_data, "receipts"))
+    dispatcher = OutboxDispatcher(storage, application.bot, workers=OUTBOX_WORKERS,
+                                  per_chat_interval=OUTBOX_CHAT_INTERVAL, global_rate=OUTBOX_RATE)
+    await dispatcher.start()
+    application.bot_data['outbox'] = dispatcher
+    metrics.QUEUE_DEPTH.set_function(dispatcher.in_flight, metrics.tenant_label(application.bot_data, "outbox"))
+    await application.bot_data['events'].start()
+    # در اجرای چند Tenant سرویس‌های سطح Process را run_tenants یک بار برای همه راه می‌اندازد
+    if 'shared' not in application.bot_data:
+        application.bot_data.update(await start_process_services([application]))
+
+async def post_shutdown(application: Application):
+    await stop_process_services(application.bot_data)
+    profiler = application.bot_data.pop('profiler', None)
+    if profiler:
+        profiler.stop()
+    pipeline = application.bot_data.pop('receipt_pipeline', None)
+    if pipeline:
+        await pipeline.stop()
+    # رویدادهای در صف پیش از توقف outbox پردازش می‌شوند تا پیام‌هایشان ثبت شود
+    await application.bot_data['events'].stop()
+    # پیام‌های ارسال‌نشده در جدول outbox می‌مانند و پس از راه‌اندازی بعدی ارسال می‌شوند
+    dispatcher = application.bot_data.pop('outbox', None)
+    if dispatcher:
+        await dispatcher.stop()
+    await application.bot_data['storage'].close()
+
+async def start_process_services(applications):
+    # ناظر حلقه‌ی رویداد و سرور متریک یک بار در هر Process؛ هشدار lag به مدیر همه‌ی Tenantها می‌رسد
+    services = {}
+    if LOOP_LAG_THRESHOLD:
+        async def alert(text):
+            for application in applications:
+                await application.bot_data['storage'].enqueue_messages([
+                    outbox_message(application.bot_data['tenant'].admin_id, text=text)])
+
+        watchdog = LoopWatchdog(threshold=LOOP_LAG_THRESHOLD, alert=alert if LOOP_LAG_ALERT else None,
+                                alert_threshold=LOOP_LAG_ALERT, alert_after=LOOP_LAG_ALERT_AFTER)
+        await watchdog.start()
+        services['loop_watchdog'] = watchdog
+    if METRICS_PORT:
+        services['metrics_server'] = await metrics.start_metrics_server(METRICS_PORT)
+    return services
+
+async def stop_process_services(services):
+    watchdog = services.pop('loop_watchdog', None)
+    if watchdog:
+        await watchdog.stop()
+    server = services.pop('metrics_server', None)
+    if server:
+        server.close()
+        await server.wait_closed()
+
+def default_tenant() -> Tenant:
+    # نمونه‌ی تکی ربات با تنظیمات متغیرهای محیطی
+    return Tenant(
+        name='', token=TOKEN, admin_id=ADMIN_ID, reviewer_ids=REVIEWER_IDS, bank_card=BANK_CARD,
+        channel_id=CHANNEL_ID, db_path=DB_PATH, archive_db_path=ARCHIVE_DB_PATH, snapshot_db_path=SNAPSHOT_DB_PATH,
+        receipts_dir=RECEIPTS_DIR,
+    )
+
+def update_classifier(tenant):
+    # کلاس اولویت هر Update برای PriorityUpdateProcessor؛ باید سریع و بدون I/O باشد
+    staff = frozenset((tenant.admin_id, *tenant.reviewer_ids))
+
+    def classify(update):
+        user = getattr(update, "effective_user", None)
+        if user is not None and user.id in staff:
+            return 'admin'
+        query = getattr(update, "callback_query", None)
+        if query is not None:
+            data = query.data or ''
+            if data.startswith(('approve_', 'reject_', 'confirm_invoice_')):
+                return 'payment'
+            if data.startswith((TOKEN_PREFIX, 'cancel_invoice_')):
+                return 'orders'
+            return 'browsing'
+        message = getattr(update, "message", None)
+        if message is not None:
+            if message.photo:
+                return 'payment'
+            if message.text and len(message.text) == 11 and message.text.isdigit():
+                return 'orders'
+        return 'browsing'
+
+    return classify
+
+def build_application(request=None, storage=None, tenant=None, shared=None):
+    # shared: منابع مشترک SharedResources در اجرای چند Tenant (tenants.py)
+    tenant = tenant or default_tenant()
+    builder = (
+        Application.builder()
+        .token(tenant.token)
+        .base_url(BOT_API_URL)
+        .base_file_url(BOT_FILE_URL)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(PriorityUpdateProcessor(
+            update_classifier(tenant), UPDATE_WORKERS, UPDATE_WEIGHTS, UPDATE_SHED_THRESHOLD,
+            label=lambda name: metrics.tenant_label({'tenant': tenant}, name)))
+    )
+    if shared:
+        builder = builder.request(shared.request).get_updates_request(shared.request).job_queue(shared.job_queue())
+    else:
+        builder = builder.request(request or metrics.InstrumentedHTTPXRequest(connection_pool_size=256))
+    application = builder.build()
+    application.bot_data['tenant'] = tenant
+    if shared:
+        application.bot_data['shared'] = shared
+    application.bot_data['storage'] = storage = storage or SQLiteStorage(
+        tenant.db_path, executor=shared.db_executor if shared else None,
+        archive_path=tenant.archive_db_path or None, snapshot_path=tenant.snapshot_db_path or None,
+        snapshot_max_age=SNAPSHOT_MAX_AGE, snapshot_executor=shared.snapshot_executor if shared else None)
+    application.bot_data['user_state'] = user_state = UserStateStore(USER_STATE_MAX_USERS, USER_STATE_IDLE_TTL, USER_STATE_TTLS)
+    if not shared:
+        metrics.USER_STATE_USERS.set_function(lambda: len(user_state))
+        metrics.USER_STATE_KEYS.set_function(user_state.key_count)
+    application.bot_data['segments'] = build_segments(SEGMENT_ACTIVE_DAYS, SEGMENT_LOYALTY_MIN)
+    application.bot_data['ticket_threads'] = TicketThreadCache(storage, TICKET_THREAD_CACHE_SIZE)
+    application.bot_data['review_queue'] = ReviewQueue(storage, tenant.reviewer_ids, REVIEW_ASSIGNMENT, REVIEW_LEASE)
+    application.bot_data['events'] = events = EventBus(application.bot_data, EVENT_QUEUE_SIZE)
+    register_subscribers(events)
+
+    # Updateهای تکراری و محافظ Flood پیش از همه‌ی Handlerها
+    IdempotencyGuard(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL).install(application)
+    FloodGuard(
+        rate=FLOOD_RATE, burst=FLOOD_BURST, cooldown=FLOOD_COOLDOWN,
+        duplicate_window=FLOOD_DUPLICATE_WINDOW, expensive=EXPENSIVE_ACTIONS,
+        menu=[text for row in USER_MENU for text in row], exempt=(tenant.admin_id, *tenant.reviewer_ids),
+    ).install(application)
 
     # فرمان‌های اصلی
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("history", transaction_history))
     application.add_handler(CommandHandler("stats", detailed_stats))
     application.add_handler(CommandHandler("export", export_transactions))
+    application.add_handler(CommandHandler("changes", export_changes))
     application.add_handler(CommandHandler("addpackage", add_package))
     application.add_handler(CommandHandler("deletepackage", delete_package))
+    application.add_handler(CommandHandler("catalog", export_catalog))
     application.add_handler(CommandHandler("changecvrate", change_conversion_rate))
+    application.add_handler(CommandHandler("discounts", change_discount_tiers))
     application.add_handler(CommandHandler("broadcast", broadcast))
     application.add_handler(CommandHandler("post", post_to_channel))
+    application.add_handler(CommandHandler("metrics", metrics_summary))
+    application.add_handler(CommandHandler("reviewers", reviewer_stats))
+    application.add_handler(CommandHandler("inbox", ticket_inbox))
+    application.add_handler(CommandHandler("profiling", start_profiling))
     application.add_handler(CommandHandler("search_transaction", handle_message))
     application.add_handler(CommandHandler("search_ticket", handle_message))
     application.add_handler(CommandHandler("feedback", None))
 
     # CallbackQuery Handlerها
     application.add_handler(CallbackQueryHandler(handle_admin_action, pattern='^(approve|reject)_'))
+    application.add_handler(CallbackQueryHandler(handle_catalog_import, pattern='^catalog_import_'))
+    application.add_handler(CallbackQueryHandler(handle_inbox, pattern='^inbox_'))
     application.add_handler(CallbackQueryHandler(handle_callback))
     application.add_handler(CallbackQueryHandler(cancel_ticket, pattern='^cancel_ticket$'))
     application.add_handler(CallbackQueryHandler(cancel_ticket_reply, pattern='^cancel_ticket_reply_'))
@@ -1289,6 +1632,7 @@ def main():
     # Handlerهای اختصاصی برای شماره تلفن و تصاویر
     application.add_handler(MessageHandler(filters.Regex(r'^\d{11}$'), handle_phone_number))
     application.add_handler(MessageHandler(filters.PHOTO, handle_payment_proof))
+    application.add_handler(MessageHandler(filters.Document.FileExtension("csv") & filters.User(tenant.admin_id), handle_catalog_csv))
 
     # Handler عمومی
     application.add_handler(MessageHandler(filters.ALL, handle_message))
@@ -1296,10 +1640,41 @@ def main():
 
     # زمان‌بندی وظایف
     job_queue = application.job_queue
-    job_queue.run_repeating(admin_notifications, interval=3600, first=10)
-    job_queue.run_repeating(payment_reminder, interval=3600, first=10)
-    job_queue.run_repeating(payment_expiry_job, interval=60, first=10)
+    job_queue.run_repeating(metrics.instrument_job(admin_notifications), interval=3600, first=10)
+    job_queue.run_repeating(metrics.instrument_job(payment_reminder), interval=3600, first=10)
+    job_queue.run_repeating(metrics.instrument_job(payment_expiry_job), interval=60, first=10)
+    job_queue.run_repeating(metrics.instrument_job(review_lease_job), interval=60, first=30)
+    job_queue.run_repeating(metrics.instrument_job(user_state_job), interval=300, first=300)
+    job_queue.run_repeating(metrics.instrument_job(segments_job), interval=SEGMENT_REFRESH_INTERVAL, first=60)
+    if ARCHIVE_AFTER_DAYS:
+        job_queue.run_repeating(metrics.instrument_job(archive_job), interval=86400, first=300)
+    if CHANGE_LOG_RETENTION_DAYS:
+        job_queue.run_repeating(metrics.instrument_job(change_log_job), interval=86400, first=600)
+
+    # زمان‌سنجی همه‌ی Handlerهای ثبت‌شده
+    metrics.instrument_application(application)
+    return application
+
+async def run_tenants(path):
+    tenants = load_tenants(path)
+    shared = SharedResources(connection_pool_size=256, db_workers=min(len(tenants), DB_WORKERS))
+    applications = [build_application(tenant=tenant, shared=shared) for tenant in tenants]
+    stores = [application.bot_data['user_state'] for application in applications]
+    metrics.USER_STATE_USERS.set_function(lambda: sum(len(store) for store in stores))
+    metrics.USER_STATE_KEYS.set_function(lambda: sum(store.key_count() for store in stores))
+    try:
+        await run_applications(applications, lambda: start_process_services(applications), stop_process_services)
+    finally:
+        shared.close()
 
+def main():
+    setup_logging()
+    if RECEIPT_WORKERS:
+        check_image_support()
+    if TENANTS_CONFIG:
+        asyncio.run(run_tenants(TENANTS_CONFIG))
+        return
+    application = build_application()
     application.run_polling()
 
 if __name__ == '__main__':
@@ -0,0 +1,482 @@
+import asyncio
+import functools
+import logging
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+from telegram.ext import ApplicationHandlerStop
+from telegram.request import HTTPXRequest
+
+from log_config import log_context
+
+logger = logging.getLogger(__name__)
+
+# مرزهای پیش‌فرض هیستوگرام‌ها بر حسب ثانیه
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# -------------------------------
+# انواع متریک
+# -------------------------------
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, labels, value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, func, *labels):
+        # مقدار در لحظه‌ی خواندن متریک‌ها محاسبه می‌شود
+        with self._lock:
+            self._callbacks[labels] = func
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+            callbacks = list(self._callbacks.items())
+        for labels, func in callbacks:
+            try:
+                items.append((labels, func()))
+            except Exception as e:
+                logger.debug("Gauge callback %s failed: %s", self.name, e)
+        for labels, value in items:
+            yield self.name, labels, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # برای هر برچسب: [شمارش هر سطل..., شمارش +Inf, مجموع]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            return list(series) if series else None
+
+    def label_sets(self):
+        with self._lock:
+            return list(self._series)
+
+    def count(self, *labels):
+        series = self.snapshot(*labels)
+        return sum(series[:-1]) if series else 0
+
+    def total(self, *labels):
+        series = self.snapshot(*labels)
+        return series[-1] if series else 0.0
+
+    def quantile(self, q, *labels):
+        # تخمین صدک از روی سطل‌ها (کران بالای سطلی که صدک در آن قرار می‌گیرد)
+        series = self.snapshot(*labels)
+        if not series:
+            return 0.0
+        counts = series[:-1]
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, series):
+                cumulative += c
+                yield f"{self.name}_bucket", labels + (_format_value(bound),), cumulative
+            cumulative += series[len(self.buckets)]
+            yield f"{self.name}_bucket", labels + ("+Inf",), cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, series[-1]
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) >= 1 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        # خروجی با فرمت متنی Prometheus (نسخه 0.0.4)
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                labelnames = metric.labelnames
+                if name.endswith("_bucket"):
+                    labelnames = labelnames + ("le",)
+                if labels:
+                    pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(labelnames, labels))
+                    lines.append(f"{name}{{{pairs}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.histogram(
+    "bot_handler_latency_seconds", "Latency of handler and job callbacks.", ("kind", "handler"))
+HANDLER_CALLS = REGISTRY.counter(
+    "bot_handler_calls_total", "Number of handler and job invocations.", ("kind", "handler"))
+HANDLER_ERRORS = REGISTRY.counter(
+    "bot_handler_errors_total", "Number of handler and job invocations that raised.", ("kind", "handler"))
+DB_LATENCY = REGISTRY.histogram(
+    "bot_db_query_latency_seconds", "Latency of SQLite statements grouped by statement type and table.", ("query",))
+DB_CALLS = REGISTRY.counter(
+    "bot_db_queries_total", "Number of SQLite statements grouped by statement type and table.", ("query",))
+DB_ERRORS = REGISTRY.counter(
+    "bot_db_errors_total", "Number of failed SQLite statements grouped by statement type and table.", ("query",))
+API_LATENCY = REGISTRY.histogram(
+    "bot_telegram_api_latency_seconds", "Latency of outbound Telegram Bot API requests.", ("method",),
+    buckets=DEFAULT_BUCKETS + (30.0, 60.0))
+API_ERRORS = REGISTRY.counter(
+    "bot_telegram_api_errors_total", "Number of failed outbound Telegram Bot API requests.", ("method",))
+QUEUE_DEPTH = REGISTRY.gauge(
+    "bot_queue_depth", "Current depth of internal queues.", ("queue",))
+DROPPED_UPDATES = REGISTRY.counter(
+    "bot_updates_dropped_total", "Number of updates dropped before dispatch.", ("reason",))
+OUTBOX_DELIVERIES = REGISTRY.counter(
+    "bot_outbox_deliveries_total", "Outbox delivery attempts by result.", ("result",))
+REVIEW_EVENTS = REGISTRY.counter(
+    "bot_review_events_total", "Review queue assignments, expirations and conflicts.", ("event",))
+EVENTS = REGISTRY.counter(
+    "bot_events_total", "Domain events by type and delivery result.", ("event", "result"))
+USER_STATE_USERS = REGISTRY.gauge(
+    "bot_user_state_users", "Users holding conversation state in memory.")
+USER_STATE_KEYS = REGISTRY.gauge(
+    "bot_user_state_keys", "Conversation state keys held in memory.")
+USER_STATE_EVICTIONS = REGISTRY.counter(
+    "bot_user_state_evictions_total", "Conversation state dropped by reason (expired, idle, lru).", ("reason",))
+UPDATE_QUEUE_WAIT = REGISTRY.histogram(
+    "bot_update_queue_wait_seconds", "Time updates waited in the priority scheduler by class.", ("class",))
+CACHE_REQUESTS = REGISTRY.counter(
+    "bot_cache_requests_total", "In-memory cache lookups by cache and result (hit, miss).", ("cache", "result"))
+LOOP_LAG = REGISTRY.histogram(
+    "bot_event_loop_lag_seconds", "Delay of the event loop watchdog heartbeat beyond its interval.")
+LOOP_LAG_RECENT = REGISTRY.gauge(
+    "bot_event_loop_lag_recent_seconds", "Event loop lag percentiles over the watchdog's rolling window.", ("quantile",))
+LOOP_STALLS = REGISTRY.counter(
+    "bot_event_loop_stalls_total", "Times the event loop stayed blocked past the watchdog threshold.", ("handler",))
+
+# زمینه‌ی callback در حال اجرای هر Task؛ loop_watchdog از Thread دیگری آن را می‌خواند
+ACTIVE_CALLBACKS = {}
+
+
+# -------------------------------
+# زمان‌سنجی Handlerها و Jobها
+# -------------------------------
+def instrument_callback(callback, kind="handler", name=None):
+    if getattr(callback, "__instrumented__", False):
+        return callback
+    name = name or getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        # فیلدهای update_id/user_id/handler به همه‌ی لاگ‌های این فراخوانی اضافه می‌شوند
+        update = args[0] if args else None
+        user = getattr(update, "effective_user", None)
+        context = {
+            "update_id": getattr(update, "update_id", None),
+            "user_id": user.id if user else None,
+            "handler": name,
+        }
+        token = log_context.set(context)
+        task = asyncio.current_task()
+        previous = ACTIVE_CALLBACKS.get(task)
+        ACTIVE_CALLBACKS[task] = context
+        start = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(kind, name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            HANDLER_CALLS.inc(kind, name)
+            HANDLER_LATENCY.observe(elapsed, kind, name)
+            logger.debug("%s %s finished", kind, name, extra={"latency_ms": round(elapsed * 1000, 3)})
+            log_context.reset(token)
+            if previous is None:
+                ACTIVE_CALLBACKS.pop(task, None)
+            else:
+                ACTIVE_CALLBACKS[task] = previous
+
+    wrapper.__instrumented__ = True
+    return wrapper
+
+
+def instrument_job(callback):
+    return instrument_callback(callback, kind="job")
+
+
+def tenant_label(bot_data, name):
+    # در اجرای چند Tenant (tenants.py) صف‌های هر ربات با نام خودش جدا شمرده می‌شوند
+    tenant = bot_data.get('tenant') if bot_data else None
+    return f"{tenant.name}:{name}" if tenant and tenant.name else name
+
+
+def instrument_application(application):
+    # پس از ثبت همه‌ی Handlerها فراخوانی شود
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if handler.callback is not None:
+                handler.callback = instrument_callback(handler.callback)
+    QUEUE_DEPTH.set_function(application.update_queue.qsize, tenant_label(application.bot_data, "updates"))
+    if application.job_queue is not None:
+        QUEUE_DEPTH.set_function(lambda: len(application.job_queue.jobs()), tenant_label(application.bot_data, "jobs"))
+
+
+# -------------------------------
+# زمان‌سنجی کوئری‌های دیتابیس
+# -------------------------------
+# جدول هدف هر نوع دستور؛ شماره‌ی جداول ماهانه‌ی بایگانی حذف می‌شود تا تعداد برچسب‌ها محدود بماند
+_FROM = re.compile(r"\bFROM\s+([\w.]+)", re.I)
+_INTO = re.compile(r"\bINTO\s+([\w.]+)", re.I)
+_STATEMENT_TARGET = {
+    "SELECT": _FROM, "WITH": _FROM, "DELETE": _FROM, "INSERT": _INTO, "REPLACE": _INTO,
+    "UPDATE": re.compile(r"^\s*UPDATE\s+(?:OR\s+\w+\s+)?([\w.]+)", re.I),
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql):
+    # "SELECT users"، "UPDATE outbox"، "PRAGMA"؛ برچسب از متن دستور است نه تابع فراخواننده
+    words = sql.split(None, 1)
+    if not words:
+        return "empty"
+    verb = words[0].upper()
+    pattern = _STATEMENT_TARGET.get(verb)
+    match = pattern.search(sql) if pattern else None
+    if match is None:
+        return verb
+    return f"{verb} {re.sub(r'_[0-9]+', '', match.group(1).lower())}"
+
+
+def _timed(label, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    except sqlite3.Error:
+        DB_ERRORS.inc(label)
+        raise
+    finally:
+        DB_CALLS.inc(label)
+        DB_LATENCY.observe(time.perf_counter() - start, label)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return _timed(statement_label(sql), super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return _timed(statement_label(sql), super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return _timed("SCRIPT", super().executescript, sql_script)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # sqlite3.connect(path, factory=InstrumentedConnection)
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return _timed(statement_label(sql), super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return _timed(statement_label(sql), super().executemany, sql, seq_of_parameters)
+
+
+# -------------------------------
+# زمان‌سنجی درخواست‌های خروجی به Bot API
+# -------------------------------
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            API_ERRORS.inc(endpoint)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, endpoint)
+
+
+# -------------------------------
+# سرور HTTP محلی برای Prometheus
+# -------------------------------
+async def _handle_http(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # بقیه‌ی هدرها خوانده و نادیده گرفته می‌شوند
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if not line or line in (b"\r\n", b"\n"):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+            status, body = "200 OK", REGISTRY.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        logger.debug("Metrics request failed: %s", e)
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port, host="127.0.0.1"):
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info("Metrics endpoint listening on http://%s:%s/metrics", host, port)
+    return server
+
+
+# -------------------------------
+# خلاصه‌ی متنی برای فرمان /metrics مدیر
+# -------------------------------
+def summary(limit=10):
+    lines = []
+
+    def top_by_latency(histogram):
+        rows = []
+        for labels in histogram.label_sets():
+            count = histogram.count(*labels)
+            if count:
+                total = histogram.total(*labels)
+                rows.append((total, labels, count, total / count, histogram.quantile(0.95, *labels)))
+        rows.sort(reverse=True)
+        return rows[:limit]
+
+    lines.append("handlers / jobs (total s | calls | avg ms | p95 ms | errors)")
+    for total, labels, count, avg, p95 in top_by_latency(HANDLER_LATENCY):
+        kind, name = labels
+        lines.append(f"  {kind}:{name}: {total:.2f} | {count} | {avg * 1000:.1f} | {p95 * 1000:.0f} | "
+                     f"{HANDLER_ERRORS.value(kind, name)}")
+    lines.append("")
+    lines.append("db (total s | queries | avg ms | p95 ms | errors)")
+    for total, (name,), count, avg, p95 in top_by_latency(DB_LATENCY):
+        lines.append(f"  {name}: {total:.2f} | {count} | {avg * 1000:.1f} | {p95 * 1000:.0f} | {DB_ERRORS.value(name)}")
+    lines.append("")
+    lines.append("telegram api (total s | calls | avg ms | p95 ms | errors)")
+    for total, (name,), count, avg, p95 in top_by_latency(API_LATENCY):
+        lines.append(f"  {name}: {total:.2f} | {count} | {avg * 1000:.1f} | {p95 * 1000:.0f} | {API_ERRORS.value(name)}")
+    lines.append("")
+    recent = {labels[0]: value for name, labels, value in LOOP_LAG_RECENT.samples()}
+    if recent:
+        lines.append("loop lag ms: " + " | ".join(f"{q} {value * 1000:.0f}" for q, value in recent.items()))
+    for name, labels, value in LOOP_STALLS.samples():
+        lines.append(f"loop stalls {labels[0]}: {value}")
+    for name, labels, value in USER_STATE_USERS.samples():
+        lines.append(f"user state users: {value}")
+    for name, labels, value in USER_STATE_KEYS.samples():
+        lines.append(f"user state keys: {value}")
+    for name, labels, value in USER_STATE_EVICTIONS.samples():
+        lines.append(f"user state evicted {labels[0]}: {value}")
+    for name, labels, value in CACHE_REQUESTS.samples():
+        lines.append(f"cache {labels[0]} {labels[1]}: {value}")
+    for name, labels, value in QUEUE_DEPTH.samples():
+        lines.append(f"queue {labels[0]}: {value}")
+    for total, (name,), count, avg, p95 in top_by_latency(UPDATE_QUEUE_WAIT):
+        lines.append(f"update wait {name}: {count} | avg {avg * 1000:.1f} ms | p95 {p95 * 1000:.0f} ms")
+    for name, labels, value in DROPPED_UPDATES.samples():
+        lines.append(f"dropped {labels[0]}: {value}")
+    for name, labels, value in OUTBOX_DELIVERIES.samples():
+        lines.append(f"outbox {labels[0]}: {value}")
+    for name, labels, value in REVIEW_EVENTS.samples():
+        lines.append(f"review {labels[0]}: {value}")
+    for name, labels, value in EVENTS.samples():
+        lines.append(f"event {labels[0]} {labels[1]}: {value}")
+    return "\n".join(lines)
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+import metrics
+from antiflood import TokenBucket
+from storage import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+# متدهای Bot که از طریق outbox ارسال می‌شوند (فایل‌ها فقط با file_id)
+METHODS = ('send_message', 'send_photo', 'send_document')
+MAX_BACKOFF = 300
+
+
+def outbox_message(chat_id, method='send_message', **kwargs):
+    if method not in METHODS:
+        raise ValueError(f"Unsupported outbox method: {method}")
+    reply_markup = kwargs.get('reply_markup')
+    if reply_markup is not None:
+        kwargs['reply_markup'] = reply_markup.to_dict()
+    return OutboxMessage(chat_id, method, json.dumps(kwargs, ensure_ascii=False))
+
+
+class OutboxDispatcher:
+    # پیام‌های ثبت‌شده در جدول outbox را با چند Worker ارسال می‌کند؛ پیام‌های هر چت همیشه به یک Worker می‌رسند
+    # تا ترتیبشان حفظ شود. پیام تا ارسال موفق در دیتابیس می‌ماند، پس با خاموش شدن ربات از دست نمی‌رود.
+    def __init__(self, storage, bot, workers=4, poll_interval=5.0, per_chat_interval=1.0,
+                 global_rate=25.0, max_attempts=8, batch_size=100):
+        self.storage = storage
+        self.bot = bot
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.per_chat_interval = per_chat_interval
+        self.global_rate = global_rate
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self._queues = [asyncio.Queue() for _ in range(workers)]
+        self._wake = asyncio.Event()
+        self._in_flight = set()
+        # chat_id -> شناسه‌ی قدیمی‌ترین پیام در انتظار تلاش مجدد؛ پیام‌های بعدی آن چت تا ارسال آن صبر می‌کنند
+        self._retrying = {}
+        self._chat_next = {}
+        self._bucket = TokenBucket(global_rate, time.monotonic())
+        self._paused_until = 0.0
+        self._tasks = []
+
+    def wake(self):
+        self._wake.set()
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+    async def start(self):
+        self.storage.outbox_listener = self.wake
+        self._tasks = [asyncio.create_task(self._dispatch(), name="outbox-dispatcher")]
+        self._tasks += [asyncio.create_task(self._worker(q), name=f"outbox-worker-{i}") for i, q in enumerate(self._queues)]
+
+    async def stop(self):
+        self.storage.outbox_listener = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def drain(self):
+        # برای بنچمارک‌ها: تا خالی شدن پیام‌های قابل ارسال صبر می‌کند
+        while self._in_flight or await self.storage.get_due_messages(time.time(), 1):
+            self.wake()
+            await asyncio.sleep(0.01)
+
+    async def _dispatch(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self._poll()
+            except Exception as e:
+                logger.error("Outbox poll failed: %s", e)
+
+    async def _poll(self):
+        # صفحه‌به‌صفحه پس از آخرین شناسه‌ی دیده‌شده؛ پیام‌های در حال ارسال یا چت منتظر تلاش مجدد
+        # صفحه را پر نمی‌کنند و چت‌های دیگر پشت آن‌ها گرسنه نمی‌مانند
+        now, after, queued = time.time(), 0, 0
+        while queued < self.batch_size:
+            entries = await self.storage.get_due_messages(now, self.batch_size, after)
+            for entry in entries:
+                if entry.message_id in self._in_flight or self._blocked(entry):
+                    continue
+                self._in_flight.add(entry.message_id)
+                self._queues[hash(entry.chat_id) % self.workers].put_nowait(entry)
+                queued += 1
+            if len(entries) < self.batch_size:
+                break
+            after = entries[-1].message_id
+
+    async def _worker(self, queue):
+        while True:
+            entry = await queue.get()
+            try:
+                await self._deliver(entry)
+            except Exception as e:
+                logger.error("Outbox delivery of %s failed: %s", entry.message_id, e)
+            finally:
+                self._in_flight.discard(entry.message_id)
+                # پیام بعدی همین چت (یا پیامی که پشت این یکی مانده) بدون صبر تا poll_interval خوانده شود
+                self.wake()
+
+    async def _throttle(self, chat_id):
+        # فاصله‌ی حداقل بین پیام‌های یک چت، سقف کلی ارسال و توقف پس از RetryAfter
+        while True:
+            now = time.monotonic()
+            wait = max(self._chat_next.get(chat_id, 0) - now, self._paused_until - now)
+            if wait <= 0 and self._bucket.take(self.global_rate, self.global_rate, now):
+                break
+            await asyncio.sleep(max(wait, 1 / self.global_rate))
+        self._chat_next[chat_id] = time.monotonic() + self.per_chat_interval
+        if len(self._chat_next) > 10000:
+            now = time.monotonic()
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+    def _blocked(self, entry):
+        return self._retrying.get(entry.chat_id, entry.message_id) < entry.message_id
+
+    def _retry_later(self, entry):
+        self._retrying[entry.chat_id] = min(self._retrying.get(entry.chat_id, entry.message_id), entry.message_id)
+
+    def _done(self, entry):
+        if self._retrying.get(entry.chat_id) == entry.message_id:
+            del self._retrying[entry.chat_id]
+
+    async def _deliver(self, entry):
+        if self._blocked(entry):
+            # پس از ارسال پیام قدیمی‌تر همین چت دوباره از دیتابیس خوانده می‌شود
+            return
+        kwargs = json.loads(entry.payload)
+        if 'reply_markup' in kwargs:
+            kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], self.bot)
+        await self._throttle(entry.chat_id)
+        try:
+            await getattr(self.bot, entry.method)(chat_id=entry.chat_id, **kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            metrics.OUTBOX_DELIVERIES.inc("retry_after")
+            self._retry_later(entry)
+            await self.storage.reschedule_message(entry.message_id, time.time() + retry_after, str(e))
+            return
+        except (Forbidden, BadRequest) as e:
+            # کاربر ربات را مسدود کرده یا پیام نامعتبر است؛ تلاش مجدد فایده‌ای ندارد
+            metrics.OUTBOX_DELIVERIES.inc("failed")
+            logger.warning("Outbox message %s to %s dropped: %s", entry.message_id, entry.chat_id, e)
+            self._done(entry)
+            await self.storage.fail_message(entry.message_id, str(e))
+            return
+        except TelegramError as e:
+            if entry.attempts + 1 >= self.max_attempts:
+                metrics.OUTBOX_DELIVERIES.inc("failed")
+                logger.error("Outbox message %s to %s failed after %s attempts: %s",
+                             entry.message_id, entry.chat_id, entry.attempts + 1, e)
+                self._done(entry)
+                await self.storage.fail_message(entry.message_id, str(e))
+                return
+            backoff = min(MAX_BACKOFF, 2 ** entry.attempts) * random.uniform(0.5, 1.5)
+            metrics.OUTBOX_DELIVERIES.inc("retry")
+            self._retry_later(entry)
+            await self.storage.reschedule_message(entry.message_id, time.time() + backoff, str(e))
+            return
+        metrics.OUTBOX_DELIVERIES.inc("sent")
+        self._done(entry)
+        await self.storage.delete_message(entry.message_id)
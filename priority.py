@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# کلاس‌های اولویت به ترتیب اهمیت و وزن هر کلاس در صف‌بندی منصفانه‌ی وزن‌دار
+CLASSES = ('admin', 'payment', 'orders', 'browsing')
+DEFAULT_WEIGHTS = {'admin': 8, 'payment': 4, 'orders': 2, 'browsing': 1}
+
+
+class _Entry:
+    __slots__ = ("update", "user_id", "finish", "enqueued", "granted")
+
+    def __init__(self, update, user_id, finish, enqueued):
+        self.update = update
+        self.user_id = user_id
+        self.finish = finish
+        self.enqueued = enqueued
+        self.granted = asyncio.Event()
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    # به جای پردازش Updateها به ترتیب رسیدن، هر Update با classify(update) در یکی از CLASSES قرار می‌گیرد و
+    # حداکثر workers Update هم‌زمان اجرا می‌شوند. نوبت با صف‌بندی منصفانه‌ی وزن‌دار (WFQ) داده می‌شود: هر Update
+    # برچسب پایان max(زمان مجازی، برچسب قبلی کلاس) + 1/وزن می‌گیرد و کوچک‌ترین برچسب اول اجرا می‌شود؛ پس کلاس
+    # سبک گرسنه نمی‌ماند ولی تایید مدیر و رسید پرداخت پشت سیل /start و منو منتظر نمی‌مانند.
+    # Updateهای هر کاربر به ترتیب رسیدن و یکی‌یکی اجرا می‌شوند (Update بعدی کاربر در همان کلاس قبلی‌اش می‌ماند).
+    # با عبور صف از shed_threshold، Updateهای تازه‌ی کلاس‌های shed_classes دور ریخته می‌شوند.
+    def __init__(self, classify, workers=1, weights=None, shed_threshold=500, shed_classes=('browsing',),
+                 max_backlog=10000, label=lambda name: name, clock=time.monotonic):
+        # max_backlog سقف Taskهای Application است؛ هم‌زمانی واقعی را workers تعیین می‌کند
+        super().__init__(max_backlog)
+        weights = dict(weights or {})
+        unknown = sorted(set(weights) - set(CLASSES))
+        if unknown:
+            raise ValueError(f"Unknown priority classes in weights: {', '.join(unknown)}")
+        if any(not weight > 0 for weight in weights.values()):
+            raise ValueError("Priority weights must be positive")
+        self.classify = classify
+        self.workers = workers
+        self.weights = dict(DEFAULT_WEIGHTS, **weights)
+        self.shed_threshold = shed_threshold
+        self.shed_classes = frozenset(shed_classes)
+        self.clock = clock
+        self._queues = {name: deque() for name in CLASSES}
+        self._last_finish = dict.fromkeys(CLASSES, 0.0)
+        self._virtual_time = 0.0
+        self._active = 0
+        self._running_users = set()
+        # user_id -> [کلاس، تعداد Updateهای در صف]
+        self._queued_users = {}
+        for name in CLASSES:
+            metrics.QUEUE_DEPTH.set_function(self._queues[name].__len__, label(f"updates:{name}"))
+
+    def backlog(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        user_id = user.id if user else None
+        queued = self._queued_users.get(user_id) if user_id is not None else None
+        own = self.classify(update)
+        # دور ریختن بر اساس کلاس خود Update است تا رسید پرداخت پشت یک کلیک منوی همان کاربر از دست نرود
+        if own in self.shed_classes and self.backlog() >= self.shed_threshold:
+            coroutine.close()
+            metrics.DROPPED_UPDATES.inc(f"shed:{own}")
+            await self._answer_shed(update)
+            return
+        name = queued[0] if queued else own
+        finish = max(self._virtual_time, self._last_finish[name]) + 1.0 / self.weights[name]
+        self._last_finish[name] = finish
+        entry = _Entry(update, user_id, finish, self.clock())
+        self._queues[name].append(entry)
+        if user_id is not None:
+            if queued:
+                queued[1] += 1
+            else:
+                self._queued_users[user_id] = [name, 1]
+        self._dispatch()
+        try:
+            await entry.granted.wait()
+        except asyncio.CancelledError:
+            if entry.granted.is_set():
+                self._release(user_id)
+            else:
+                self._queues[name].remove(entry)
+                self._unqueue_user(user_id)
+            coroutine.close()
+            raise
+        metrics.UPDATE_QUEUE_WAIT.observe(self.clock() - entry.enqueued, name)
+        try:
+            await coroutine
+        finally:
+            self._release(user_id)
+
+    def _unqueue_user(self, user_id):
+        queued = self._queued_users.get(user_id)
+        if queued is not None:
+            queued[1] -= 1
+            if queued[1] == 0:
+                del self._queued_users[user_id]
+
+    def _release(self, user_id):
+        self._active -= 1
+        self._running_users.discard(user_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._active < self.workers:
+            best = None
+            for name in CLASSES:
+                found = self._first_ready(self._queues[name])
+                if found is not None and (best is None or found[1].finish < best[2].finish):
+                    best = (name, *found)
+            if best is None:
+                return
+            name, index, entry = best
+            del self._queues[name][index]
+            self._virtual_time = entry.finish
+            self._unqueue_user(entry.user_id)
+            if entry.user_id is not None:
+                self._running_users.add(entry.user_id)
+            self._active += 1
+            entry.granted.set()
+
+    def _first_ready(self, queue):
+        # Update بعدی کاربری که هنوز در حال اجراست منتظر می‌ماند ولی جلوی کاربران دیگر همان کلاس را نمی‌گیرد؛
+        # برچسب‌های هر کلاس صعودی است، پس اولین Update آماده کوچک‌ترین برچسب کلاس را دارد
+        for index, entry in enumerate(queue):
+            if entry.user_id is None or entry.user_id not in self._running_users:
+                return index, entry
+        return None
+
+    async def _answer_shed(self, update):
+        # بدون پاسخ، دکمه در کلاینت کاربر در حالت بارگذاری می‌ماند
+        query = getattr(update, "callback_query", None)
+        if query is not None:
+            try:
+                await query.answer("⏳ ربات در حال حاضر شلوغ است؛ لطفاً چند لحظه بعد دوباره تلاش کنید.")
+            except TelegramError:
+                pass
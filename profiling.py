@@ -0,0 +1,121 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+# فریم‌هایی که در Thread حلقه‌ی رویداد یعنی بیکاری (انتظار برای I/O)
+IDLE_FUNCTIONS = frozenset(("select", "poll", "epoll", "_run_once", "wait", "_worker"))
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    # یک Thread جداگانه هر interval ثانیه پشته‌ی همه‌ی Threadها (حلقه‌ی رویداد، SQLite، Executorها) را
+    # نمونه‌برداری می‌کند؛ تا start فراخوانی نشود هیچ هزینه‌ای ندارد
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self._stop.clear()
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.elapsed = time.monotonic() - self.started
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        # قالب flamegraph.pl / speedscope: "thread;outer;...;inner count"
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, limit=25):
+        own = Counter()
+        total = Counter()
+        threads = Counter()
+        for stack, count in self.stacks.items():
+            thread, *frames = stack.split(";")
+            threads[thread] += count
+            if frames:
+                own[(thread, frames[-1])] += count
+            for label in set(frames):
+                total[(thread, label)] += count
+        # فریم‌های راه‌اندازی Thread (run_forever، _bootstrap و...) در همه‌ی نمونه‌ها هستند و چیزی نمی‌گویند
+        total = Counter({key: count for key, count in total.items() if count < threads[key[0]]})
+        lines = [f"{self.samples} samples over {self.elapsed:.1f}s (interval {self.interval * 1000:.0f} ms)", ""]
+        lines.append("samples per thread:")
+        for thread, count in threads.most_common():
+            idle = sum(c for (t, label), c in own.items() if t == thread and label.split(" ")[0] in IDLE_FUNCTIONS)
+            lines.append(f"  {thread}: {count} ({idle * 100 / count:.0f}% idle)")
+        for title, counter in (("top functions by own samples", own), ("top functions by total samples", total)):
+            lines.append("")
+            lines.append(f"{title} (thread | % of thread | function):")
+            for (thread, label), count in counter.most_common(limit):
+                lines.append(f"  {thread} | {count * 100 / threads[thread]:5.1f}% | {label}")
+        return "\n".join(lines) + "\n"
+
+
+class CProfiler:
+    # cProfile فقط Thread حلقه‌ی رویداد را می‌بیند (Handlerها و Jobها، بدون کوئری‌های SQLite در Executor)
+    def __init__(self):
+        self._profile = cProfile.Profile()
+        self.started = None
+        self.elapsed = 0.0
+        self.running = False
+
+    def start(self):
+        self.started = time.monotonic()
+        self._profile.enable()
+        self.running = True
+
+    def stop(self):
+        self._profile.disable()
+        self.running = False
+        self.elapsed = time.monotonic() - self.started
+
+    def dump(self, path):
+        self._profile.dump_stats(path)
+
+    def summary(self, limit=40):
+        out = io.StringIO()
+        out.write(f"cProfile over {self.elapsed:.1f}s (event loop thread)\n\n")
+        stats = pstats.Stats(self._profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(limit)
+        stats.sort_stats("tottime").print_stats(limit)
+        return out.getvalue()
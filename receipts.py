@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+
+try:
+    from PIL import Image
+except ImportError:  # بدون Pillow فقط شناسه‌ی فایل و هش محتوا مقایسه می‌شوند
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+def content_path(directory, sha256):
+    # ذخیره‌سازی بر اساس محتوا: receipts/ab/abcdef....jpg
+    return os.path.join(directory, sha256[:2], f"{sha256}.jpg")
+
+
+def check_image_support():
+    # یک بار هنگام راه‌اندازی؛ بدون Pillow مقایسه‌ی تصویری (dHash) رسیدها بی‌صدا غیرفعال می‌ماند
+    if Image is None:
+        logger.warning("Pillow is not installed; receipts are only compared by file id and content hash")
+    return Image is not None
+
+
+def perceptual_hash(data):
+    # dHash شصت‌وچهار بیتی؛ فشرده‌سازی مجدد تصویر توسط Telegram آن را تغییر نمی‌دهد
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            pixels = list(image.convert("L").resize((9, 8)).getdata())
+    except Exception as e:
+        logger.warning("Could not decode receipt image: %s", e)
+        return None
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def store_receipt(directory, data):
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = content_path(directory, sha256)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return sha256, perceptual_hash(data), path
+
+
+def duplicate_flag(transaction_id, exact=True):
+    # exact: همان فایل یا همان محتوا؛ در غیر این صورت فقط تصویر مشابه (فاصله‌ی dHash) که ممکن است رسید دیگری از
+    # همان اپلیکیشن بانکی باشد
+    if exact:
+        return f"\n\n⚠️ *رسید تکراری:* همان رسید تراکنش `{transaction_id}`"
+    return f"\n\n⚠️ *احتمال رسید تکراری:* مشابه رسید تراکنش `{transaction_id}`"
+
+
+class ReceiptPipeline:
+    # دریافت رسیدها در پس‌زمینه با تعداد محدود Worker و صف محدود
+    # phash_distance: حداکثر فاصله‌ی Hamming دو dHash برای مشابه دانستن رسیدها (storage.PHASH_BANDS)
+    def __init__(self, storage, bot, directory, workers=2, queue_size=100, phash_distance=2):
+        self.storage = storage
+        self.bot = bot
+        self.directory = directory
+        self.workers = workers
+        self.phash_distance = phash_distance
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._tasks = [asyncio.create_task(self._worker(), name=f"receipt-worker-{i}") for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, transaction_id, file_id, review):
+        # review: (chat_id, message_id, flagged) پیام بررسی مدیر
+        try:
+            self.queue.put_nowait((transaction_id, file_id, review))
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Receipt queue full, skipping pre-screening for %s", transaction_id)
+            return False
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._process(*job)
+            except Exception as e:
+                logger.error("Receipt pre-screening failed for %s: %s", job[0], e)
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, transaction_id, file_id, review):
+        file = await self.bot.get_file(file_id)
+        data = bytes(await file.download_as_bytearray())
+        loop = asyncio.get_running_loop()
+        sha256, phash, path = await loop.run_in_executor(None, store_receipt, self.directory, data)
+        duplicate_of = await self.storage.find_duplicate_receipt(transaction_id, sha256=sha256)
+        exact = duplicate_of is not None
+        if not exact:
+            duplicate_of = await self.storage.find_duplicate_receipt(
+                transaction_id, phash=phash, max_distance=self.phash_distance)
+        await self.storage.set_receipt_hashes(transaction_id, sha256, phash, path)
+        chat_id, message_id, flagged = review
+        if duplicate_of and not flagged:
+            # هشدار در پاسخ به پیام بررسی فرستاده می‌شود، نه با ویرایش آن: مدیر ممکن است پیش از پایان بررسی
+            # رسید را تایید یا رد کرده باشد و ویرایش، نتیجه را با متن و دکمه‌های اولیه بازنویسی می‌کرد
+            try:
+                await self.bot.send_message(
+                    chat_id=chat_id, text=duplicate_flag(duplicate_of, exact).strip(), reply_to_message_id=message_id,
+                    parse_mode=ParseMode.MARKDOWN,
+                )
+            except TelegramError as e:
+                logger.info("Could not flag duplicate receipt on %s: %s", transaction_id, e)
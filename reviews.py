@@ -0,0 +1,84 @@
+import logging
+import time
+
+import metrics
+from storage import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION = 'transaction'
+TICKET = 'ticket'
+# round_robin: نوبتی، load: مدیر با کمترین مورد باز (در تساوی نوبتی)
+STRATEGIES = ('round_robin', 'load')
+
+
+class ReviewQueue:
+    # رسیدهای در انتظار بررسی و تیکت‌ها بین چند مدیر تقسیم می‌شوند. هر مورد با یک Lease محدود به یک مدیر
+    # سپرده می‌شود و اگر تا پایان آن پاسخی نیاید به مدیر دیگری می‌رسد؛ Claim و تکمیل در دیتابیس اتمیک هستند
+    # تا دو مدیر هرگز یک رسید را هم‌زمان پردازش نکنند.
+    def __init__(self, storage, reviewers, strategy='round_robin', lease=600.0, clock=time.time):
+        if not reviewers:
+            raise ValueError("At least one reviewer is required")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown review assignment strategy: {strategy}")
+        self.storage = storage
+        self.reviewers = tuple(reviewers)
+        self.strategy = strategy
+        self.lease = lease
+        self.clock = clock
+        self._turn = 0
+
+    def is_reviewer(self, user_id):
+        return user_id in self.reviewers
+
+    async def _candidates(self, exclude):
+        candidates = [r for r in self.reviewers if r not in exclude] or list(self.reviewers)
+        start = self._turn % len(candidates)
+        self._turn += 1
+        candidates = candidates[start:] + candidates[:start]
+        if self.strategy == 'load':
+            load = await self.storage.get_review_load()
+            candidates.sort(key=lambda r: load.get(r, 0))
+        return candidates
+
+    async def assign(self, item_type, item_id, notice=None, exclude=()):
+        # notice: پیام بررسی بدون chat_id؛ برای ارسال به مدیر بعدی پس از انقضای Lease ذخیره می‌شود
+        now = self.clock()
+        for reviewer_id in await self._candidates(exclude):
+            if await self.storage.claim_review(item_type, item_id, reviewer_id, now, now + self.lease, notice):
+                metrics.REVIEW_EVENTS.inc("assigned")
+                return reviewer_id
+        metrics.REVIEW_EVENTS.inc("conflict")
+        return None
+
+    async def claim(self, item_type, item_id, reviewer_id):
+        # با فشردن دکمه توسط مدیر؛ Lease همان مدیر تمدید می‌شود و مورد آزاد یا منقضی به او می‌رسد
+        now = self.clock()
+        claimed = await self.storage.claim_review(item_type, item_id, reviewer_id, now, now + self.lease)
+        if not claimed:
+            metrics.REVIEW_EVENTS.inc("conflict")
+        return claimed
+
+    async def _still_pending(self, claim):
+        if claim.item_type == TRANSACTION:
+            trans = await self.storage.get_transaction(claim.item_id)
+            return trans is not None and trans.status == 'pending_review'
+        ticket = await self.storage.get_ticket(claim.item_id)
+        return ticket is not None and ticket.status == 'pending'
+
+    async def release_expired(self):
+        # Job دوره‌ای: موارد بی‌پاسخ به مدیر دیگری سپرده و پیام بررسی دوباره از طریق outbox ارسال می‌شود
+        messages = []
+        for claim in await self.storage.release_expired_reviews(self.clock()):
+            metrics.REVIEW_EVENTS.inc("expired")
+            if not await self._still_pending(claim):
+                continue
+            notice = OutboxMessage(None, claim.method, claim.payload) if claim.method else None
+            reviewer_id = await self.assign(claim.item_type, claim.item_id, notice, exclude=(claim.reviewer_id,))
+            logger.info("Review lease of %s %s expired for %s, reassigned to %s",
+                        claim.item_type, claim.item_id, claim.reviewer_id, reviewer_id)
+            if reviewer_id is not None and notice is not None:
+                messages.append(notice._replace(chat_id=reviewer_id))
+        if messages:
+            await self.storage.enqueue_messages(messages)
+        return len(messages)
@@ -0,0 +1,58 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from catalog import is_internet
+
+# sql: (user_id, expires_at) اعضا از میان temp.segment_candidates؛ تنها پارامتر :now است.
+# expires_at برای عضویت وابسته به زمان است (None = تا تغییر بعدی کاربر).
+# matches(user, transactions, now) معادل همان شرط برای MemoryStorage: (عضو است؟، expires_at)
+Segment = namedtuple('Segment', 'name description sql matches')
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _active(days):
+    def matches(user, transactions, now):
+        last = max((t.created_at for t in transactions), default=None)
+        if last is None:
+            return False, None
+        expires = (datetime.strptime(last, TIME_FORMAT) + timedelta(days=days)).strftime(TIME_FORMAT)
+        return expires > now, expires
+    return Segment(
+        f'active_{days}d', f"سفارش در {days} روز گذشته",
+        f'''SELECT user_id, datetime(MAX(created_at), '+{days} days') FROM transactions
+            WHERE user_id IN temp.segment_candidates
+            GROUP BY user_id HAVING MAX(created_at) > datetime(:now, '-{days} days')''',
+        matches,
+    )
+
+
+def _loyal(points):
+    return Segment(
+        'loyal', f"امتیاز وفاداری حداقل {points}",
+        f'''SELECT user_id, NULL FROM users
+            WHERE user_id IN temp.segment_candidates AND loyalty_points >= {points}''',
+        lambda user, transactions, now: (user.loyalty_points >= points, None),
+    )
+
+
+PENDING_ORDERS = Segment(
+    'pending_orders', "سفارش باز (در انتظار پرداخت یا بررسی)",
+    '''SELECT DISTINCT user_id, NULL FROM transactions
+       WHERE user_id IN temp.segment_candidates AND status IN ('pending', 'pending_review')''',
+    lambda user, transactions, now: (any(t.status in ('pending', 'pending_review') for t in transactions), None),
+)
+
+INTERNET_BUYERS = Segment(
+    'internet_buyers', "خرید موفق بسته‌ی اینترنت",
+    '''SELECT DISTINCT user_id, NULL FROM all_transactions
+       WHERE user_id IN temp.segment_candidates AND status = 'completed' AND instr(package_name, 'GB') > 0
+    ''',
+    lambda user, transactions, now: (any(t.status == 'completed' and is_internet(t) for t in transactions), None),
+)
+
+
+def build_segments(active_days=7, loyalty_min=10):
+    segments = (_active(active_days), _loyal(loyalty_min), PENDING_ORDERS, INTERNET_BUYERS)
+    return {segment.name: segment for segment in segments}
+
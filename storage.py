@@ -0,0 +1,1726 @@
+import abc
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import metrics
+
+# ردیف‌ها به ترتیب ستون‌های جداول هستند تا دسترسی با اندیس (مثل trans[0]) هم کار کند
+User = namedtuple('User', 'user_id username join_date transactions_count total_spent loyalty_points')
+Transaction = namedtuple('Transaction', 'transaction_id user_id amount package_name status phone_number '
+                                        'created_at payment_time completed_at rejected_at expired_at')
+Ticket = namedtuple('Ticket', 'ticket_id user_id message status created_at')
+TicketReply = namedtuple('TicketReply', 'reply_id ticket_id from_admin message time')
+Price = namedtuple('Price', 'package_id package_name amount description')
+Feedback = namedtuple('Feedback', 'feedback_id user_id rating message created_at')
+Receipt = namedtuple('Receipt', 'receipt_id transaction_id file_unique_id sha256 phash path created_at')
+# پیام خروجی: method نام متد Bot (send_message, ...) و payload آرگومان‌های آن به صورت JSON
+OutboxMessage = namedtuple('OutboxMessage', 'chat_id method payload')
+OutboxEntry = namedtuple('OutboxEntry', 'message_id chat_id method payload attempts')
+# item_type: 'transaction' یا 'ticket'؛ method/payload پیام بررسی برای ارسال مجدد به مدیر بعدی (بدون chat_id)
+ReviewClaim = namedtuple('ReviewClaim', 'item_type item_id reviewer_id status claimed_at lease_until completed_at '
+                                        'method payload')
+ReviewerStats = namedtuple('ReviewerStats', 'reviewer_id completed active avg_seconds')
+# تغییر ثبت‌شده در change_log؛ row وضعیت فعلی ردیف است و None یعنی ردیف حذف شده
+Change = namedtuple('Change', 'seq table_name row_key row')
+
+# ستون‌های زمانی مجاز برای update_transaction_status
+STATUS_TIME_FIELDS = ('payment_time', 'completed_at', 'rejected_at', 'expired_at')
+# فقط تراکنش‌های پایان‌یافته بایگانی می‌شوند؛ تراکنش‌های در جریان همیشه در جدول اصلی می‌مانند
+ARCHIVABLE_STATUSES = ('completed', 'rejected', 'expired')
+# جداولی که تغییراتشان در change_log ثبت می‌شود: جدول -> (نوع ردیف، کلید، منبع خواندن وضعیت فعلی)
+# تراکنش‌های بایگانی‌شده از all_transactions خوانده می‌شوند، پس انتقال به بایگانی حذف به حساب نمی‌آید
+CHANGE_TABLES = {
+    'transactions': (Transaction, 'transaction_id', 'all_transactions'),
+    'users': (User, 'user_id', 'users'),
+    'tickets': (Ticket, 'ticket_id', 'tickets'),
+}
+
+
+# dHash شصت‌وچهار بیتی رسید (۱۶ رقم هگز) در PHASH_BANDS بخش دورقمی اندیس می‌شود؛ دو هش با فاصله‌ی Hamming
+# کمتر از PHASH_BANDS دست‌کم در یک بخش برابرند، پس فقط رسیدهای هم‌بخش با هش کامل مقایسه می‌شوند
+PHASH_BANDS = 8
+
+
+def phash_bands(phash):
+    return [phash[i * 2:i * 2 + 2] for i in range(PHASH_BANDS)]
+
+
+def phash_distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def archive_month(created_at):
+    # "2024-03-17 10:00:00" -> "2024_03"
+    return created_at[:7].replace('-', '_')
+
+
+def now_str():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def segments_signature(segments):
+    # با تغییر تعریف بخش‌ها (مثلاً آستانه‌ی وفاداری) عضویت‌ها از نو ساخته می‌شوند
+    text = "\n".join(f"{name}:{segment.sql}" for name, segment in sorted(segments.items()))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class Storage(abc.ABC):
+    # رابط لایه‌ی داده؛ Handlerها فقط از این متدها استفاده می‌کنند
+    # متدهای تغییر وضعیت با پارامتر outbox پیام‌های اطلاع‌رسانی را در همان تراکنش دیتابیس ثبت می‌کنند
+
+    # پس از ثبت پیام در outbox فراخوانی می‌شود (OutboxDispatcher.wake)
+    outbox_listener = None
+
+    def _outbox_written(self, outbox):
+        if outbox and self.outbox_listener:
+            self.outbox_listener()
+
+    async def init(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # کاربران
+    @abc.abstractmethod
+    async def add_user(self, user_id, username): ...
+
+    @abc.abstractmethod
+    async def get_user(self, user_id): ...
+
+    @abc.abstractmethod
+    async def update_user_transaction(self, user_id, amount): ...
+
+    @abc.abstractmethod
+    async def get_user_ids(self): ...
+
+    # تراکنش‌ها
+    @abc.abstractmethod
+    async def add_transaction(self, transaction_id, user_id, amount, package_name, outbox=()): ...
+
+    @abc.abstractmethod
+    async def get_transaction(self, transaction_id): ...
+
+    @abc.abstractmethod
+    async def set_transaction_phone(self, transaction_id, phone_number): ...
+
+    @abc.abstractmethod
+    async def update_transaction_status(self, transaction_id, status, field, outbox=(), reviewer_id=None,
+                                        expected=None, credit_user=False):
+        # با reviewer_id فقط اگر همان مدیر Claim فعال مورد را داشته باشد اعمال می‌شود؛ در غیر این صورت False
+        # با expected فقط از همان وضعیت منتقل می‌شود (Compare-and-set)؛ تکرار یک انتقال False برمی‌گرداند
+        # credit_user آمار خرید کاربر را در همان تراکنش دیتابیس به‌روز می‌کند
+        ...
+
+    async def expire_transaction(self, transaction_id, outbox=()):
+        return await self.update_transaction_status(transaction_id, 'expired', 'expired_at', outbox, expected='pending')
+
+    async def submit_payment(self, transaction_id, outbox=()):
+        return await self.update_transaction_status(transaction_id, 'pending_review', 'payment_time', outbox,
+                                                    expected='pending')
+
+    @abc.abstractmethod
+    async def get_transactions_today(self, user_id): ...
+
+    @abc.abstractmethod
+    async def get_completed_transactions(self, user_id): ...
+
+    @abc.abstractmethod
+    async def get_transaction_history(self, user_id, limit=10): ...
+
+    @abc.abstractmethod
+    async def get_pending_orders(self): ...
+
+    @abc.abstractmethod
+    async def get_pending_transactions(self): ...
+
+    @abc.abstractmethod
+    async def get_detailed_stats(self): ...
+
+    @abc.abstractmethod
+    async def export_transactions(self): ...
+
+    @abc.abstractmethod
+    async def archive_transactions(self, before, batch_size=500):
+        # انتقال تراکنش‌های پایان‌یافته‌ی قدیمی‌تر از before به بایگانی ماهانه؛ تعداد منتقل‌شده را برمی‌گرداند
+        ...
+
+    @abc.abstractmethod
+    async def backup(self, filename): ...
+
+    # تیکت‌ها
+    @abc.abstractmethod
+    async def add_ticket(self, ticket_id, user_id, message, outbox=()): ...
+
+    @abc.abstractmethod
+    async def get_ticket(self, ticket_id): ...
+
+    @abc.abstractmethod
+    async def add_ticket_reply(self, ticket_id, from_admin, message): ...
+
+    @abc.abstractmethod
+    async def update_ticket_status(self, ticket_id, status, outbox=(), reviewer_id=None, reply=None):
+        # reply: (from_admin, message) در همان تراکنش به رشته‌ی تیکت اضافه می‌شود
+        ...
+
+    @abc.abstractmethod
+    async def get_pending_tickets(self): ...
+
+    @abc.abstractmethod
+    async def get_tickets_page(self, statuses, before=None, limit=10):
+        # صفحه‌بندی Keyset: جدیدترین تیکت‌ها با وضعیت statuses، پس از تیکت before (شناسه‌ی آخرین ردیف صفحه‌ی قبل)
+        ...
+
+    @abc.abstractmethod
+    async def get_ticket_thread(self, ticket_id):
+        # (Ticket، پاسخ‌ها به ترتیب ثبت) یا None
+        ...
+
+    # قیمت‌ها
+    @abc.abstractmethod
+    async def get_prices(self): ...
+
+    @abc.abstractmethod
+    async def add_price(self, package_name, amount, description): ...
+
+    @abc.abstractmethod
+    async def delete_price(self, package_name): ...
+
+    @abc.abstractmethod
+    async def replace_prices(self, rows):
+        # کل فهرست در یک تراکنش: بسته‌های غایب حذف و بقیه درج یا به‌روز می‌شوند (شناسه‌ی بسته‌های موجود ثابت می‌ماند)
+        ...
+
+    # تنظیمات (نرخ تبدیل، سطوح تخفیف و ...)
+    @abc.abstractmethod
+    async def get_settings(self): ...
+
+    @abc.abstractmethod
+    async def set_setting(self, key, value): ...
+
+    # بازخورد
+    @abc.abstractmethod
+    async def add_feedback(self, user_id, rating, message): ...
+
+    # رسیدهای پرداخت (اندیس تشخیص رسید تکراری)
+    @abc.abstractmethod
+    async def add_receipt(self, transaction_id, file_unique_id): ...
+
+    @abc.abstractmethod
+    async def set_receipt_hashes(self, transaction_id, sha256, phash, path): ...
+
+    @abc.abstractmethod
+    async def find_duplicate_receipt(self, transaction_id, file_unique_id=None, sha256=None, phash=None,
+                                     max_distance=0): ...
+
+    # صف پیام‌های خروجی (outbox.py)
+    @abc.abstractmethod
+    async def enqueue_messages(self, messages): ...
+
+    @abc.abstractmethod
+    async def get_due_messages(self, now, limit=100, after=0): ...
+
+    @abc.abstractmethod
+    async def delete_message(self, message_id): ...
+
+    @abc.abstractmethod
+    async def reschedule_message(self, message_id, next_attempt_at, error): ...
+
+    @abc.abstractmethod
+    async def fail_message(self, message_id, error): ...
+
+    # صف بررسی مدیران (reviews.py)
+    @abc.abstractmethod
+    async def claim_review(self, item_type, item_id, reviewer_id, now, lease_until, notice=None):
+        # اتمیک: موفق اگر مورد آزاد باشد، Lease مدیر قبلی گذشته باشد یا همین مدیر آن را داشته باشد
+        ...
+
+    @abc.abstractmethod
+    async def release_expired_reviews(self, now): ...
+
+    @abc.abstractmethod
+    async def get_review_load(self): ...
+
+    @abc.abstractmethod
+    async def get_review_stats(self, since): ...
+
+    # فید تغییرات (خروجی افزایشی برای سیستم حسابداری)
+    @abc.abstractmethod
+    async def get_changes(self, after=0, limit=500):
+        # (تغییرات پس از شماره‌ی after، شماره‌ی آخرین ردیف خوانده‌شده)؛ هر ردیف در یک دسته فقط یک بار می‌آید
+        ...
+
+    async def iter_changes(self, after=0, batch_size=500):
+        # دسته‌دسته تا انتهای فید: (تغییرات، cursor برای ادامه)
+        while True:
+            changes, cursor = await self.get_changes(after, batch_size)
+            if cursor == after:
+                return
+            yield changes, cursor
+            after = cursor
+
+    @abc.abstractmethod
+    async def compact_changes(self, before):
+        # حذف ردیف‌های قدیمی‌تر از before که تغییر جدیدتری از همان ردیف دارند؛ تعداد حذف‌شده
+        ...
+
+    # بخش‌های مخاطبان (segments.py)
+    @abc.abstractmethod
+    async def refresh_segments(self, segments, now=None):
+        # فقط کاربرانی که پس از cursor قبلی در change_log تغییر کرده‌اند یا عضویت زمان‌دارشان منقضی شده دوباره
+        # ارزیابی می‌شوند؛ با تغییر تعریف‌ها همه از نو. تعداد کاربران ارزیابی‌شده
+        ...
+
+    @abc.abstractmethod
+    async def get_segment_members(self, name, after=0, limit=1000, now=None): ...
+
+    @abc.abstractmethod
+    async def get_segment_sizes(self, now=None): ...
+
+    async def iter_segment(self, name, batch_size=1000, now=None):
+        # اعضا دسته‌دسته به ترتیب user_id (keyset)
+        after = 0
+        while True:
+            user_ids = await self.get_segment_members(name, after, batch_size, now)
+            if not user_ids:
+                return
+            yield user_ids
+            after = user_ids[-1]
+
+
+# -------------------------------
+# پیاده‌سازی SQLite
+# -------------------------------
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        join_date TEXT,
+        transactions_count INTEGER DEFAULT 0,
+        total_spent INTEGER DEFAULT 0,
+        loyalty_points INTEGER DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS transactions (
+        transaction_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        amount INTEGER,
+        package_name TEXT,
+        status TEXT,
+        phone_number TEXT,
+        created_at TEXT,
+        payment_time TEXT,
+        completed_at TEXT,
+        rejected_at TEXT,
+        expired_at TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS tickets (
+        ticket_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        message TEXT,
+        status TEXT,
+        created_at TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS ticket_replies (
+        reply_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ticket_id TEXT,
+        from_admin BOOLEAN,
+        message TEXT,
+        time TEXT,
+        FOREIGN KEY(ticket_id) REFERENCES tickets(ticket_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS prices (
+        package_name TEXT PRIMARY KEY,
+        amount INTEGER,
+        description TEXT,
+        package_id INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS archived_totals (
+        user_id INTEGER PRIMARY KEY,
+        completed_count INTEGER DEFAULT 0,
+        completed_total INTEGER DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS feedbacks (
+        feedback_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        rating INTEGER,
+        message TEXT,
+        created_at TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS receipts (
+        receipt_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        transaction_id TEXT,
+        file_unique_id TEXT,
+        sha256 TEXT,
+        phash TEXT,
+        path TEXT,
+        created_at TEXT,
+        FOREIGN KEY(transaction_id) REFERENCES transactions(transaction_id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_receipts_transaction ON receipts(transaction_id)',
+    'CREATE INDEX IF NOT EXISTS idx_receipts_file_unique_id ON receipts(file_unique_id)',
+    'CREATE INDEX IF NOT EXISTS idx_receipts_sha256 ON receipts(sha256)',
+    '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        method TEXT,
+        payload TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL,
+        last_error TEXT,
+        created_at TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)',
+    'CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status, created_at, ticket_id)',
+    'CREATE INDEX IF NOT EXISTS idx_ticket_replies_ticket ON ticket_replies(ticket_id, reply_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS review_claims (
+        item_type TEXT,
+        item_id TEXT,
+        reviewer_id INTEGER,
+        status TEXT DEFAULT 'claimed',
+        claimed_at REAL,
+        lease_until REAL,
+        completed_at REAL,
+        method TEXT,
+        payload TEXT,
+        PRIMARY KEY(item_type, item_id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_review_claims_lease ON review_claims(status, lease_until)',
+    'CREATE INDEX IF NOT EXISTS idx_review_claims_reviewer ON review_claims(reviewer_id, status)',
+    '''
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT,
+        row_key TEXT,
+        op TEXT,
+        changed_at TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log(table_name, row_key, seq)',
+    '''
+    CREATE TABLE IF NOT EXISTS segment_members (
+        segment TEXT,
+        user_id INTEGER,
+        expires_at TEXT,
+        PRIMARY KEY(segment, user_id)
+    ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_segment_members_user ON segment_members(user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id, created_at)',
+)
+
+# Triggerهای change_log برای هر جدول و عملیات
+CHANGE_TRIGGER = '''
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_{op} AFTER {op} ON {table}
+    BEGIN
+        INSERT INTO change_log (table_name, row_key, op, changed_at)
+        VALUES ('{table}', {ref}.{key}, '{op}', datetime('now', 'localtime'));
+    END
+'''
+SCHEMA += tuple(
+    CHANGE_TRIGGER.format(table=table, key=key, op=op, ref='OLD' if op == 'delete' else 'NEW')
+    for table, (_, key, _) in CHANGE_TABLES.items()
+    for op in ('insert', 'update', 'delete')
+)
+SCHEMA += tuple(
+    f'CREATE INDEX IF NOT EXISTS idx_receipts_phash_{i} ON receipts(substr(phash, {i * 2 + 1}, 2))'
+    for i in range(PHASH_BANDS)
+)
+# ردیف‌های موجود پیش از ایجاد change_log یک بار به‌عنوان درج ثبت می‌شوند
+CHANGE_LOG_BACKFILL = (
+    "INSERT INTO change_log (table_name, row_key, op, changed_at) "
+    "SELECT 'users', user_id, 'insert', join_date FROM users ORDER BY join_date",
+    "INSERT INTO change_log (table_name, row_key, op, changed_at) "
+    "SELECT 'transactions', transaction_id, 'insert', created_at FROM all_transactions ORDER BY created_at",
+    "INSERT INTO change_log (table_name, row_key, op, changed_at) "
+    "SELECT 'tickets', ticket_id, 'insert', created_at FROM tickets ORDER BY created_at",
+)
+
+# ستون‌هایی که پس از نسخه‌ی اول به جداول موجود اضافه شده‌اند: (جدول، ستون، تعریف، دستورات پس از افزودن)
+MIGRATIONS = (
+    ('prices', 'package_id', 'INTEGER', ('UPDATE prices SET package_id = rowid WHERE package_id IS NULL',)),
+)
+POST_MIGRATION = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_prices_package_id ON prices(package_id)',
+)
+
+# جدول بایگانی هر ماه (transactions_YYYY_MM)؛ ستون‌ها هم‌ترتیب جدول transactions هستند
+ARCHIVE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {schema}.{table} (
+        transaction_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        amount INTEGER,
+        package_name TEXT,
+        status TEXT,
+        phone_number TEXT,
+        created_at TEXT,
+        payment_time TEXT,
+        completed_at TEXT,
+        rejected_at TEXT,
+        expired_at TEXT
+    )
+'''
+ARCHIVE_INDEX = 'CREATE INDEX IF NOT EXISTS {schema}.idx_{table}_user ON {table}(user_id, created_at)'
+
+
+class SQLiteStorage(Storage):
+    # همه‌ی کوئری‌ها روی یک اتصال و در Thread جداگانه اجرا می‌شوند تا حلقه‌ی رویداد مسدود نشود
+    # archive_path: فایل جداگانه‌ی بایگانی (ATTACH)؛ بدون آن جداول ماهانه در همان فایل ساخته می‌شوند
+    # snapshot_path: کپی فقط‌خواندنی برای گزارش‌های سنگین مدیر که حداکثر snapshot_max_age ثانیه قدیمی است
+    #   (با archive_path، کپی بایگانی در snapshot_path + '.archive')
+    # executor/snapshot_executor: Threadهای مشترک چند مخزن (اجرای چند Tenant)؛ اتصال و قفل هر مخزن جداست
+    def __init__(self, path, executor=None, archive_path=None, snapshot_path=None, snapshot_max_age=300.0,
+                 snapshot_executor=None):
+        self.path = path
+        self.archive_path = archive_path
+        self.snapshot_path = snapshot_path
+        self.snapshot_max_age = snapshot_max_age
+        self._archive_schema = 'archive' if archive_path else 'main'
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._owns_executor = executor is None
+        self._lock = threading.Lock()
+        self._conn = None
+        self._snapshot_executor = None
+        if snapshot_path:
+            self._snapshot_executor = snapshot_executor or ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="sqlite-snapshot")
+        self._owns_snapshot_executor = snapshot_executor is None
+        self._snapshot_conn = None
+        self._snapshot_at = 0.0
+        self._snapshot_archive_path = f"{snapshot_path}.archive" if snapshot_path and archive_path else None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, factory=metrics.InstrumentedConnection, check_same_thread=False)
+            if self.snapshot_path:
+                # در WAL خواندن کپی Snapshot از اتصال جداگانه نویسنده‌ها را مسدود نمی‌کند
+                self._conn.execute('PRAGMA journal_mode = WAL')
+            if self.archive_path:
+                self._conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            self._refresh_archive_view(self._conn)
+        return self._conn
+
+    def _archive_tables(self, conn):
+        return [row[0] for row in conn.execute(
+            f"SELECT name FROM {self._archive_schema}.sqlite_master WHERE type = 'table' "
+            "AND name GLOB 'transactions_[0-9][0-9][0-9][0-9]_[0-9][0-9]' ORDER BY name")]
+
+    def _refresh_archive_view(self, conn):
+        # all_transactions: جدول اصلی به‌همراه همه‌ی جداول بایگانی برای تاریخچه، جستجو و خروجی
+        if not conn.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'transactions'").fetchone():
+            return
+        selects = ['SELECT * FROM main.transactions']
+        selects += [f'SELECT * FROM {self._archive_schema}.{table}' for table in self._archive_tables(conn)]
+        conn.execute('DROP VIEW IF EXISTS temp.all_transactions')
+        conn.execute(f'CREATE TEMP VIEW all_transactions AS {" UNION ALL ".join(selects)}')
+
+    def _call(self, func, args):
+        with self._lock:
+            return func(self._connect(), *args)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    def _refresh_snapshot(self):
+        # فقط در Thread مخصوص Snapshot اجرا می‌شود؛ کپی کامل با Backup API در یک مرحله و یک تراکنش خواندنی
+        if self._snapshot_conn is None:
+            self._snapshot_conn = sqlite3.connect(self.snapshot_path, factory=metrics.InstrumentedConnection,
+                                                  check_same_thread=False)
+        elif self._snapshot_archive_path:
+            self._snapshot_conn.execute('DETACH DATABASE archive')
+        source = sqlite3.connect(self.path)
+        try:
+            if self._snapshot_archive_path:
+                # بایگانی هم کپی می‌شود و هر دو فایل در یک تراکنش خواندنی خوانده می‌شوند تا ردیفی که هم‌زمان
+                # به بایگانی منتقل می‌شود در Snapshot دو بار یا هیچ بار دیده نشود
+                source.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+                source.execute('BEGIN')
+                source.execute('SELECT COUNT(*) FROM main.sqlite_master').fetchone()
+                source.execute('SELECT COUNT(*) FROM archive.sqlite_master').fetchone()
+                archive = sqlite3.connect(self._snapshot_archive_path)
+                try:
+                    source.backup(archive, name='archive')
+                finally:
+                    archive.close()
+            source.backup(self._snapshot_conn)
+        finally:
+            source.close()
+        if self._snapshot_archive_path:
+            self._snapshot_conn.execute('ATTACH DATABASE ? AS archive', (self._snapshot_archive_path,))
+        self._refresh_archive_view(self._snapshot_conn)
+        self._snapshot_at = time.time()
+
+    def _snapshot_call(self, func, args, max_age):
+        if self._snapshot_conn is None or time.time() - self._snapshot_at > max_age:
+            self._refresh_snapshot()
+        return func(self._snapshot_conn, *args)
+
+    async def _run_snapshot(self, func, *args, max_age=None):
+        # گزارش‌های سنگین روی Snapshot و در Thread جداگانه؛ کوئری‌های مسیر سفارش پشت آن‌ها منتظر نمی‌مانند
+        if self._snapshot_executor is None:
+            return await self._run(func, *args)
+        max_age = self.snapshot_max_age if max_age is None else max_age
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._snapshot_executor, self._snapshot_call, func, args, max_age)
+
+    def _as_of(self, conn):
+        # زمان داده‌هایی که conn می‌بیند
+        if conn is self._snapshot_conn:
+            return datetime.fromtimestamp(self._snapshot_at).strftime("%Y-%m-%d %H:%M:%S")
+        return now_str()
+
+    def set_trace_callback(self, callback):
+        # برای بنچمارک‌ها: متن کوئری‌های اجراشده را گزارش می‌دهد
+        self._call(lambda conn: conn.set_trace_callback(callback), ())
+
+    def query_plan(self, sql):
+        # برای بنچمارک‌ها: EXPLAIN QUERY PLAN روی همین اتصال (نمای موقت all_transactions فقط اینجا وجود دارد)
+        return self._call(lambda conn: [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")], ())
+
+    async def init(self):
+        def create(conn):
+            cursor = conn.cursor()
+            for statement in SCHEMA:
+                cursor.execute(statement)
+            for table, column, definition, backfill in MIGRATIONS:
+                columns = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+                if column not in columns:
+                    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+                    for statement in backfill:
+                        cursor.execute(statement)
+            for statement in POST_MIGRATION:
+                cursor.execute(statement)
+            conn.commit()
+            self._refresh_archive_view(conn)
+            if not cursor.execute('SELECT 1 FROM change_log LIMIT 1').fetchone():
+                for statement in CHANGE_LOG_BACKFILL:
+                    cursor.execute(statement)
+                conn.commit()
+        await self._run(create)
+
+    async def close(self):
+        def close(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            await self._run(close)
+        if self._owns_executor:
+            self._executor.shutdown(wait=True)
+        if self._snapshot_executor is not None:
+            if self._snapshot_conn is not None:
+                await asyncio.get_running_loop().run_in_executor(self._snapshot_executor, self._snapshot_conn.close)
+                self._snapshot_conn = None
+            if self._owns_snapshot_executor:
+                self._snapshot_executor.shutdown(wait=True)
+
+    # کاربران
+    async def add_user(self, user_id, username):
+        def add_user(conn):
+            conn.execute('INSERT OR IGNORE INTO users (user_id, username, join_date) VALUES (?, ?, ?)',
+                         (user_id, username, now_str()))
+            conn.commit()
+        await self._run(add_user)
+
+    async def get_user(self, user_id):
+        def get_user(conn):
+            row = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            return User(*row) if row else None
+        return await self._run(get_user)
+
+    def _credit_user(self, conn, user_id, amount):
+        conn.execute('''
+            UPDATE users
+            SET transactions_count = transactions_count + 1,
+                total_spent = total_spent + ?,
+                loyalty_points = loyalty_points + 1
+            WHERE user_id = ?
+        ''', (amount, user_id))
+
+    async def update_user_transaction(self, user_id, amount):
+        def update_user_transaction(conn):
+            self._credit_user(conn, user_id, amount)
+            conn.commit()
+        await self._run(update_user_transaction)
+
+    async def get_user_ids(self):
+        def get_user_ids(conn):
+            return [row[0] for row in conn.execute('SELECT user_id FROM users')]
+        return await self._run_snapshot(get_user_ids)
+
+    # تراکنش‌ها
+    def _insert_outbox(self, conn, messages):
+        # بدون commit؛ فراخواننده آن را همراه تغییر وضعیت commit می‌کند
+        conn.executemany('''
+            INSERT INTO outbox (chat_id, method, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)
+        ''', [(m.chat_id, m.method, m.payload, time.time(), now_str()) for m in messages])
+
+    async def add_transaction(self, transaction_id, user_id, amount, package_name, outbox=()):
+        def add_transaction(conn):
+            conn.execute('''
+                INSERT INTO transactions (transaction_id, user_id, amount, package_name, status, created_at)
+                VALUES (?, ?, ?, ?, 'pending', ?)
+            ''', (transaction_id, user_id, amount, package_name, now_str()))
+            self._insert_outbox(conn, outbox)
+            conn.commit()
+        await self._run(add_transaction)
+        self._outbox_written(outbox)
+
+    async def get_transaction(self, transaction_id):
+        def get_transaction(conn):
+            row = conn.execute('SELECT * FROM all_transactions WHERE transaction_id = ?', (transaction_id,)).fetchone()
+            return Transaction(*row) if row else None
+        return await self._run(get_transaction)
+
+    async def set_transaction_phone(self, transaction_id, phone_number):
+        def set_transaction_phone(conn):
+            conn.execute('UPDATE transactions SET phone_number = ? WHERE transaction_id = ?', (phone_number, transaction_id))
+            conn.commit()
+        await self._run(set_transaction_phone)
+
+    async def update_transaction_status(self, transaction_id, status, field, outbox=(), reviewer_id=None,
+                                        expected=None, credit_user=False):
+        if field not in STATUS_TIME_FIELDS:
+            raise ValueError(f"Unknown transaction time field: {field}")
+
+        def update_transaction_status(conn):
+            cursor = conn.execute(f'''
+                UPDATE transactions
+                SET status = ?, {field} = ?
+                WHERE transaction_id = ? AND (? IS NULL OR status = ?)
+            ''', (status, now_str(), transaction_id, expected, expected))
+            if expected is not None and cursor.rowcount == 0:
+                conn.rollback()
+                return False
+            if not self._complete_review(conn, 'transaction', transaction_id, reviewer_id):
+                return False
+            if credit_user:
+                row = conn.execute('SELECT user_id, amount FROM transactions WHERE transaction_id = ?',
+                                   (transaction_id,)).fetchone()
+                if row:
+                    self._credit_user(conn, *row)
+            self._insert_outbox(conn, outbox)
+            conn.commit()
+            return True
+        updated = await self._run(update_transaction_status)
+        if updated:
+            self._outbox_written(outbox)
+        return updated
+
+    async def get_transactions_today(self, user_id):
+        def get_transactions_today(conn):
+            return conn.execute('SELECT COUNT(*) FROM transactions WHERE user_id = ? AND created_at LIKE ?',
+                                (user_id, f"{datetime.now().strftime('%Y-%m-%d')}%")).fetchone()[0]
+        return await self._run(get_transactions_today)
+
+    async def get_completed_transactions(self, user_id):
+        def get_completed_transactions(conn):
+            # مجموع تراکنش‌های بایگانی‌شده هنگام انتقال در archived_totals نگه داشته می‌شود
+            return conn.execute('''
+                SELECT hot.count + COALESCE(archived.completed_count, 0), hot.total + COALESCE(archived.completed_total, 0)
+                FROM (SELECT COUNT(*) AS count, COALESCE(SUM(amount), 0) AS total FROM transactions
+                      WHERE user_id = ? AND status = "completed") AS hot
+                LEFT JOIN archived_totals AS archived ON archived.user_id = ?
+            ''', (user_id, user_id)).fetchone()
+        return await self._run(get_completed_transactions)
+
+    async def get_transaction_history(self, user_id, limit=10):
+        def get_transaction_history(conn):
+            return conn.execute('''
+                SELECT transaction_id, amount, package_name, status, created_at
+                FROM all_transactions
+                WHERE user_id = ?
+                ORDER BY created_at DESC
+                LIMIT ?
+            ''', (user_id, limit)).fetchall()
+        return await self._run(get_transaction_history)
+
+    async def get_pending_orders(self):
+        def get_pending_orders(conn):
+            return conn.execute('SELECT transaction_id, user_id, created_at FROM transactions '
+                                'WHERE status = "pending"').fetchall()
+        return await self._run(get_pending_orders)
+
+    async def get_pending_transactions(self):
+        def get_pending_transactions(conn):
+            return conn.execute("SELECT COUNT(*) FROM transactions WHERE status = 'pending_review'").fetchone()[0]
+        return await self._run(get_pending_transactions)
+
+    async def get_detailed_stats(self):
+        def get_detailed_stats(conn):
+            today = datetime.now().strftime("%Y-%m-%d")
+            week_start = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+            cursor = conn.cursor()
+            stats = {}
+            cursor.execute('SELECT COUNT(*), SUM(amount) FROM transactions WHERE created_at LIKE ?', (f"{today}%",))
+            stats['today_trans'], stats['today_amount'] = cursor.fetchone()
+            cursor.execute('SELECT COUNT(*), SUM(amount) FROM transactions WHERE created_at >= ?', (week_start,))
+            stats['week_trans'], stats['week_amount'] = cursor.fetchone()
+            cursor.execute('SELECT COUNT(*) FROM users')
+            stats['total_users'] = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(DISTINCT user_id) FROM transactions WHERE created_at LIKE ?', (f"{today}%",))
+            stats['active_users_today'] = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM all_transactions WHERE status = "completed"')
+            stats['completed_trans'] = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM transactions WHERE status = "pending_review"')
+            stats['pending_review_trans'] = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM all_transactions WHERE status = "rejected"')
+            stats['rejected_trans'] = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM tickets')
+            stats['total_tickets'] = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM tickets WHERE status = "pending"')
+            stats['pending_tickets'] = cursor.fetchone()[0]
+            stats['as_of'] = self._as_of(conn)
+            return stats
+        return await self._run_snapshot(get_detailed_stats)
+
+    async def export_transactions(self):
+        def export_transactions(conn):
+            return conn.execute('SELECT created_at, transaction_id, user_id, amount, status, phone_number, package_name '
+                                'FROM all_transactions').fetchall()
+        return await self._run_snapshot(export_transactions)
+
+    async def archive_transactions(self, before, batch_size=500):
+        placeholders = ', '.join('?' * len(ARCHIVABLE_STATUSES))
+
+        def archive_transactions(conn):
+            # یک دسته در یک تراکنش: درج در بایگانی، به‌روزرسانی archived_totals و حذف از جدول اصلی
+            rows = conn.execute(f'''
+                SELECT * FROM main.transactions
+                WHERE status IN ({placeholders}) AND created_at < ?
+                ORDER BY created_at
+                LIMIT ?
+            ''', (*ARCHIVABLE_STATUSES, before, batch_size)).fetchall()
+            if not rows:
+                return 0
+            existing = set(self._archive_tables(conn))
+            months = {}
+            for row in rows:
+                months.setdefault(f"transactions_{archive_month(row[6])}", []).append(row)
+            try:
+                for table, batch in months.items():
+                    if table not in existing:
+                        conn.execute(ARCHIVE_TABLE.format(schema=self._archive_schema, table=table))
+                        conn.execute(ARCHIVE_INDEX.format(schema=self._archive_schema, table=table))
+                    conn.executemany(f'INSERT OR REPLACE INTO {self._archive_schema}.{table} '
+                                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                totals = {}
+                for row in rows:
+                    if row[4] == 'completed':
+                        count, total = totals.get(row[1], (0, 0))
+                        totals[row[1]] = (count + 1, total + (row[2] or 0))
+                conn.executemany('''
+                    INSERT INTO archived_totals (user_id, completed_count, completed_total) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        completed_count = completed_count + excluded.completed_count,
+                        completed_total = completed_total + excluded.completed_total
+                ''', [(user_id, count, total) for user_id, (count, total) in totals.items()])
+                conn.executemany('DELETE FROM main.transactions WHERE transaction_id = ?', [(row[0],) for row in rows])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if not existing.issuperset(months):
+                self._refresh_archive_view(conn)
+            return len(rows)
+
+        # هر دسته جداگانه اجرا می‌شود تا کوئری‌های Handlerها بین دسته‌ها اجرا شوند
+        moved = 0
+        while True:
+            count = await self._run(archive_transactions)
+            moved += count
+            if count < batch_size:
+                return moved
+
+    async def backup(self, filename):
+        def backup(conn):
+            with open(filename, 'wb') as f:
+                for chunk in conn.iterdump():
+                    f.write(f"{chunk}\n".encode())
+                if self.archive_path:
+                    # iterdump فقط main را می‌نویسد؛ جداول بایگانی جداگانه پس از آن می‌آیند و با بازیابی در همان
+                    # فایل اصلی ساخته می‌شوند (حالت بدون archive_path)
+                    archive = sqlite3.connect(':memory:')
+                    try:
+                        conn.backup(archive, name='archive')
+                        for chunk in archive.iterdump():
+                            f.write(f"{chunk}\n".encode())
+                    finally:
+                        archive.close()
+        # بکاپ همیشه از Snapshot تازه گرفته می‌شود
+        await self._run_snapshot(backup, max_age=0)
+
+    # تیکت‌ها
+    async def add_ticket(self, ticket_id, user_id, message, outbox=()):
+        def add_ticket(conn):
+            conn.execute('''
+                INSERT INTO tickets (ticket_id, user_id, message, status, created_at)
+                VALUES (?, ?, ?, 'pending', ?)
+            ''', (ticket_id, user_id, message, now_str()))
+            self._insert_outbox(conn, outbox)
+            conn.commit()
+        await self._run(add_ticket)
+        self._outbox_written(outbox)
+
+    async def get_ticket(self, ticket_id):
+        def get_ticket(conn):
+            row = conn.execute('SELECT * FROM tickets WHERE ticket_id = ?', (ticket_id,)).fetchone()
+            return Ticket(*row) if row else None
+        return await self._run(get_ticket)
+
+    async def add_ticket_reply(self, ticket_id, from_admin, message):
+        def add_ticket_reply(conn):
+            conn.execute('INSERT INTO ticket_replies (ticket_id, from_admin, message, time) VALUES (?, ?, ?, ?)',
+                         (ticket_id, from_admin, message, now_str()))
+            conn.commit()
+        await self._run(add_ticket_reply)
+
+    async def update_ticket_status(self, ticket_id, status, outbox=(), reviewer_id=None, reply=None):
+        def update_ticket_status(conn):
+            if not self._complete_review(conn, 'ticket', ticket_id, reviewer_id):
+                return False
+            conn.execute('UPDATE tickets SET status = ? WHERE ticket_id = ?', (status, ticket_id))
+            if reply is not None:
+                conn.execute('INSERT INTO ticket_replies (ticket_id, from_admin, message, time) VALUES (?, ?, ?, ?)',
+                             (ticket_id, *reply, now_str()))
+            self._insert_outbox(conn, outbox)
+            conn.commit()
+            return True
+        updated = await self._run(update_ticket_status)
+        if updated:
+            self._outbox_written(outbox)
+        return updated
+
+    async def get_pending_tickets(self):
+        def get_pending_tickets(conn):
+            return conn.execute("SELECT COUNT(*) FROM tickets WHERE status = 'pending'").fetchone()[0]
+        return await self._run(get_pending_tickets)
+
+    async def get_tickets_page(self, statuses, before=None, limit=10):
+        def get_tickets_page(conn):
+            placeholders = ", ".join("?" * len(statuses))
+            # (created_at, ticket_id) ترتیب یکتا دارد؛ بدون OFFSET، هزینه‌ی هر صفحه به شماره‌ی صفحه بستگی ندارد
+            cursor = ''
+            params = list(statuses)
+            if before is not None:
+                cursor = 'AND (created_at, ticket_id) < (SELECT created_at, ticket_id FROM tickets WHERE ticket_id = ?)'
+                params.append(before)
+            return [Ticket(*row) for row in conn.execute(f'''
+                SELECT * FROM tickets
+                WHERE status IN ({placeholders}) {cursor}
+                ORDER BY created_at DESC, ticket_id DESC
+                LIMIT ?
+            ''', (*params, limit))]
+        return await self._run(get_tickets_page)
+
+    async def get_ticket_thread(self, ticket_id):
+        def get_ticket_thread(conn):
+            row = conn.execute('SELECT * FROM tickets WHERE ticket_id = ?', (ticket_id,)).fetchone()
+            if not row:
+                return None
+            replies = [TicketReply(*r) for r in conn.execute(
+                'SELECT * FROM ticket_replies WHERE ticket_id = ? ORDER BY reply_id', (ticket_id,))]
+            return Ticket(*row), replies
+        return await self._run(get_ticket_thread)
+
+    # قیمت‌ها
+    async def get_prices(self):
+        def get_prices(conn):
+            return [Price(*row) for row in conn.execute(
+                'SELECT package_id, package_name, amount, description FROM prices ORDER BY package_id')]
+        return await self._run(get_prices)
+
+    async def add_price(self, package_name, amount, description):
+        def add_price(conn):
+            # شناسه‌ی بسته با ویرایش قیمت ثابت می‌ماند (INSERT OR REPLACE ردیف را حذف و دوباره می‌سازد)
+            conn.execute('''
+                INSERT INTO prices (package_name, amount, description, package_id)
+                VALUES (?, ?, ?, (SELECT COALESCE(MAX(package_id), 0) + 1 FROM prices))
+                ON CONFLICT(package_name) DO UPDATE SET amount = excluded.amount, description = excluded.description
+            ''', (package_name, amount, description))
+            conn.commit()
+        await self._run(add_price)
+
+    async def delete_price(self, package_name):
+        def delete_price(conn):
+            conn.execute('DELETE FROM prices WHERE package_name = ?', (package_name,))
+            conn.commit()
+        await self._run(delete_price)
+
+    async def replace_prices(self, rows):
+        def replace_prices(conn):
+            try:
+                names = {row[0] for row in rows}
+                stale = [(name,) for (name,) in conn.execute('SELECT package_name FROM prices') if name not in names]
+                conn.executemany('DELETE FROM prices WHERE package_name = ?', stale)
+                conn.executemany('''
+                    INSERT INTO prices (package_name, amount, description, package_id)
+                    VALUES (?, ?, ?, (SELECT COALESCE(MAX(package_id), 0) + 1 FROM prices))
+                    ON CONFLICT(package_name) DO UPDATE SET amount = excluded.amount, description = excluded.description
+                ''', rows)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        await self._run(replace_prices)
+
+    # تنظیمات
+    async def get_settings(self):
+        def get_settings(conn):
+            return dict(conn.execute('SELECT key, value FROM settings'))
+        return await self._run(get_settings)
+
+    async def set_setting(self, key, value):
+        def set_setting(conn):
+            conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, str(value)))
+            conn.commit()
+        await self._run(set_setting)
+
+    # بازخورد
+    async def add_feedback(self, user_id, rating, message):
+        def add_feedback(conn):
+            conn.execute('INSERT INTO feedbacks (user_id, rating, message, created_at) VALUES (?, ?, ?, ?)',
+                         (user_id, rating, message, now_str()))
+            conn.commit()
+        await self._run(add_feedback)
+
+    # رسیدهای پرداخت
+    async def add_receipt(self, transaction_id, file_unique_id):
+        def add_receipt(conn):
+            conn.execute('INSERT INTO receipts (transaction_id, file_unique_id, created_at) VALUES (?, ?, ?)',
+                         (transaction_id, file_unique_id, now_str()))
+            conn.commit()
+        await self._run(add_receipt)
+
+    async def set_receipt_hashes(self, transaction_id, sha256, phash, path):
+        def set_receipt_hashes(conn):
+            conn.execute('UPDATE receipts SET sha256 = ?, phash = ?, path = ? WHERE transaction_id = ?',
+                         (sha256, phash, path, transaction_id))
+            conn.commit()
+        await self._run(set_receipt_hashes)
+
+    async def find_duplicate_receipt(self, transaction_id, file_unique_id=None, sha256=None, phash=None,
+                                     max_distance=0):
+        # هر ستون اندیس دارد؛ اولین تراکنش دیگری که همین رسید یا تصویری با فاصله‌ی dHash حداکثر max_distance
+        # را داشته برگردانده می‌شود
+        if max_distance >= PHASH_BANDS:
+            raise ValueError(f"max_distance must be below {PHASH_BANDS}")
+
+        def find_duplicate_receipt(conn):
+            for column, value in (('file_unique_id', file_unique_id), ('sha256', sha256)):
+                if value is None:
+                    continue
+                row = conn.execute(f'SELECT transaction_id FROM receipts WHERE {column} = ? AND transaction_id != ? '
+                                   'ORDER BY receipt_id LIMIT 1', (value, transaction_id)).fetchone()
+                if row:
+                    return row[0]
+            if phash is None:
+                return None
+            bands = ' OR '.join(f'substr(phash, {i * 2 + 1}, 2) = ?' for i in range(PHASH_BANDS))
+            for other, other_phash in conn.execute(f'''
+                SELECT transaction_id, phash FROM receipts
+                WHERE ({bands}) AND transaction_id != ?
+                ORDER BY receipt_id
+            ''', (*phash_bands(phash), transaction_id)):
+                if phash_distance(phash, other_phash) <= max_distance:
+                    return other
+            return None
+        return await self._run(find_duplicate_receipt)
+
+    # صف پیام‌های خروجی
+    async def enqueue_messages(self, messages):
+        def enqueue_messages(conn):
+            self._insert_outbox(conn, messages)
+            conn.commit()
+        await self._run(enqueue_messages)
+        self._outbox_written(messages)
+
+    async def get_due_messages(self, now, limit=100, after=0):
+        def get_due_messages(conn):
+            return [OutboxEntry(*row) for row in conn.execute('''
+                SELECT message_id, chat_id, method, payload, attempts FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ? AND message_id > ?
+                ORDER BY message_id
+                LIMIT ?
+            ''', (now, after, limit))]
+        return await self._run(get_due_messages)
+
+    async def delete_message(self, message_id):
+        def delete_message(conn):
+            conn.execute('DELETE FROM outbox WHERE message_id = ?', (message_id,))
+            conn.commit()
+        await self._run(delete_message)
+
+    async def reschedule_message(self, message_id, next_attempt_at, error):
+        def reschedule_message(conn):
+            conn.execute('UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? '
+                         'WHERE message_id = ?', (next_attempt_at, error, message_id))
+            conn.commit()
+        await self._run(reschedule_message)
+
+    async def fail_message(self, message_id, error):
+        def fail_message(conn):
+            conn.execute("UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ? "
+                         "WHERE message_id = ?", (error, message_id))
+            conn.commit()
+        await self._run(fail_message)
+
+    # صف بررسی مدیران
+    def _complete_review(self, conn, item_type, item_id, reviewer_id):
+        # بدون commit؛ اگر Claim این مدیر نباشد تغییرات همین تراکنش rollback می‌شود
+        if reviewer_id is None:
+            return True
+        cursor = conn.execute('''
+            UPDATE review_claims SET status = 'done', completed_at = ?
+            WHERE item_type = ? AND item_id = ? AND reviewer_id = ? AND status = 'claimed'
+        ''', (time.time(), item_type, item_id, reviewer_id))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False
+        return True
+
+    async def claim_review(self, item_type, item_id, reviewer_id, now, lease_until, notice=None):
+        def claim_review(conn):
+            # claimed_at برای همان مدیر حفظ می‌شود تا زمان رسیدگی در آمار درست باشد
+            cursor = conn.execute('''
+                INSERT INTO review_claims (item_type, item_id, reviewer_id, status, claimed_at, lease_until, method, payload)
+                VALUES (?, ?, ?, 'claimed', ?, ?, ?, ?)
+                ON CONFLICT(item_type, item_id) DO UPDATE SET
+                    claimed_at = CASE WHEN review_claims.status = 'claimed' AND review_claims.reviewer_id = excluded.reviewer_id
+                                      THEN review_claims.claimed_at ELSE excluded.claimed_at END,
+                    reviewer_id = excluded.reviewer_id,
+                    status = 'claimed',
+                    lease_until = excluded.lease_until,
+                    method = COALESCE(excluded.method, review_claims.method),
+                    payload = COALESCE(excluded.payload, review_claims.payload)
+                WHERE review_claims.status = 'released'
+                   OR (review_claims.status = 'claimed'
+                       AND (review_claims.reviewer_id = excluded.reviewer_id OR review_claims.lease_until < excluded.claimed_at))
+            ''', (item_type, item_id, reviewer_id, now, lease_until,
+                  notice.method if notice else None, notice.payload if notice else None))
+            conn.commit()
+            return cursor.rowcount > 0
+        return await self._run(claim_review)
+
+    async def release_expired_reviews(self, now):
+        def release_expired_reviews(conn):
+            rows = [ReviewClaim(*row) for row in conn.execute(
+                "SELECT * FROM review_claims WHERE status = 'claimed' AND lease_until < ?", (now,))]
+            conn.executemany(
+                "UPDATE review_claims SET status = 'released' WHERE item_type = ? AND item_id = ? AND status = 'claimed'",
+                [(row.item_type, row.item_id) for row in rows])
+            conn.commit()
+            return rows
+        return await self._run(release_expired_reviews)
+
+    async def get_review_load(self):
+        def get_review_load(conn):
+            return dict(conn.execute(
+                "SELECT reviewer_id, COUNT(*) FROM review_claims WHERE status = 'claimed' GROUP BY reviewer_id"))
+        return await self._run(get_review_load)
+
+    async def get_review_stats(self, since):
+        def get_review_stats(conn):
+            return [ReviewerStats(*row) for row in conn.execute('''
+                SELECT reviewer_id,
+                       SUM(status = 'done' AND completed_at >= ?),
+                       SUM(status = 'claimed'),
+                       AVG(CASE WHEN status = 'done' AND completed_at >= ? THEN completed_at - claimed_at END)
+                FROM review_claims
+                GROUP BY reviewer_id
+            ''', (since, since))]
+        return await self._run(get_review_stats)
+
+    # فید تغییرات
+    async def get_changes(self, after=0, limit=500):
+        def get_changes(conn):
+            entries = conn.execute('SELECT seq, table_name, row_key FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?',
+                                   (after, limit)).fetchall()
+            if not entries:
+                return [], after
+            latest = {(table, key): seq for seq, table, key in entries}
+            rows = {}
+            for table, (row_type, key, source) in CHANGE_TABLES.items():
+                keys = [k for t, k in latest if t == table]
+                # سقف متغیرهای هر کوئری SQLite
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    for row in conn.execute(f'SELECT * FROM {source} WHERE {key} IN ({", ".join("?" * len(chunk))})', chunk):
+                        rows[(table, str(row[0]))] = row_type(*row)
+            changes = sorted((Change(seq, table, key, rows.get((table, key))) for (table, key), seq in latest.items()),
+                             key=lambda c: c.seq)
+            return changes, entries[-1][0]
+        return await self._run(get_changes)
+
+    async def compact_changes(self, before):
+        def compact_changes(conn):
+            cursor = conn.execute('''
+                DELETE FROM change_log
+                WHERE changed_at < ? AND EXISTS (
+                    SELECT 1 FROM change_log AS newer
+                    WHERE newer.table_name = change_log.table_name AND newer.row_key = change_log.row_key
+                      AND newer.seq > change_log.seq
+                )
+            ''', (before,))
+            conn.commit()
+            return cursor.rowcount
+        return await self._run(compact_changes)
+
+    # بخش‌های مخاطبان
+    async def refresh_segments(self, segments, now=None):
+        now = now or now_str()
+        signature = segments_signature(segments)
+
+        def refresh_segments(conn):
+            state = dict(conn.execute("SELECT key, value FROM settings WHERE key IN ('segments_cursor', 'segments_signature')"))
+            full = state.get('segments_signature') != signature
+            cursor = 0 if full else int(state.get('segments_cursor', 0))
+            last = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS segment_candidates (user_id INTEGER PRIMARY KEY)')
+            conn.execute('DELETE FROM temp.segment_candidates')
+            try:
+                if full:
+                    conn.execute('DELETE FROM segment_members')
+                    conn.execute('INSERT INTO temp.segment_candidates SELECT user_id FROM users')
+                else:
+                    conn.execute('''
+                        INSERT OR IGNORE INTO temp.segment_candidates
+                        SELECT CAST(row_key AS INTEGER) FROM change_log
+                        WHERE seq > ? AND seq <= ? AND table_name = 'users'
+                    ''', (cursor, last))
+                    conn.execute('''
+                        INSERT OR IGNORE INTO temp.segment_candidates
+                        SELECT t.user_id FROM change_log AS c JOIN all_transactions AS t ON t.transaction_id = c.row_key
+                        WHERE c.seq > ? AND c.seq <= ? AND c.table_name = 'transactions'
+                    ''', (cursor, last))
+                    conn.execute('INSERT OR IGNORE INTO temp.segment_candidates '
+                                 'SELECT user_id FROM segment_members WHERE expires_at <= ?', (now,))
+                    conn.execute('DELETE FROM segment_members WHERE user_id IN temp.segment_candidates')
+                for name, segment in segments.items():
+                    conn.execute(f'INSERT INTO segment_members (segment, user_id, expires_at) '
+                                 f'SELECT :segment, * FROM ({segment.sql})', {'segment': name, 'now': now})
+                conn.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                                 (('segments_cursor', str(last)), ('segments_signature', signature)))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return conn.execute('SELECT COUNT(*) FROM temp.segment_candidates').fetchone()[0]
+        return await self._run(refresh_segments)
+
+    async def get_segment_members(self, name, after=0, limit=1000, now=None):
+        now = now or now_str()
+
+        def get_segment_members(conn):
+            return [row[0] for row in conn.execute('''
+                SELECT user_id FROM segment_members
+                WHERE segment = ? AND user_id > ? AND (expires_at IS NULL OR expires_at > ?)
+                ORDER BY user_id LIMIT ?
+            ''', (name, after, now, limit))]
+        return await self._run(get_segment_members)
+
+    async def get_segment_sizes(self, now=None):
+        now = now or now_str()
+
+        def get_segment_sizes(conn):
+            return dict(conn.execute('SELECT segment, COUNT(*) FROM segment_members '
+                                     'WHERE expires_at IS NULL OR expires_at > ? GROUP BY segment', (now,)))
+        return await self._run(get_segment_sizes)
+
+# -------------------------------
+# پیاده‌سازی درون‌حافظه‌ای (آزمون و بنچمارک)
+# -------------------------------
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.users = {}
+        self.transactions = {}
+        self.tickets = {}
+        self.ticket_replies = []
+        self.prices = {}
+        self.settings = {}
+        self.feedbacks = []
+        self.outbox = {}
+        self._next_outbox_id = 0
+        # (item_type, item_id) -> ReviewClaim
+        self.review_claims = {}
+        # فید تغییرات: [seq, table_name, row_key, op, changed_at] به ترتیب seq
+        self.change_log = []
+        self._change_seq = 0
+        # segment -> {user_id: expires_at}
+        self.segment_members = {}
+        self.receipts = {}
+        # اندیس تراکنش‌های هر کاربر به ترتیب ایجاد
+        self._user_transactions = {}
+        # بایگانی ماهانه: "YYYY_MM" -> {transaction_id: Transaction}
+        self.archive = {}
+        self.archived_totals = {}
+        self._archived_month = {}
+        self._user_archive = {}
+        # اندیس رسیدها: (ستون، مقدار) -> شناسه‌ی تراکنش‌ها به ترتیب ثبت
+        self._receipt_index = {}
+
+    def load(self, users=(), transactions=()):
+        # بارگذاری گروهی ردیف‌های آماده (به ترتیب ستون‌های جدول) برای بنچمارک‌ها
+        for row in users:
+            user = User(*row)
+            self.users[user.user_id] = user
+            self._log_change('users', user.user_id, 'insert')
+        for row in transactions:
+            trans = Transaction(*row)
+            self.transactions[trans.transaction_id] = trans
+            self._user_transactions.setdefault(trans.user_id, []).append(trans.transaction_id)
+            self._log_change('transactions', trans.transaction_id, 'insert')
+
+    def _log_change(self, table_name, row_key, op):
+        # معادل Triggerهای change_log در SQLite
+        self._change_seq += 1
+        self.change_log.append([self._change_seq, table_name, str(row_key), op, now_str()])
+
+    # کاربران
+    async def add_user(self, user_id, username):
+        if user_id not in self.users:
+            self.users[user_id] = User(user_id, username, now_str(), 0, 0, 0)
+            self._log_change('users', user_id, 'insert')
+
+    async def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    async def update_user_transaction(self, user_id, amount):
+        self._credit_user(user_id, amount)
+
+    def _credit_user(self, user_id, amount):
+        user = self.users.get(user_id)
+        if user:
+            self.users[user_id] = user._replace(
+                transactions_count=user.transactions_count + 1,
+                total_spent=user.total_spent + amount,
+                loyalty_points=user.loyalty_points + 1,
+            )
+            self._log_change('users', user_id, 'update')
+
+    async def get_user_ids(self):
+        return list(self.users)
+
+    # تراکنش‌ها
+    async def add_transaction(self, transaction_id, user_id, amount, package_name, outbox=()):
+        if transaction_id in self.transactions:
+            raise sqlite3.IntegrityError(f"UNIQUE constraint failed: transactions.transaction_id ({transaction_id})")
+        self.transactions[transaction_id] = Transaction(
+            transaction_id, user_id, amount, package_name, 'pending', None, now_str(), None, None, None, None)
+        self._user_transactions.setdefault(user_id, []).append(transaction_id)
+        self._log_change('transactions', transaction_id, 'insert')
+        self._insert_outbox(outbox)
+
+    async def get_transaction(self, transaction_id):
+        trans = self.transactions.get(transaction_id)
+        if trans is None and transaction_id in self._archived_month:
+            trans = self.archive[self._archived_month[transaction_id]][transaction_id]
+        return trans
+
+    async def set_transaction_phone(self, transaction_id, phone_number):
+        trans = self.transactions.get(transaction_id)
+        if trans:
+            self.transactions[transaction_id] = trans._replace(phone_number=phone_number)
+            self._log_change('transactions', transaction_id, 'update')
+
+    async def update_transaction_status(self, transaction_id, status, field, outbox=(), reviewer_id=None,
+                                        expected=None, credit_user=False):
+        if field not in STATUS_TIME_FIELDS:
+            raise ValueError(f"Unknown transaction time field: {field}")
+        trans = self.transactions.get(transaction_id)
+        if expected is not None and (trans is None or trans.status != expected):
+            return False
+        if not self._complete_review('transaction', transaction_id, reviewer_id):
+            return False
+        if trans:
+            self.transactions[transaction_id] = trans._replace(status=status, **{field: now_str()})
+            self._log_change('transactions', transaction_id, 'update')
+            if credit_user:
+                self._credit_user(trans.user_id, trans.amount)
+        self._insert_outbox(outbox)
+        return True
+
+    def _user_rows(self, user_id):
+        return (self.transactions[t] for t in self._user_transactions.get(user_id, ()))
+
+    async def get_transactions_today(self, user_id):
+        today = datetime.now().strftime('%Y-%m-%d')
+        return sum(1 for t in self._user_rows(user_id) if t.created_at.startswith(today))
+
+    def _archived_rows(self, user_id=None):
+        if user_id is None:
+            return (t for month in self.archive.values() for t in month.values())
+        return (self.archive[self._archived_month[t]][t] for t in self._user_archive.get(user_id, ()))
+
+    async def get_completed_transactions(self, user_id):
+        completed = [t.amount for t in self._user_rows(user_id) if t.status == 'completed']
+        archived_count, archived_total = self.archived_totals.get(user_id, (0, 0))
+        return len(completed) + archived_count, sum(completed) + archived_total
+
+    async def get_transaction_history(self, user_id, limit=10):
+        rows = itertools.chain(self._user_rows(user_id), self._archived_rows(user_id))
+        rows = sorted(rows, key=lambda t: t.created_at, reverse=True)[:limit]
+        return [(t.transaction_id, t.amount, t.package_name, t.status, t.created_at) for t in rows]
+
+    async def get_pending_orders(self):
+        return [(t.transaction_id, t.user_id, t.created_at) for t in self.transactions.values() if t.status == 'pending']
+
+    async def get_pending_transactions(self):
+        return sum(1 for t in self.transactions.values() if t.status == 'pending_review')
+
+    async def get_detailed_stats(self):
+        today = datetime.now().strftime("%Y-%m-%d")
+        week_start = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        today_rows = [t for t in self.transactions.values() if t.created_at.startswith(today)]
+        week_rows = [t for t in self.transactions.values() if t.created_at >= week_start]
+        statuses = [t.status for t in itertools.chain(self.transactions.values(), self._archived_rows())]
+        return {
+            'today_trans': len(today_rows),
+            'today_amount': sum(t.amount for t in today_rows) if today_rows else None,
+            'week_trans': len(week_rows),
+            'week_amount': sum(t.amount for t in week_rows) if week_rows else None,
+            'total_users': len(self.users),
+            'active_users_today': len({t.user_id for t in today_rows}),
+            'completed_trans': statuses.count('completed'),
+            'pending_review_trans': statuses.count('pending_review'),
+            'rejected_trans': statuses.count('rejected'),
+            'total_tickets': len(self.tickets),
+            'pending_tickets': sum(1 for t in self.tickets.values() if t.status == 'pending'),
+            'as_of': now_str(),
+        }
+
+    async def export_transactions(self):
+        return [(t.created_at, t.transaction_id, t.user_id, t.amount, t.status, t.phone_number, t.package_name)
+                for t in itertools.chain(self.transactions.values(), self._archived_rows())]
+
+    async def archive_transactions(self, before, batch_size=500):
+        rows = sorted((t for t in self.transactions.values()
+                       if t.status in ARCHIVABLE_STATUSES and t.created_at < before), key=lambda t: t.created_at)
+        for trans in rows:
+            month = archive_month(trans.created_at)
+            self.archive.setdefault(month, {})[trans.transaction_id] = trans
+            self._archived_month[trans.transaction_id] = month
+            self._user_archive.setdefault(trans.user_id, []).append(trans.transaction_id)
+            if trans.status == 'completed':
+                count, total = self.archived_totals.get(trans.user_id, (0, 0))
+                self.archived_totals[trans.user_id] = (count + 1, total + trans.amount)
+            del self.transactions[trans.transaction_id]
+            self._user_transactions[trans.user_id].remove(trans.transaction_id)
+            self._log_change('transactions', trans.transaction_id, 'delete')
+        return len(rows)
+
+    async def backup(self, filename):
+        data = {
+            'users': list(self.users.values()),
+            'transactions': list(self.transactions.values()),
+            'archive': {month: list(rows.values()) for month, rows in self.archive.items()},
+            'tickets': list(self.tickets.values()),
+            'ticket_replies': self.ticket_replies,
+            'prices': list(self.prices.values()),
+            'settings': self.settings,
+            'feedbacks': self.feedbacks,
+        }
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    # تیکت‌ها
+    async def add_ticket(self, ticket_id, user_id, message, outbox=()):
+        if ticket_id in self.tickets:
+            raise sqlite3.IntegrityError(f"UNIQUE constraint failed: tickets.ticket_id ({ticket_id})")
+        self.tickets[ticket_id] = Ticket(ticket_id, user_id, message, 'pending', now_str())
+        self._log_change('tickets', ticket_id, 'insert')
+        self._insert_outbox(outbox)
+
+    async def get_ticket(self, ticket_id):
+        return self.tickets.get(ticket_id)
+
+    async def add_ticket_reply(self, ticket_id, from_admin, message):
+        self.ticket_replies.append(TicketReply(len(self.ticket_replies) + 1, ticket_id, from_admin, message, now_str()))
+
+    async def update_ticket_status(self, ticket_id, status, outbox=(), reviewer_id=None, reply=None):
+        if not self._complete_review('ticket', ticket_id, reviewer_id):
+            return False
+        ticket = self.tickets.get(ticket_id)
+        if ticket:
+            self.tickets[ticket_id] = ticket._replace(status=status)
+            self._log_change('tickets', ticket_id, 'update')
+        if reply is not None:
+            await self.add_ticket_reply(ticket_id, *reply)
+        self._insert_outbox(outbox)
+        return True
+
+    async def get_pending_tickets(self):
+        return sum(1 for t in self.tickets.values() if t.status == 'pending')
+
+    async def get_tickets_page(self, statuses, before=None, limit=10):
+        rows = sorted((t for t in self.tickets.values() if t.status in statuses),
+                      key=lambda t: (t.created_at, t.ticket_id), reverse=True)
+        if before is not None:
+            cursor = self.tickets.get(before)
+            if cursor is None:
+                return []
+            rows = [t for t in rows if (t.created_at, t.ticket_id) < (cursor.created_at, cursor.ticket_id)]
+        return rows[:limit]
+
+    async def get_ticket_thread(self, ticket_id):
+        ticket = self.tickets.get(ticket_id)
+        if ticket is None:
+            return None
+        return ticket, [r for r in self.ticket_replies if r.ticket_id == ticket_id]
+
+    # قیمت‌ها
+    async def get_prices(self):
+        return list(self.prices.values())
+
+    async def add_price(self, package_name, amount, description):
+        existing = self.prices.get(package_name)
+        if existing:
+            self.prices[package_name] = existing._replace(amount=amount, description=description)
+        else:
+            package_id = max((p.package_id for p in self.prices.values()), default=0) + 1
+            self.prices[package_name] = Price(package_id, package_name, amount, description)
+
+    async def delete_price(self, package_name):
+        self.prices.pop(package_name, None)
+
+    async def replace_prices(self, rows):
+        names = {row[0] for row in rows}
+        for name in [name for name in self.prices if name not in names]:
+            del self.prices[name]
+        for package_name, amount, description in rows:
+            await self.add_price(package_name, amount, description)
+
+    # تنظیمات
+    async def get_settings(self):
+        return dict(self.settings)
+
+    async def set_setting(self, key, value):
+        self.settings[key] = str(value)
+
+    # بازخورد
+    async def add_feedback(self, user_id, rating, message):
+        self.feedbacks.append(Feedback(len(self.feedbacks) + 1, user_id, rating, message, now_str()))
+
+    # رسیدهای پرداخت
+    async def add_receipt(self, transaction_id, file_unique_id):
+        self.receipts[transaction_id] = Receipt(len(self.receipts) + 1, transaction_id, file_unique_id,
+                                                None, None, None, now_str())
+        self._receipt_index.setdefault(('file_unique_id', file_unique_id), []).append(transaction_id)
+
+    async def set_receipt_hashes(self, transaction_id, sha256, phash, path):
+        receipt = self.receipts.get(transaction_id)
+        if receipt:
+            self.receipts[transaction_id] = receipt._replace(sha256=sha256, phash=phash, path=path)
+            self._receipt_index.setdefault(('sha256', sha256), []).append(transaction_id)
+            if phash is not None:
+                for band in enumerate(phash_bands(phash)):
+                    self._receipt_index.setdefault(('phash', band), []).append(transaction_id)
+
+    async def find_duplicate_receipt(self, transaction_id, file_unique_id=None, sha256=None, phash=None,
+                                     max_distance=0):
+        if max_distance >= PHASH_BANDS:
+            raise ValueError(f"max_distance must be below {PHASH_BANDS}")
+        for column, value in (('file_unique_id', file_unique_id), ('sha256', sha256)):
+            if value is None:
+                continue
+            for other in self._receipt_index.get((column, value), ()):
+                if other != transaction_id:
+                    return other
+        if phash is None:
+            return None
+        candidates = {other for band in enumerate(phash_bands(phash))
+                      for other in self._receipt_index.get(('phash', band), ()) if other != transaction_id}
+        for other in sorted(candidates, key=lambda t: self.receipts[t].receipt_id):
+            if phash_distance(phash, self.receipts[other].phash) <= max_distance:
+                return other
+        return None
+
+    # صف پیام‌های خروجی: message_id -> [OutboxEntry, status, next_attempt_at, last_error]
+    def _insert_outbox(self, messages):
+        for m in messages:
+            message_id = self._next_outbox_id = self._next_outbox_id + 1
+            self.outbox[message_id] = [OutboxEntry(message_id, m.chat_id, m.method, m.payload, 0), 'pending', time.time(), None]
+        self._outbox_written(messages)
+
+    async def enqueue_messages(self, messages):
+        self._insert_outbox(messages)
+
+    async def get_due_messages(self, now, limit=100, after=0):
+        due = [entry for entry, status, next_attempt_at, _ in self.outbox.values()
+               if status == 'pending' and next_attempt_at <= now and entry.message_id > after]
+        return due[:limit]
+
+    async def delete_message(self, message_id):
+        self.outbox.pop(message_id, None)
+
+    async def reschedule_message(self, message_id, next_attempt_at, error):
+        row = self.outbox.get(message_id)
+        if row:
+            row[0] = row[0]._replace(attempts=row[0].attempts + 1)
+            row[2], row[3] = next_attempt_at, error
+
+    async def fail_message(self, message_id, error):
+        row = self.outbox.get(message_id)
+        if row:
+            row[0] = row[0]._replace(attempts=row[0].attempts + 1)
+            row[1], row[3] = 'failed', error
+
+    # صف بررسی مدیران
+    def _complete_review(self, item_type, item_id, reviewer_id):
+        if reviewer_id is None:
+            return True
+        claim = self.review_claims.get((item_type, item_id))
+        if claim is None or claim.reviewer_id != reviewer_id or claim.status != 'claimed':
+            return False
+        self.review_claims[(item_type, item_id)] = claim._replace(status='done', completed_at=time.time())
+        return True
+
+    async def claim_review(self, item_type, item_id, reviewer_id, now, lease_until, notice=None):
+        claim = self.review_claims.get((item_type, item_id))
+        claimed_at = now
+        if claim is not None:
+            if claim.status == 'claimed' and claim.reviewer_id == reviewer_id:
+                claimed_at = claim.claimed_at
+            elif not (claim.status == 'released' or (claim.status == 'claimed' and claim.lease_until < now)):
+                return False
+        method = notice.method if notice else (claim.method if claim else None)
+        payload = notice.payload if notice else (claim.payload if claim else None)
+        self.review_claims[(item_type, item_id)] = ReviewClaim(
+            item_type, item_id, reviewer_id, 'claimed', claimed_at, lease_until, None, method, payload)
+        return True
+
+    async def release_expired_reviews(self, now):
+        rows = [c for c in self.review_claims.values() if c.status == 'claimed' and c.lease_until < now]
+        for claim in rows:
+            self.review_claims[(claim.item_type, claim.item_id)] = claim._replace(status='released')
+        return rows
+
+    async def get_review_load(self):
+        load = {}
+        for claim in self.review_claims.values():
+            if claim.status == 'claimed':
+                load[claim.reviewer_id] = load.get(claim.reviewer_id, 0) + 1
+        return load
+
+    async def get_review_stats(self, since):
+        rows = {}
+        for claim in self.review_claims.values():
+            rows.setdefault(claim.reviewer_id, []).append(claim)
+        stats = []
+        for reviewer_id, claims in rows.items():
+            done = [c.completed_at - c.claimed_at for c in claims if c.status == 'done' and c.completed_at >= since]
+            stats.append(ReviewerStats(reviewer_id, len(done), sum(1 for c in claims if c.status == 'claimed'),
+                                       sum(done) / len(done) if done else None))
+        return stats
+
+    # فید تغییرات
+    def _current_row(self, table_name, row_key):
+        if table_name == 'transactions':
+            trans = self.transactions.get(row_key)
+            if trans is None and row_key in self._archived_month:
+                trans = self.archive[self._archived_month[row_key]][row_key]
+            return trans
+        if table_name == 'users':
+            return self.users.get(int(row_key))
+        return self.tickets.get(row_key)
+
+    async def get_changes(self, after=0, limit=500):
+        # ردیف‌ها به ترتیب seq هستند؛ [after + 1] پیش از هر ردیف با همان seq قرار می‌گیرد
+        start = bisect.bisect_left(self.change_log, [after + 1])
+        entries = self.change_log[start:start + limit]
+        if not entries:
+            return [], after
+        latest = {(table, key): seq for seq, table, key, _, _ in entries}
+        changes = sorted((Change(seq, table, key, self._current_row(table, key)) for (table, key), seq in latest.items()),
+                         key=lambda c: c.seq)
+        return changes, entries[-1][0]
+
+    async def compact_changes(self, before):
+        newest = {}
+        for seq, table, key, _, _ in self.change_log:
+            newest[(table, key)] = seq
+        kept = [e for e in self.change_log if e[4] >= before or newest[(e[1], e[2])] == e[0]]
+        removed = len(self.change_log) - len(kept)
+        self.change_log = kept
+        return removed
+
+    # بخش‌های مخاطبان
+    async def refresh_segments(self, segments, now=None):
+        now = now or now_str()
+        signature = segments_signature(segments)
+        full = self.settings.get('segments_signature') != signature
+        if full:
+            self.segment_members = {}
+            candidates = set(self.users)
+        else:
+            start = bisect.bisect_left(self.change_log, [int(self.settings.get('segments_cursor', 0)) + 1])
+            candidates = set()
+            for _, table, key, _, _ in self.change_log[start:]:
+                row = self._current_row(table, key) if table != 'tickets' else None
+                if row is not None:
+                    candidates.add(row.user_id)
+            candidates.update(user_id for members in self.segment_members.values()
+                              for user_id, expires in members.items() if expires is not None and expires <= now)
+        for name, segment in segments.items():
+            members = self.segment_members.setdefault(name, {})
+            for user_id in candidates:
+                members.pop(user_id, None)
+                user = self.users.get(user_id)
+                if user is None:
+                    continue
+                rows = list(itertools.chain(self._user_rows(user_id), self._archived_rows(user_id)))
+                matched, expires = segment.matches(user, rows, now)
+                if matched:
+                    members[user_id] = expires
+        self.settings['segments_cursor'] = str(self.change_log[-1][0] if self.change_log else 0)
+        self.settings['segments_signature'] = signature
+        return len(candidates)
+
+    async def get_segment_members(self, name, after=0, limit=1000, now=None):
+        now = now or now_str()
+        members = self.segment_members.get(name, {})
+        return sorted(u for u, expires in members.items() if u > after and (expires is None or expires > now))[:limit]
+
+    async def get_segment_sizes(self, now=None):
+        now = now or now_str()
+        sizes = {name: sum(1 for expires in members.values() if expires is None or expires > now)
+                 for name, members in self.segment_members.items()}
+        return {name: size for name, size in sizes.items() if size}
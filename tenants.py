@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from telegram.ext import JobQueue
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# تنظیمات هر نمونه‌ی منطقه‌ای ربات؛ داده‌های هر Tenant در data_dir خودش جداست
+Tenant = namedtuple(
+    'Tenant',
+    'name token admin_id reviewer_ids bank_card channel_id db_path archive_db_path snapshot_db_path receipts_dir',
+)
+
+
+def load_tenants(path):
+    # قالب فایل: {"tenants": [{"name": ..., "token": ..., "admin_id": ..., "bank_card": ..., "channel_id": ...,
+    #   "reviewer_ids": [...], "data_dir": ...}, ...]}؛ مسیرهای دیتابیس و رسیدها به‌طور پیش‌فرض زیر data_dir
+    #   و بایگانی بدون archive_db_path در همان bot.db
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)['tenants']
+    tenants = []
+    for entry in entries:
+        name = entry['name']
+        data_dir = entry.get('data_dir', name)
+        admin_id = int(entry['admin_id'])
+        tenants.append(Tenant(
+            name=name,
+            token=entry['token'],
+            admin_id=admin_id,
+            reviewer_ids=tuple(int(i) for i in entry.get('reviewer_ids', (admin_id,))),
+            bank_card=entry['bank_card'],
+            channel_id=entry['channel_id'],
+            db_path=entry.get('db_path', os.path.join(data_dir, 'bot.db')),
+            archive_db_path=entry.get('archive_db_path', ''),
+            snapshot_db_path=entry.get('snapshot_db_path', os.path.join(data_dir, 'snapshot.db')),
+            receipts_dir=entry.get('receipts_dir', os.path.join(data_dir, 'receipts')),
+        ))
+    names = [t.name for t in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate tenant names in {path}")
+    paths = [t.db_path for t in tenants]
+    if len(set(paths)) != len(paths):
+        raise ValueError(f"Tenants in {path} must not share a database")
+    for tenant in tenants:
+        for directory in {os.path.dirname(tenant.db_path), tenant.receipts_dir}:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+    return tenants
+
+
+class SharedHTTPXRequest(metrics.InstrumentedHTTPXRequest):
+    # یک Connection pool برای همه‌ی Botها؛ هر Bot هنگام initialize/shutdown آن را می‌گیرد و رها می‌کند و
+    # اتصال‌ها فقط با رها شدن آخرین استفاده‌کننده بسته می‌شوند
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._users = 0
+
+    async def initialize(self):
+        self._users += 1
+        await super().initialize()
+
+    async def shutdown(self):
+        self._users -= 1
+        if self._users <= 0:
+            self._users = 0
+            await super().shutdown()
+
+
+class SharedJobQueue(JobQueue):
+    # Jobهای همه‌ی Tenantها روی یک AsyncIOScheduler اجرا می‌شوند؛ هر Job همچنان با JobQueue و
+    # Application خودش فراخوانی می‌شود و jobs() فقط Jobهای همین Tenant را برمی‌گرداند
+    __slots__ = ("_users",)
+
+    def __init__(self, owner=None):
+        super().__init__()
+        if owner is None:
+            self._users = [0]
+        else:
+            self.scheduler, self._executor, self._users = owner.scheduler, owner._executor, owner._users
+
+    def jobs(self):
+        return tuple(job.args[1] for job in self.scheduler.get_jobs() if job.args[0] is self)
+
+    async def start(self):
+        self._users[0] += 1
+        await super().start()
+
+    async def stop(self, wait=True):
+        self._users[0] -= 1
+        if self._users[0] > 0:
+            # Scheduler برای بقیه‌ی Tenantها روشن می‌ماند؛ فقط Jobهای همین Tenant برداشته می‌شوند
+            for job in self.jobs():
+                job.schedule_removal()
+            return
+        await super().stop(wait)
+
+
+class SharedResources:
+    # منابعی که همه‌ی Tenantهای یک Process به اشتراک می‌گذارند: Connection pool تلگرام، Threadهای
+    # SQLite (هر مخزن همچنان اتصال و قفل خودش را دارد) و Scheduler؛ متریک‌ها در metrics.REGISTRY مشترک‌اند
+    def __init__(self, connection_pool_size=256, db_workers=4):
+        self.request = SharedHTTPXRequest(connection_pool_size=connection_pool_size)
+        self.db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="sqlite")
+        self.snapshot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-snapshot")
+        self._scheduler_owner = SharedJobQueue()
+
+    def job_queue(self):
+        return SharedJobQueue(self._scheduler_owner)
+
+    def close(self):
+        self.db_executor.shutdown(wait=True)
+        self.snapshot_executor.shutdown(wait=True)
+
+
+async def run_applications(applications, start=None, stop=None):
+    # همان چرخه‌ی Application.run_polling برای چند Application در یک حلقه؛ start/stop برای سرویس‌های
+    # سطح Process پیش و پس از همه‌ی Tenantها فراخوانی می‌شوند
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    # راه‌اندازی موازی: زمان شروع برابر کندترین Tenant است نه مجموع همه
+    await asyncio.gather(*(application.initialize() for application in applications))
+    await asyncio.gather(*(application.post_init(application) for application in applications
+                           if application.post_init))
+    services = await start() if start else None
+    try:
+        for application in applications:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            await application.start()
+        logger.info("Serving %s tenants", len(applications))
+        await stop_event.wait()
+    finally:
+        for application in applications:
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+        if stop:
+            await stop(services)
+        for application in applications:
+            if application.post_stop:
+                await application.post_stop(application)
+        for application in applications:
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
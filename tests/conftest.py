@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+# ماژول‌های ربات در ریشه‌ی مخزن هستند، نه در یک پکیج
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main هنگام import مقدار ADMIN_ID را به عدد تبدیل می‌کند
+os.environ.setdefault("ADMIN_ID", "1")
+
+
+class FakeClock:
+    # جایگزین time.monotonic/time.time؛ تست‌ها زمان را با now جلو می‌برند
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeMessage:
+    def __init__(self, text=None, photo=None, message_id=1, caption=None):
+        self.text = text
+        self.photo = photo
+        self.message_id = message_id
+        self.caption = caption
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeQuery:
+    def __init__(self, data, message, query_id=None):
+        self.id = query_id
+        self.data = data
+        self.message = message
+        self.answers = []
+        self.captions = []
+        self.texts = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+    async def edit_message_caption(self, caption, **kwargs):
+        self.captions.append(caption)
+
+    async def edit_message_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+def fake_update(user_id=5, text=None, photo=None, data=None, message_id=1, caption=None, update_id=0,
+                callback_id=None, **extra):
+    # با data یا callback_id یک CallbackQuery روی پیام message_id، وگرنه یک پیام متنی/تصویری
+    if data is not None or callback_id is not None:
+        query = FakeQuery(data, FakeMessage(message_id=message_id, caption=caption), callback_id)
+        message = None
+    else:
+        query = None
+        message = FakeMessage(text, photo, message_id, caption)
+    return types.SimpleNamespace(update_id=update_id, effective_user=types.SimpleNamespace(id=user_id),
+                                 message=message, callback_query=query,
+                                 effective_message=message or query.message, **extra)
+
+
+def fake_context(bot_data, bot=None, args=()):
+    return types.SimpleNamespace(bot_data=bot_data, bot=bot, args=list(args))
+
+
+@pytest.fixture
+def run():
+    return asyncio.run
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def make_update():
+    return fake_update
+
+
+@pytest.fixture
+def make_context():
+    return fake_context
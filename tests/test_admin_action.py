@@ -0,0 +1,45 @@
+import main
+from events import EventBus
+from reviews import ReviewQueue
+from storage import MemoryStorage
+
+
+class StaleReadStorage(MemoryStorage):
+    # اولین خواندن وضعیت قبل از نوشتن مدیر دیگر را برمی‌گرداند (مسابقه‌ی دو مدیر)
+    def __init__(self):
+        super().__init__()
+        self.stale = None
+
+    async def get_transaction(self, transaction_id):
+        if self.stale is not None:
+            stale, self.stale = self.stale, None
+            return stale
+        return await super().get_transaction(transaction_id)
+
+
+
+async def press(make_update, make_context, action, setup):
+    storage = StaleReadStorage()
+    await storage.add_user(5, "alice")
+    await storage.add_transaction("TX1", 5, 1000, "pkg")
+    await storage.submit_payment("TX1")
+    await setup(storage)
+    bot_data = {'storage': storage, 'review_queue': ReviewQueue(storage, (1, 2)), 'events': EventBus(None)}
+    update = make_update(1, data=f"{action}_TX1", caption="order")
+    await main.handle_admin_action(update, make_context(bot_data))
+    return update.callback_query.captions
+
+
+def test_lost_race_shows_current_status(run, make_update, make_context):
+    async def approved_by_other_admin(storage):
+        storage.stale = await storage.get_transaction("TX1")
+        await storage.update_transaction_status("TX1", "completed", "completed_at", expected="pending_review")
+
+    assert run(press(make_update, make_context, "reject", approved_by_other_admin)) == ["order\n\n✅ قبلاً تایید شده است"]
+
+
+def test_claim_held_by_other_reviewer(run, make_update, make_context):
+    async def claimed_by_other_reviewer(storage):
+        await storage.claim_review('transaction', "TX1", 2, 0, float('inf'))
+
+    assert run(press(make_update, make_context, "approve", claimed_by_other_reviewer)) == ["order\n\n⚠️ به مدیر دیگری سپرده شده است"]
@@ -0,0 +1,71 @@
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+from antiflood import THROTTLE_NOTICE, FloodGuard
+
+
+def guard(clock, **kwargs):
+    return FloodGuard(rate=1.0, burst=2, cooldown=5.0, duplicate_window=1.0, menu=("💰 تعرفه‌ها",),
+                      expensive=("/history",), exempt=(1,), clock=clock, **kwargs)
+
+
+def test_bucket_limits_menu_commands_and_callbacks_only(clock, make_update):
+    flood = guard(clock)
+    assert flood.check(make_update(text="💰 تعرفه‌ها")) is None
+    assert flood.check(make_update(data="pkg_1", message_id=2)) is None
+    assert flood.check(make_update(text="/start")) == "rate_limited"
+    # رسید، شماره تلفن و متن تیکت از سطل مستثنا هستند
+    assert flood.check(make_update(photo=["p"])) is None
+    assert flood.check(make_update(text="09123456789")) is None
+    assert flood.check(make_update(text="my ticket text")) is None
+    assert flood.check(make_update(user_id=1, text="/start")) is None
+    clock.now += 1
+    assert flood.check(make_update(text="💰 تعرفه‌ها")) is None
+
+
+def test_duplicate_callback_and_cooldown(clock, make_update):
+    flood = guard(clock)
+    assert flood.check(make_update(data="approve_TX1")) is None
+    assert flood.check(make_update(data="approve_TX1")) == "duplicate_callback"
+    clock.now += 10
+    assert flood.check(make_update(text="/history")) is None
+    clock.now += 1
+    assert flood.check(make_update(text="/history")) == "cooldown"
+
+
+def test_dropped_message_gets_one_notice_until_admitted(run, clock, make_update):
+    flood = guard(clock)
+
+    async def send(u):
+        try:
+            await flood.filter_update(u, None)
+        except ApplicationHandlerStop:
+            return "dropped"
+        return "passed"
+
+    async def scenario():
+        updates = [make_update(text="/start") for _ in range(4)]
+        results = [await send(u) for u in updates]
+        clock.now += 1
+        results.append(await send(make_update(text="/start")))
+        later = make_update(text="/start")
+        results.append(await send(later))
+        query = make_update(data="pkg_1", message_id=9)
+        results.append(await send(query))
+        return results, [u.message.replies for u in updates], later.message.replies, query.callback_query.answers
+
+    results, replies, later, answers = run(scenario())
+    assert results == ["passed", "passed", "dropped", "dropped", "passed", "dropped", "dropped"]
+    assert replies == [[], [], [THROTTLE_NOTICE], []]
+    # پس از پذیرفته شدن یک Update، رد بعدی دوباره اطلاع داده می‌شود
+    assert later == [THROTTLE_NOTICE]
+    assert answers == [THROTTLE_NOTICE]
+
+
+@pytest.mark.parametrize("idle", [True, False])
+def test_prune_forgets_idle_users(clock, make_update, idle):
+    flood = guard(clock, idle_ttl=60)
+    flood.check(make_update(text="/start"))
+    clock.now += 120 if idle else 10
+    flood.prune(clock.now)
+    assert (5 in flood._buckets) is not idle
@@ -0,0 +1,142 @@
+import io
+
+import pytest
+
+import main
+from events import EventBus
+from catalog import Catalog, CatalogRow, catalog_csv, diff_catalog, format_tiers, parse_catalog_csv, parse_tiers
+from storage import MemoryStorage, Price
+from user_state import UserStateStore
+
+
+@pytest.mark.parametrize("spec, tiers", [
+    ("", ((0, 0),)),
+    ("10:10", ((0, 0), (10, 10))),
+    ("25:15, 10:10", ((0, 0), (10, 10), (25, 15))),
+    ("0:5,10:10", ((0, 5), (10, 10))),
+])
+def test_parse_format_round_trip(spec, tiers):
+    assert parse_tiers(spec) == tiers
+    assert parse_tiers(format_tiers(tiers)) == tiers
+
+
+def test_default_tier_is_not_written():
+    assert format_tiers(parse_tiers("10:10,25:15")) == "10:10,25:15"
+    assert format_tiers(parse_tiers("0:5")) == "0:5"
+
+
+@pytest.mark.parametrize("spec", ["-1:5", "10:-5", "10:100", "10:150", "10", "a:5", "10:5:3"])
+def test_parse_tiers_rejects_invalid_tiers(spec):
+    with pytest.raises(ValueError):
+        parse_tiers(spec)
+
+
+def test_change_discount_tiers_reports_error(run, make_update, make_context):
+    async def scenario():
+        storage = MemoryStorage()
+        bot_data = {'storage': storage, 'tenant': main.default_tenant()}
+        await main.refresh_catalog(bot_data)
+        update = make_update(1)
+        await main.change_discount_tiers(update, make_context(bot_data, args=["10:10,25:120"]))
+        return update.message.replies, (await storage.get_settings()).get('discount_tiers')
+
+    replies, stored = run(scenario())
+    assert "25:120" in replies[0] and "بین 0 و 99" in replies[0]
+    assert stored is None
+
+
+def test_parse_catalog_csv_normalizes_amounts():
+    lines = ["package_name,amount,description", "اینترنت 5GB,\"۱۲٬۵۰۰\",ماهانه", "", "شارژ 50,50"]
+    rows, errors = parse_catalog_csv(lines)
+    assert errors == []
+    assert rows == [CatalogRow("اینترنت 5GB", 12500, "ماهانه"), CatalogRow("شارژ 50", 50, "")]
+
+
+@pytest.mark.parametrize("line, error", [
+    ("pkg", "تعداد ستون‌ها کم است"),
+    (",1000,x", "نام بسته خالی است"),
+    ("pkg,ten,x", "عدد صحیح مثبت نیست"),
+    ("pkg,0,x", "عدد صحیح مثبت نیست"),
+    ("pkg,-5,x", "عدد صحیح مثبت نیست"),
+    ("a,1000,x", "تکراری است"),
+])
+def test_parse_catalog_csv_rejects_malformed_rows(line, error):
+    rows, errors = parse_catalog_csv(["package_name,amount,description", "a,1000,x", line])
+    assert len(errors) == 1 and errors[0].startswith("سطر 3:") and error in errors[0]
+
+
+def test_parse_catalog_csv_checks_header_and_caps_errors():
+    assert parse_catalog_csv(["name,price", "a,1"])[1] == ["سطر 1: ستون‌ها باید package_name,amount,description باشند"]
+    _, errors = parse_catalog_csv(["package_name,amount,description"] + [f"p{i},x" for i in range(50)], max_errors=5)
+    assert len(errors) == 5
+
+
+def test_diff_catalog():
+    packages = [Price(1, "a", 100, "x"), Price(2, "b", 200, None), Price(3, "c", 300, "")]
+    rows = [CatalogRow("a", 100, "x"), CatalogRow("b", 250, ""), CatalogRow("d", 400, "")]
+    diff = diff_catalog(packages, rows)
+    assert diff.added == [CatalogRow("d", 400, "")]
+    assert diff.changed == [(packages[1], rows[1])]
+    assert diff.removed == [packages[2]]
+
+
+def test_csv_export_round_trip():
+    packages = [Price(1, "اینترنت 5GB", 12500, "ماهانه, نامحدود"), Price(2, "شارژ 50", 50, None)]
+    out = io.StringIO()
+    catalog_csv(packages, out)
+    rows, errors = parse_catalog_csv(io.StringIO(out.getvalue()))
+    assert errors == [] and diff_catalog(packages, rows) == ([], [], [])
+
+
+def test_catalog_import_rejects_stale_preview(run, make_update, make_context):
+    async def scenario():
+        storage = MemoryStorage()
+        await storage.add_price("a", 100, "x")
+        bot_data = {'storage': storage, 'tenant': main.default_tenant(), 'user_state': UserStateStore()}
+        await main.refresh_catalog(bot_data)
+        bot_data['user_state'].get(1)['catalog_import'] = (bot_data['catalog'].version, [CatalogRow("b", 200, "")])
+        # قیمت پس از پیش‌نمایش تغییر کرده است
+        await storage.add_price("a", 150, "x")
+        await main.refresh_catalog(bot_data)
+        update = make_update(1, data="catalog_import_apply")
+        update.callback_query.message.text = "preview"
+        await main.handle_catalog_import(update, make_context(bot_data))
+        return update.callback_query.texts, [p.package_name for p in await storage.get_prices()]
+
+    texts, names = run(scenario())
+    assert "تغییر کرده است" in texts[0] and names == ["a"]
+
+
+def test_package_token_is_versioned():
+    catalog = Catalog([Price(1, "a", 100, "x"), Price(2, "b", 200, "")])
+    token = catalog.token(catalog.by_id[2])
+    assert len(token.encode("utf-8")) <= 64
+    assert catalog.resolve(token) == catalog.by_id[2]
+    assert Catalog(catalog.packages).resolve(token) == catalog.by_id[2]
+    repriced = Catalog([Price(1, "a", 120, "x"), Price(2, "b", 200, "")])
+    assert repriced.version != catalog.version and repriced.resolve(token) is None
+    assert Catalog(catalog.packages, {'discount_tiers': "5:10"}).resolve(token) is None
+    for data in ("pkg_", "pkg_x", f"pkg_{catalog.version}_x", f"pkg_{catalog.version}_9"):
+        assert catalog.resolve(data) is None
+
+
+def test_stale_package_button_after_version_bump(run, make_update, make_context):
+    async def scenario():
+        storage = MemoryStorage()
+        await storage.add_price("اینترنت 5GB", 100, "x")
+        bot_data = {'storage': storage, 'tenant': main.default_tenant(), 'user_state': UserStateStore(),
+                    'events': EventBus(None)}
+        await main.refresh_catalog(bot_data)
+        token = bot_data['catalog'].token(bot_data['catalog'].packages[0])
+        await storage.add_price("اینترنت 5GB", 150, "x")
+        await main.refresh_catalog(bot_data)
+        update = make_update(5, data=token)
+        await main.handle_callback(update, make_context(bot_data))
+        stale = await storage.get_transaction_history(5)
+        fresh = make_update(5, data=bot_data['catalog'].token(bot_data['catalog'].packages[0]))
+        await main.handle_callback(fresh, make_context(bot_data))
+        return update.callback_query.texts, stale, [t.amount for t in storage.transactions.values()]
+
+    texts, stale, amounts = run(scenario())
+    assert "به‌روزرسانی شده" in texts[0] and not stale
+    assert amounts == [150]
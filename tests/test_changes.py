@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+import main
+from storage import MemoryStorage, SQLiteStorage
+
+
+class DocumentBot:
+    # محتوای فایل را هنگام ارسال می‌خواند؛ فایل پس از ارسال حذف می‌شود
+    def __init__(self):
+        self.documents = []
+
+    async def send_document(self, chat_id, document, caption, parse_mode=None):
+        self.documents.append([json.loads(line) for line in document.read().decode("utf-8").splitlines()])
+
+
+async def open_storage(kind, tmp_path):
+    if kind == "memory":
+        return MemoryStorage()
+    storage = SQLiteStorage(str(tmp_path / "bot.db"))
+    await storage.init()
+    return storage
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_change_feed_cursor(run, tmp_path, kind):
+    async def scenario():
+        storage = await open_storage(kind, tmp_path)
+        try:
+            await storage.add_user(1, "alice")
+            await storage.add_transaction("TX1", 1, 1000, "pkg")
+            await storage.update_transaction_status("TX1", "completed", "completed_at")
+            batches = [[(c.table_name, c.row_key) for c in changes]
+                       async for changes, _ in storage.iter_changes(0, 1)]
+            changes, cursor = await storage.get_changes(0)
+            empty = await storage.get_changes(cursor)
+            await storage.add_transaction("TX2", 1, 500, "pkg")
+            later, _ = await storage.get_changes(cursor)
+            return batches, [(c.table_name, c.row_key, c.row.status if c.table_name == "transactions" else None)
+                             for c in changes], empty == ([], cursor), [c.row_key for c in later]
+        finally:
+            await storage.close()
+
+    batches, changes, empty, later = run(scenario())
+    # دو تغییر TX1 در یک دسته یک بار و با آخرین وضعیت می‌آیند
+    assert changes == [("users", "1", None), ("transactions", "TX1", "completed")]
+    assert [key for batch in batches for key in batch] == [("users", "1"), ("transactions", "TX1"), ("transactions", "TX1")]
+    assert empty and later == ["TX2"]
+
+
+def test_export_changes_resumes_from_saved_cursor(run, tmp_path, monkeypatch, make_update, make_context):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario():
+        storage = MemoryStorage()
+        bot = DocumentBot()
+        bot_data = {'storage': storage, 'tenant': main.default_tenant()}
+        await storage.add_user(1, "alice")
+        await storage.add_transaction("TX1", 1, 1000, "pkg")
+        await main.export_changes(make_update(1), make_context(bot_data, bot))
+        idle = make_update(1)
+        await main.export_changes(idle, make_context(bot_data, bot))
+        await storage.add_transaction("TX2", 1, 500, "pkg")
+        await main.export_changes(make_update(1), make_context(bot_data, bot))
+        return bot.documents, idle.message.replies, (await storage.get_settings())['changes_cursor']
+
+    documents, replies, cursor = run(scenario())
+    assert [[row["key"] for row in document] for document in documents] == [["1", "TX1"], ["TX2"]]
+    assert documents[1][0]["row"]["amount"] == 500
+    assert len(replies) == 1 and int(cursor) == documents[1][0]["seq"]
+    assert list(tmp_path.iterdir()) == []
+
+
+class CsvBot:
+    def __init__(self):
+        self.rows = []
+
+    async def send_document(self, chat_id, document, caption, parse_mode=None):
+        self.rows = document.read().decode("utf-8-sig").splitlines()
+
+
+def test_export_transactions_sends_csv(run, tmp_path, monkeypatch, make_update, make_context):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario():
+        storage = MemoryStorage()
+        bot = CsvBot()
+        await storage.add_user(1, "alice")
+        await storage.add_transaction("TX1", 1, 1000, "pkg")
+        await main.export_transactions(make_update(1), make_context({'storage': storage, 'tenant': main.default_tenant()}, bot))
+        return bot.rows
+
+    rows = run(scenario())
+    assert len(rows) == 2 and "TX1" in rows[1]
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,21 @@
+from idempotency import IdempotencyGuard
+
+
+def test_redelivered_updates_and_callbacks_are_detected(clock, make_update):
+    guard = IdempotencyGuard(clock=clock)
+    assert guard.check(make_update(update_id=1, callback_id="cb1")) is None
+    assert guard.check(make_update(update_id=1, callback_id="cb1")) == "redelivered_update"
+    # همان Callback با update_id تازه (تحویل دوباره پس از Webhook)
+    assert guard.check(make_update(update_id=2, callback_id="cb1")) == "redelivered_callback"
+    assert guard.check(make_update(update_id=3)) is None
+
+
+def test_keys_are_bounded_by_ttl_and_size(clock, make_update):
+    guard = IdempotencyGuard(max_keys=3, ttl=10, clock=clock)
+    for update_id in range(5):
+        guard.check(make_update(update_id=update_id))
+    assert len(guard) == 3
+    assert guard.check(make_update(update_id=0)) is None
+    clock.now = 20
+    assert guard.check(make_update(update_id=4)) is None
+    assert len(guard) == 1
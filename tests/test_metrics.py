@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+import main
+import metrics
+
+
+@pytest.mark.parametrize("sql, label", [
+    ("SELECT * FROM users WHERE user_id = ?", "SELECT users"),
+    ("\n  select amount from archive.transactions_2024_05", "SELECT archive.transactions"),
+    ("INSERT OR IGNORE INTO outbox (chat_id) VALUES (?)", "INSERT outbox"),
+    ("UPDATE OR REPLACE settings SET value = ?", "UPDATE settings"),
+    ("DELETE FROM change_log WHERE seq < ?", "DELETE change_log"),
+    ("PRAGMA journal_mode = WAL", "PRAGMA"),
+])
+def test_statement_label(sql, label):
+    assert metrics.statement_label(sql) == label
+
+
+def test_queries_are_labelled_by_statement():
+    conn = sqlite3.connect(":memory:", factory=metrics.InstrumentedConnection)
+    before = metrics.DB_CALLS.value("INSERT metrics_probe"), metrics.DB_ERRORS.value("SELECT missing_table")
+    conn.execute("CREATE TABLE metrics_probe (x)")
+    conn.cursor().executemany("INSERT INTO metrics_probe VALUES (?)", [(1,), (2,)])
+    conn.execute("INSERT INTO metrics_probe VALUES (3)")
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("SELECT * FROM missing_table")
+    conn.close()
+    after = metrics.DB_CALLS.value("INSERT metrics_probe"), metrics.DB_ERRORS.value("SELECT missing_table")
+    assert (after[0] - before[0], after[1] - before[1]) == (2, 1)
+
+
+class DocumentBot:
+    def __init__(self):
+        self.documents = []
+
+    async def send_document(self, chat_id, document, filename, caption, parse_mode=None):
+        self.documents.append((chat_id, filename, document.decode("utf-8")))
+
+
+@pytest.mark.parametrize("lines, as_document", [(10, False), (500, True)])
+def test_long_summary_is_sent_as_document(run, monkeypatch, make_update, make_context, lines, as_document):
+    summary = "\n".join(f"  handler:menu_{i}: 0.01 | 1 | 1.0 | 1 | 0" for i in range(lines))
+    monkeypatch.setattr(metrics, "summary", lambda: summary)
+    bot = DocumentBot()
+    update = make_update(1)
+    run(main.metrics_summary(update, make_context({'tenant': main.default_tenant()}, bot)))
+    replies = update.message.replies
+    assert all(len(reply) <= 4096 for reply in replies)
+    if as_document:
+        assert bot.documents == [(1, "metrics.txt", summary)] and replies == []
+    else:
+        assert bot.documents == [] and summary in replies[0]
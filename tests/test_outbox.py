@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter, TelegramError
+
+from outbox import OutboxDispatcher, outbox_message
+from storage import MemoryStorage
+
+
+class ScriptedBot:
+    # خطاهای از پیش تعیین‌شده برای هر متن پیام؛ پیام‌های موفق به ترتیب ارسال ثبت می‌شوند
+    def __init__(self, errors=None):
+        self.errors = dict(errors or {})
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        error = self.errors.pop(text, None)
+        if error is not None:
+            raise error
+        self.sent.append((chat_id, text))
+
+
+def dispatcher(storage, bot, **kwargs):
+    options = dict(workers=2, poll_interval=0.01, per_chat_interval=0, global_rate=1000.0)
+    options.update(kwargs)
+    return OutboxDispatcher(storage, bot, **options)
+
+
+async def status(storage, message_id):
+    entry, state, next_attempt_at, _ = storage.outbox[message_id]
+    return state, entry.attempts, next_attempt_at
+
+
+def test_retry_after_pauses_dispatch(run):
+    async def scenario():
+        storage = MemoryStorage()
+        await storage.enqueue_messages([outbox_message(7, text="a")])
+        outbox = dispatcher(storage, ScriptedBot({"a": RetryAfter(30)}))
+        entry, = await storage.get_due_messages(time.time())
+        await outbox._deliver(entry)
+        return outbox._paused_until - time.monotonic(), await status(storage, entry.message_id)
+
+    paused, (state, attempts, next_attempt_at) = run(scenario())
+    assert 29 < paused <= 30
+    assert (state, attempts) == ("pending", 1)
+    assert next_attempt_at > time.time() + 29
+
+
+def test_pending_retry_keeps_chat_order_without_starving_others(run):
+    async def scenario():
+        storage = MemoryStorage()
+        # چت 7: پیام اول خطا می‌دهد و سه پیام بعدی پشت آن می‌مانند؛ صفحه‌ی اول کاملاً از چت 7 است
+        await storage.enqueue_messages([outbox_message(7, text=f"a{i}") for i in range(4)])
+        await storage.enqueue_messages([outbox_message(8, text="b")])
+        bot = ScriptedBot({"a0": TelegramError("boom")})
+        outbox = dispatcher(storage, bot, batch_size=2)
+        await outbox.start()
+        try:
+            for _ in range(100):
+                if bot.sent:
+                    break
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+        finally:
+            await outbox.stop()
+        return bot.sent, await status(storage, 1)
+
+    sent, (state, attempts, _) = run(scenario())
+    assert sent == [(8, "b")]
+    assert (state, attempts) == ("pending", 1)
+
+
+def test_fail_message_after_max_attempts(run):
+    async def scenario():
+        storage = MemoryStorage()
+        await storage.enqueue_messages([outbox_message(7, text="a"), outbox_message(7, text="b")])
+        outbox = dispatcher(storage, ScriptedBot({"a": TelegramError("boom")}), max_attempts=3)
+        first, second = await storage.get_due_messages(time.time())
+        await storage.reschedule_message(first.message_id, 0, "boom")
+        await storage.reschedule_message(first.message_id, 0, "boom")
+        first, _ = await storage.get_due_messages(time.time())
+        await outbox._deliver(first)
+        return await status(storage, first.message_id), outbox._blocked(second)
+
+    (state, attempts, _), blocked = run(scenario())
+    assert (state, attempts) == ("failed", 3)
+    assert not blocked
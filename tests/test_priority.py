@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+import metrics
+from priority import PriorityUpdateProcessor
+
+
+async def record(order, tag, gate=None):
+    if gate is not None:
+        await gate.wait()
+    order.append(tag)
+
+
+async def flood(processor, updates, order, gate):
+    # اولین Update اجرا و پشت gate نگه داشته می‌شود تا بقیه در صف بمانند
+    tasks = []
+    for i, (u, tag) in enumerate(updates):
+        tasks.append(asyncio.create_task(processor.process_update(u, record(order, tag, gate if i == 0 else None))))
+        await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(*tasks)
+
+
+def processor(**kwargs):
+    return PriorityUpdateProcessor(lambda u: u.cls, label=lambda name: f"test:{name}", **kwargs)
+
+
+def test_weighted_fair_queuing_order(run, make_update):
+    async def scenario():
+        order = []
+        updates = [(make_update(100, cls="browsing"), "b0")]
+        updates += [(make_update(100 + i, cls="browsing"), f"b{i}") for i in range(1, 5)]
+        updates += [(make_update(200 + i, cls="payment"), f"p{i}") for i in range(2)]
+        updates += [(make_update(300, cls="admin"), "a")]
+        p = processor()
+        await flood(p, updates, order, asyncio.Event())
+        return order, p.backlog(), p._active
+
+    order, backlog, active = run(scenario())
+    # مدیر و پرداخت از سیل browsing جلو می‌زنند ولی browsing هم نوبت می‌گیرد
+    assert order[:4] == ["b0", "a", "p0", "p1"]
+    assert sorted(order[4:]) == ["b1", "b2", "b3", "b4"]
+    assert (backlog, active) == (0, 0)
+
+
+def test_user_updates_keep_arrival_order(run, make_update):
+    async def scenario():
+        order = []
+        updates = [(make_update(1, cls="browsing"), "first"), (make_update(2, cls="browsing"), "other"),
+                   (make_update(2, cls="browsing"), "menu"), (make_update(2, cls="payment"), "receipt")]
+        await flood(processor(), updates, order, asyncio.Event())
+        return order
+
+    # رسید کاربر ۲ در کلاس Update قبلی او می‌ماند و از آن جلو نمی‌زند
+    order = run(scenario())
+    assert order.index("menu") < order.index("receipt")
+
+
+def test_browsing_is_shed_above_threshold(run, make_update):
+    async def scenario():
+        order = []
+        shed = make_update(10, cls="browsing", data="pkg_1")
+        payment = make_update(11, cls="payment")
+        updates = [(make_update(i, cls="browsing"), f"b{i}") for i in range(4)] + [(shed, "shed"), (payment, "payment")]
+        before = metrics.DROPPED_UPDATES.value("shed:browsing")
+        await flood(processor(shed_threshold=3), updates, order, asyncio.Event())
+        return order, shed.callback_query.answers, metrics.DROPPED_UPDATES.value("shed:browsing") - before
+
+    order, answers, dropped = run(scenario())
+    assert "shed" not in order and "payment" in order
+    assert dropped == 1 and len(answers) == 1
+
+
+def test_cancelled_update_leaves_no_state(run, make_update):
+    async def scenario():
+        p = processor()
+        gate = asyncio.Event()
+        running = asyncio.create_task(p.process_update(make_update(1, cls="browsing"), record([], "x", gate)))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(p.process_update(make_update(2, cls="orders"), record([], "y")))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        gate.set()
+        await running
+        return p.backlog(), p._active, p._queued_users, p._running_users
+
+    assert run(scenario()) == (0, 0, {}, set())
+
+
+def test_running_user_does_not_block_class(run, make_update):
+    async def scenario():
+        order = []
+        gate = asyncio.Event()
+        p = processor(workers=2)
+        # کاربر ۱ در حال اجراست و Update بعدی‌اش سر صف browsing است؛ کاربر ۲ نباید پشت آن بماند
+        first = asyncio.create_task(p.process_update(make_update(1, cls="browsing"), record(order, "first", gate)))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(p.process_update(make_update(1, cls="browsing"), record(order, "second")))
+        await asyncio.sleep(0)
+        other = asyncio.create_task(p.process_update(make_update(2, cls="browsing"), record(order, "other")))
+        await asyncio.wait_for(other, 1)
+        gate.set()
+        await asyncio.gather(first, queued)
+        return order
+
+    assert run(scenario()) == ["other", "first", "second"]
+
+
+def test_unknown_weight_class_is_rejected():
+    with pytest.raises(ValueError):
+        processor(weights={"admni": 8})
+    with pytest.raises(ValueError):
+        processor(weights={"admin": 0})
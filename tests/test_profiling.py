@@ -0,0 +1,31 @@
+import os
+import time
+import types
+
+import pytest
+
+import main
+from profiling import CProfiler, SamplingProfiler
+
+
+class DocumentBot:
+    def __init__(self):
+        self.documents = []
+
+    async def send_document(self, chat_id, document, caption, parse_mode=None):
+        self.documents.append((chat_id, os.path.splitext(document.name)[1], len(document.read())))
+
+
+@pytest.mark.parametrize("make_profiler, extension", [(lambda: SamplingProfiler(0.001), ".folded"), (CProfiler, ".prof")])
+def test_finish_profiling_sends_files(run, tmp_path, monkeypatch, make_context, make_profiler, extension):
+    monkeypatch.chdir(tmp_path)
+    profiler = make_profiler()
+    bot = DocumentBot()
+    context = make_context({'profiler': profiler}, bot)
+    context.job = types.SimpleNamespace(chat_id=1)
+    profiler.start()
+    time.sleep(0.02)
+    run(main.finish_profiling(context))
+    assert [(chat_id, ext) for chat_id, ext, _ in bot.documents] == [(1, ".txt"), (1, extension)]
+    assert all(size for _, _, size in bot.documents)
+    assert 'profiler' not in context.bot_data and list(tmp_path.iterdir()) == []
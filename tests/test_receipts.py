@@ -0,0 +1,149 @@
+import io
+import random
+import types
+
+import pytest
+from PIL import Image, ImageDraw
+
+from receipts import ReceiptPipeline, perceptual_hash
+from storage import MemoryStorage, SQLiteStorage, phash_distance
+
+
+def storages(tmp_path):
+    return [MemoryStorage(), SQLiteStorage(str(tmp_path / "bot.db"))]
+
+
+async def add_receipt(storage, transaction_id, phash):
+    await storage.add_transaction(transaction_id, 1, 1000, "pkg")
+    await storage.add_receipt(transaction_id, f"file-{transaction_id}")
+    await storage.set_receipt_hashes(transaction_id, f"sha-{transaction_id}", phash, None)
+
+
+@pytest.mark.parametrize("index", [0, 1])
+def test_find_duplicate_receipt_by_phash_distance(run, tmp_path, index):
+    async def scenario():
+        storage = storages(tmp_path)[index]
+        await storage.init()
+        try:
+            await storage.add_user(1, "alice")
+            await add_receipt(storage, "TX1", "f0f0f0f0f0f0f0f0")
+            # هر هشت بخش با TX1 متفاوت است ولی فاصله‌ی کل فقط ۸ بیت
+            await add_receipt(storage, "TX2", "0f0f0f0f0f0f0f0f")
+            return [
+                await storage.find_duplicate_receipt("TX9", phash="f0f0f0f0f0f0f0f0"),
+                await storage.find_duplicate_receipt("TX9", phash="f0f0f0f0f0f0f0f3", max_distance=2),
+                await storage.find_duplicate_receipt("TX9", phash="f0f0f0f0f0f0f0f3", max_distance=1),
+                await storage.find_duplicate_receipt("TX1", phash="f0f0f0f0f0f0f0f0", max_distance=4),
+                await storage.find_duplicate_receipt("TX9", phash="0f0f0f0f0f0f0f0e", max_distance=7),
+            ]
+        finally:
+            await storage.close()
+
+    assert run(scenario()) == ["TX1", "TX1", None, None, "TX2"]
+    with pytest.raises(ValueError):
+        run(storages(tmp_path)[index].find_duplicate_receipt("TX9", phash="0" * 16, max_distance=8))
+
+
+def test_phash_lookup_uses_band_indexes(run, tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "bot.db"))
+    run(storage.init())
+    plan = storage.query_plan("SELECT transaction_id FROM receipts WHERE "
+                              "(substr(phash, 1, 2) = 'ab' OR substr(phash, 15, 2) = 'cd') AND transaction_id != 'x'")
+    run(storage.close())
+    assert any("idx_receipts_phash_0" in step for step in plan)
+    assert any("idx_receipts_phash_7" in step for step in plan)
+
+
+def screenshot(seed, size=(360, 640)):
+    # تصویر ساختگی شبیه رسید: چند کادر با رنگ‌های مختلف روی زمینه‌ی سفید
+    rnd = random.Random(seed)
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rnd.randrange(size[0] - 60), rnd.randrange(size[1] - 40)
+        draw.rectangle((x, y, x + rnd.randrange(20, 120), y + rnd.randrange(10, 80)), fill=rnd.randrange(200))
+    return image
+
+
+def encode(image, fmt="PNG", **kwargs):
+    data = io.BytesIO()
+    image.convert("RGB").save(data, fmt, **kwargs)
+    return data.getvalue()
+
+
+class FakeBot:
+    def __init__(self, files=None):
+        self.files = files or {}
+        self.sent = []
+        self.edited = []
+
+    async def get_file(self, file_id):
+        async def download_as_bytearray():
+            return bytearray(self.files.get(file_id, b"same receipt bytes"))
+        return types.SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+    async def send_message(self, **kwargs):
+        self.sent.append(kwargs)
+
+    async def edit_message_caption(self, **kwargs):
+        self.edited.append(kwargs)
+
+
+def test_duplicate_flag_is_a_reply_not_an_edit(run, tmp_path):
+    async def scenario():
+        storage = MemoryStorage()
+        bot = FakeBot()
+        await storage.add_user(1, "alice")
+        pipeline = ReceiptPipeline(storage, bot, str(tmp_path / "receipts"))
+        for transaction_id in ("TX1", "TX2"):
+            await storage.add_transaction(transaction_id, 1, 1000, "pkg")
+            await storage.add_receipt(transaction_id, f"file-{transaction_id}")
+            await pipeline._process(transaction_id, f"file-{transaction_id}", (99, 500, False))
+        return bot
+
+    bot = run(scenario())
+    # پیام بررسی (که شاید تایید یا رد شده باشد) دست نمی‌خورد
+    assert bot.edited == []
+    assert len(bot.sent) == 1
+    assert bot.sent[0]["chat_id"] == 99 and bot.sent[0]["reply_to_message_id"] == 500
+    assert "TX1" in bot.sent[0]["text"]
+
+
+def test_perceptual_hash_survives_reencoding_and_crop():
+    original = screenshot(1)
+    phash = perceptual_hash(encode(original))
+    assert phash is not None and len(phash) == 16
+    variants = [encode(original, "JPEG", quality=40), encode(original.resize((300, 533))),
+                encode(original.crop((0, 4, 360, 636)))]
+    assert all(phash_distance(phash, perceptual_hash(data)) <= 2 for data in variants)
+    assert phash_distance(phash, perceptual_hash(encode(screenshot(2)))) > 7
+
+
+def run_pipeline(run, tmp_path, files):
+    async def scenario():
+        storage = MemoryStorage()
+        bot = FakeBot(files)
+        await storage.add_user(1, "alice")
+        pipeline = ReceiptPipeline(storage, bot, str(tmp_path / "receipts"))
+        for transaction_id in files:
+            await storage.add_transaction(transaction_id, 1, 1000, "pkg")
+            await storage.add_receipt(transaction_id, f"file-{transaction_id}")
+            await pipeline._process(transaction_id, transaction_id, (99, 500, False))
+        return [message["text"] for message in bot.sent]
+
+    return run(scenario())
+
+
+def test_similar_screenshot_is_flagged_as_possible_duplicate(run, tmp_path):
+    original = screenshot(1)
+    sent = run_pipeline(run, tmp_path, {"TX1": encode(original), "TX2": encode(screenshot(2)),
+                                        "TX3": encode(original, "JPEG", quality=40)})
+    assert len(sent) == 1
+    assert "احتمال رسید تکراری" in sent[0] and "TX1" in sent[0]
+
+
+def test_identical_file_is_flagged_as_duplicate(run, tmp_path):
+    data = encode(screenshot(1))
+    sent = run_pipeline(run, tmp_path, {"TX1": data, "TX2": data})
+    assert len(sent) == 1
+    assert sent[0].startswith("⚠️ *رسید تکراری:*") and "TX1" in sent[0]
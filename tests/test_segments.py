@@ -0,0 +1,108 @@
+import time
+
+import pytest
+
+import main
+from segments import build_segments
+from storage import MemoryStorage, SQLiteStorage
+from user_state import UserStateStore
+
+SEGMENTS = build_segments(active_days=7, loyalty_min=2)
+
+
+async def open_storage(kind, tmp_path):
+    if kind == "memory":
+        return MemoryStorage()
+    storage = SQLiteStorage(str(tmp_path / "bot.db"))
+    await storage.init()
+    return storage
+
+
+async def populate(storage):
+    # 1: اینترنت (GB)، 2: نام با gb کوچک (بسته‌ی اینترنت نیست)، 3: سفارش باز، 4: بدون سفارش
+    for user_id in (1, 2, 3, 4):
+        await storage.add_user(user_id, f"user{user_id}")
+    for transaction_id, user_id, package_name in (("TX1", 1, "اینترنت 5GB"), ("TX2", 2, "شارژ gb"),
+                                                   ("TX3", 1, "اینترنت 1GB"), ("TX4", 3, "شارژ 50")):
+        await storage.add_transaction(transaction_id, user_id, 1000, package_name)
+    for transaction_id, user_id in (("TX1", 1), ("TX2", 2), ("TX3", 1)):
+        await storage.update_transaction_status(transaction_id, "completed", "completed_at")
+        await storage.update_user_transaction(user_id, 1000)
+
+
+async def memberships(storage):
+    return {name: await storage.get_segment_members(name) for name in SEGMENTS}
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_refresh_is_incremental(run, tmp_path, kind):
+    async def scenario():
+        storage = await open_storage(kind, tmp_path)
+        try:
+            await populate(storage)
+            full = await storage.refresh_segments(SEGMENTS)
+            cursor = (await storage.get_settings())['segments_cursor']
+            unchanged = await storage.refresh_segments(SEGMENTS)
+            await storage.add_transaction("TX5", 4, 1000, "شارژ 50")
+            changed = await storage.refresh_segments(SEGMENTS)
+            new_cursor = (await storage.get_settings())['segments_cursor']
+            return full, unchanged, changed, int(cursor) < int(new_cursor), await memberships(storage)
+        finally:
+            await storage.close()
+
+    full, unchanged, changed, advanced, members = run(scenario())
+    assert (full, unchanged, changed, advanced) == (4, 0, 1, True)
+    assert members["pending_orders"] == [3, 4]
+    assert members["loyal"] == [1]
+
+
+def test_backends_agree(run, tmp_path):
+    async def scenario(kind):
+        storage = await open_storage(kind, tmp_path)
+        try:
+            await populate(storage)
+            await storage.refresh_segments(SEGMENTS)
+            return await memberships(storage)
+        finally:
+            await storage.close()
+
+    memory, sqlite = run(scenario("memory")), run(scenario("sqlite"))
+    assert memory == sqlite
+    # تطبیق GB حساس به حروف است (LIKE در SQLite نیست)
+    assert sqlite["internet_buyers"] == [1]
+
+
+def broadcast_context(make_context, storage):
+    bot_data = {'storage': storage, 'segments': SEGMENTS, 'tenant': main.default_tenant(),
+                'user_state': UserStateStore()}
+    return make_context(bot_data)
+
+
+async def queued_chats(storage):
+    return sorted(entry.chat_id for entry in await storage.get_due_messages(time.time() + 60))
+
+
+def test_broadcast_segment_targets_members(run, make_update, make_context):
+    async def scenario():
+        storage = MemoryStorage()
+        await populate(storage)
+        update = make_update(1)
+        context = broadcast_context(make_context, storage)
+        context.args = ["--segment=internet_buyers", "سلام"]
+        await main.broadcast(update, context)
+        return await queued_chats(storage), update.message.replies
+
+    chats, replies = run(scenario())
+    assert chats == [1]
+    assert "1 کاربر" in replies[-1]
+
+
+def test_broadcast_text_command_honours_segment(run, make_update, make_context):
+    async def scenario():
+        storage = MemoryStorage()
+        await populate(storage)
+        update = make_update(1, text="/broadcast --segment=pending_orders سلام")
+        await main.handle_message(update, broadcast_context(make_context, storage))
+        return await queued_chats(storage)
+
+    assert run(scenario()) == [3]
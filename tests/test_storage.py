@@ -0,0 +1,116 @@
+import sqlite3
+
+import pytest
+
+from storage import MemoryStorage, SQLiteStorage
+
+
+async def archived_backup(tmp_path, **paths):
+    storage = SQLiteStorage(str(tmp_path / "bot.db"), **paths)
+    await storage.init()
+    try:
+        await storage.add_user(1, "alice")
+        for transaction_id in ("TX1", "TX2"):
+            await storage.add_transaction(transaction_id, 1, 1000, "pkg")
+            await storage.update_transaction_status(transaction_id, "completed", "completed_at")
+        assert await storage.archive_transactions("2999-01-01") == 2
+        history = await storage.get_transaction_history(1)
+        await storage.backup(str(tmp_path / "backup.sql"))
+        return history
+    finally:
+        await storage.close()
+
+
+def restore(tmp_path):
+    conn = sqlite3.connect(":memory:")
+    conn.executescript((tmp_path / "backup.sql").read_text())
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'transactions_%'")]
+    ids = sorted(row[0] for table in tables for row in conn.execute(f"SELECT transaction_id FROM {table}"))
+    return ids, conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+
+
+@pytest.mark.parametrize("paths", [
+    {},
+    {"snapshot_path": "snapshot.db"},
+    {"archive_path": "archive.db"},
+    {"archive_path": "archive.db", "snapshot_path": "snapshot.db"},
+])
+def test_backup_includes_archived_transactions(run, tmp_path, paths):
+    paths = {key: str(tmp_path / value) for key, value in paths.items()}
+    history = run(archived_backup(tmp_path, **paths))
+    assert sorted(row[0] for row in history) == ["TX1", "TX2"]
+    assert restore(tmp_path) == (["TX1", "TX2"], 0)
+
+
+def test_snapshot_does_not_read_live_archive(run, tmp_path):
+    async def scenario():
+        storage = SQLiteStorage(str(tmp_path / "bot.db"), archive_path=str(tmp_path / "archive.db"),
+                                snapshot_path=str(tmp_path / "snapshot.db"), snapshot_max_age=3600)
+        await storage.init()
+        try:
+            await storage.add_user(1, "alice")
+            for transaction_id in ("TX1", "TX2"):
+                await storage.add_transaction(transaction_id, 1, 1000, "pkg")
+                await storage.update_transaction_status(transaction_id, "completed", "completed_at")
+                if transaction_id == "TX1":
+                    await storage.archive_transactions("2999-01-01")
+            before = await storage.export_transactions()
+            await storage.archive_transactions("2999-01-01")
+            # Snapshot هنوز تازه است؛ ردیف‌های منتقل‌شده نباید از بایگانی زنده دوباره دیده شوند
+            return before, await storage.export_transactions()
+        finally:
+            await storage.close()
+
+    before, after = run(scenario())
+    assert len(before) == len(after) == 2
+
+
+@pytest.mark.parametrize("memory", [True, False])
+def test_status_compare_and_set_credits_once(run, tmp_path, memory):
+    async def scenario():
+        storage = MemoryStorage() if memory else SQLiteStorage(str(tmp_path / "bot.db"))
+        await storage.init()
+        try:
+            await storage.add_user(1, "alice")
+            await storage.add_transaction("TX1", 1, 1000, "pkg")
+            results = [
+                await storage.update_transaction_status("TX1", "completed", "completed_at",
+                                                        expected="pending_review", credit_user=True),
+                await storage.submit_payment("TX1"),
+                await storage.submit_payment("TX1"),
+            ]
+            for status, field in (("completed", "completed_at"), ("rejected", "rejected_at")):
+                results.append(await storage.update_transaction_status(
+                    "TX1", status, field, expected="pending_review", credit_user=status == "completed"))
+            results.append(await storage.expire_transaction("TX1"))
+            user = await storage.get_user(1)
+            trans = await storage.get_transaction("TX1")
+            return results, trans.status, trans.rejected_at, user.transactions_count, user.total_spent
+        finally:
+            await storage.close()
+
+    results, status, rejected_at, count, total = run(scenario())
+    assert results == [False, True, False, True, False, False]
+    assert (status, rejected_at, count, total) == ("completed", None, 1, 1000)
+
+
+def test_snapshot_reads_are_bounded_by_max_age(run, tmp_path):
+    async def scenario():
+        storage = SQLiteStorage(str(tmp_path / "bot.db"), snapshot_path=str(tmp_path / "snapshot.db"),
+                                snapshot_max_age=3600)
+        await storage.init()
+        try:
+            await storage.add_user(1, "alice")
+            first = await storage.get_user_ids()
+            await storage.add_user(2, "bob")
+            cached = await storage.get_user_ids()
+            # Snapshot قدیمی‌تر از snapshot_max_age دوباره از دیتابیس اصلی کپی می‌شود
+            storage._snapshot_at -= 3601
+            refreshed = await storage.get_user_ids()
+            stats = await storage.get_detailed_stats()
+            return first, cached, refreshed, stats['total_users']
+        finally:
+            await storage.close()
+
+    assert run(scenario()) == ([1], [1], [1, 2], 2)
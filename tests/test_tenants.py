@@ -0,0 +1,55 @@
+import json
+import os
+import types
+
+import pytest
+
+import metrics
+from tenants import SharedHTTPXRequest, load_tenants
+
+
+def write_config(tmp_path, *entries):
+    path = tmp_path / "tenants.json"
+    path.write_text(json.dumps({"tenants": [
+        dict({"token": "t", "admin_id": "1", "bank_card": "6037", "channel_id": "@c"}, **entry) for entry in entries
+    ]}), encoding="utf-8")
+    return str(path)
+
+
+def test_load_tenants_defaults_paths_under_data_dir(tmp_path):
+    path = write_config(tmp_path, {"name": "kabul", "data_dir": str(tmp_path / "kabul")},
+                        {"name": "herat", "data_dir": str(tmp_path / "herat"), "reviewer_ids": ["2", "3"]})
+    kabul, herat = load_tenants(path)
+    assert (kabul.admin_id, kabul.reviewer_ids, herat.reviewer_ids) == (1, (1,), (2, 3))
+    assert kabul.db_path == os.path.join(str(tmp_path / "kabul"), "bot.db") and kabul.archive_db_path == ""
+    assert os.path.isdir(kabul.receipts_dir) and os.path.isdir(os.path.dirname(herat.db_path))
+
+
+@pytest.mark.parametrize("entries", [
+    ({"name": "kabul"}, {"name": "kabul", "db_path": "other.db"}),
+    ({"name": "kabul", "db_path": "shared.db"}, {"name": "herat", "db_path": "shared.db"}),
+])
+def test_load_tenants_rejects_conflicts(tmp_path, monkeypatch, entries):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError):
+        load_tenants(write_config(tmp_path, *entries))
+
+
+def test_shared_request_closes_after_last_user(run):
+    async def scenario():
+        request = SharedHTTPXRequest(connection_pool_size=4)
+        await request.initialize()
+        await request.initialize()
+        await request.shutdown()
+        open_after_first = not request._client.is_closed
+        await request.shutdown()
+        return open_after_first, request._client.is_closed
+
+    assert run(scenario()) == (True, True)
+
+
+def test_tenant_label():
+    assert metrics.tenant_label({'tenant': types.SimpleNamespace(name="kabul")}, "updates") == "kabul:updates"
+    # اجرای تک‌Tenant (default_tenant بدون نام) برچسب‌های قبلی را نگه می‌دارد
+    assert metrics.tenant_label({'tenant': types.SimpleNamespace(name="")}, "updates") == "updates"
+    assert metrics.tenant_label({}, "updates") == "updates"
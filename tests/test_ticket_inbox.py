@@ -0,0 +1,93 @@
+import main
+from events import EventBus
+from storage import MemoryStorage
+from ticket_inbox import TicketThreadCache
+from user_state import UserStateStore
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.thread_reads = 0
+        self.during_read = None
+
+    async def get_ticket_thread(self, ticket_id):
+        self.thread_reads += 1
+        thread = await super().get_ticket_thread(ticket_id)
+        if self.during_read:
+            self.during_read()
+        return thread
+
+
+async def storage_with_ticket():
+    storage = CountingStorage()
+    await storage.add_user(2, "bob")
+    await storage.add_ticket("TK1", 2, "help")
+    return storage
+
+
+def test_cache_hit_and_invalidate(run):
+    async def scenario():
+        storage = await storage_with_ticket()
+        cache = TicketThreadCache(storage)
+        first = await cache.get("TK1")
+        assert await cache.get("TK1") is first
+        assert storage.thread_reads == 1
+        await storage.update_ticket_status("TK1", "answered", reply=(True, "done"))
+        cache.invalidate("TK1")
+        ticket, replies = await cache.get("TK1")
+        assert storage.thread_reads == 2
+        return ticket.status, [r.message for r in replies]
+
+    assert run(scenario()) == ("answered", ["done"])
+
+
+def test_invalidation_during_read_is_not_cached(run):
+    async def scenario():
+        storage = await storage_with_ticket()
+        cache = TicketThreadCache(storage)
+        storage.during_read = lambda: cache.invalidate("TK1")
+        await cache.get("TK1")
+        storage.during_read = None
+        await cache.get("TK1")
+        return storage.thread_reads, len(cache)
+
+    assert run(scenario()) == (2, 1)
+
+
+def test_cache_evicts_least_recently_used(run):
+    async def scenario():
+        storage = await storage_with_ticket()
+        await storage.add_ticket("TK2", 2, "again")
+        await storage.add_ticket("TK3", 2, "third")
+        cache = TicketThreadCache(storage, max_tickets=2)
+        for ticket_id in ("TK1", "TK2", "TK1", "TK3"):
+            await cache.get(ticket_id)
+        reads = storage.thread_reads
+        await cache.get("TK1")
+        await cache.get("TK2")
+        return reads, storage.thread_reads
+
+    # TK2 کم‌استفاده‌ترین بود و حذف شد
+    assert run(scenario()) == (3, 4)
+
+
+def test_reply_invalidates_thread_without_event_subscriber(run, make_update, make_context):
+    async def scenario():
+        storage = await storage_with_ticket()
+        threads = TicketThreadCache(storage)
+        user_state = UserStateStore()
+        # EventBus شروع نشده: هیچ مشترکی رویداد TicketAnswered را پردازش نمی‌کند
+        bot_data = {'storage': storage, 'ticket_threads': threads, 'user_state': user_state,
+                    'events': EventBus(None)}
+        await storage.claim_review('ticket', "TK1", 1, 0, float('inf'))
+        await threads.get("TK1")
+        user_state.get(1)['replying_to_ticket'] = "TK1"
+        update = make_update(1, text="fixed")
+        await main.send_ticket_reply(update, make_context(bot_data))
+        ticket, thread_replies = await threads.get("TK1")
+        return update.message.replies, ticket.status, [r.message for r in thread_replies]
+
+    replies, status, messages = run(scenario())
+    assert replies == ["✅ پاسخ شما ارسال شد."]
+    assert (status, messages) == ("answered", ["fixed"])
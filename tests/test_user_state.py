@@ -0,0 +1,39 @@
+from user_state import UserStateStore
+
+
+def test_keys_expire_with_their_ttl(clock):
+    store = UserStateStore(ttls={'current_transaction': 10}, idle_ttl=100, clock=clock)
+    state = store.get(1)
+    state['current_transaction'] = "TX1"
+    state['expecting_payment'] = True
+    clock.now = 11
+    assert 'current_transaction' not in state
+    assert store.get(1)['expecting_payment'] is True
+
+
+def test_reads_do_not_register_users(clock):
+    store = UserStateStore(clock=clock)
+    assert store.get(1).get('anything') is None
+    assert len(store) == 0
+
+
+def test_least_recently_used_user_is_evicted(clock):
+    store = UserStateStore(max_users=2, clock=clock)
+    store.get(1)['a'] = 1
+    store.get(2)['a'] = 2
+    store.get(1)
+    store.get(3)['a'] = 3
+    assert store.get(2).get('a') is None
+    assert store.get(1)['a'] == 1 and len(store) == 2
+
+
+def test_sweep_drops_idle_users_and_empty_states(clock):
+    store = UserStateStore(idle_ttl=50, ttls={'short': 5}, clock=clock)
+    store.get(1)['short'] = 1
+    store.get(2)['long'] = 2
+    clock.now = 10
+    store.get(3)['long'] = 3
+    assert store.sweep() == 1
+    clock.now = 55
+    assert store.sweep() == 1
+    assert len(store) == 1 and store.key_count() == 1
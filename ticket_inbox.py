@@ -0,0 +1,44 @@
+from collections import OrderedDict
+
+import metrics
+
+# فیلترهای صندوق تیکت مدیران: نام فیلتر -> وضعیت‌های تیکت
+INBOX_FILTERS = {
+    'open': ('pending',),
+    'answered': ('answered',),
+    'all': ('pending', 'answered'),
+}
+
+
+class TicketThreadCache:
+    # رشته‌ی هر تیکت (خود تیکت و پاسخ‌ها) پس از اولین باز شدن در حافظه می‌ماند تا رفت‌وبرگشت بین فهرست و
+    # تیکت‌ها کوئری تکراری نزند؛ نویسنده‌ی پاسخ پس از ثبت موفق همان تیکت را باطل می‌کند (invalidate).
+    # حداکثر max_tickets رشته نگه داشته می‌شود و کم‌استفاده‌ترین اول حذف می‌شود.
+    def __init__(self, storage, max_tickets=256):
+        self.storage = storage
+        self.max_tickets = max_tickets
+        self._threads = OrderedDict()
+        # اگر هنگام خواندن از دیتابیس پاسخی ثبت شود، نتیجه‌ی همان خواندن ذخیره نمی‌شود
+        self._invalidations = 0
+
+    async def get(self, ticket_id):
+        thread = self._threads.get(ticket_id)
+        if thread is not None:
+            self._threads.move_to_end(ticket_id)
+            metrics.CACHE_REQUESTS.inc("ticket_thread", "hit")
+            return thread
+        metrics.CACHE_REQUESTS.inc("ticket_thread", "miss")
+        invalidations = self._invalidations
+        thread = await self.storage.get_ticket_thread(ticket_id)
+        if thread is not None and invalidations == self._invalidations:
+            self._threads[ticket_id] = thread
+            while len(self._threads) > self.max_tickets:
+                self._threads.popitem(last=False)
+        return thread
+
+    def invalidate(self, ticket_id):
+        self._invalidations += 1
+        self._threads.pop(ticket_id, None)
+
+    def __len__(self):
+        return len(self._threads)
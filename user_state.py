@@ -0,0 +1,132 @@
+import time
+from collections import OrderedDict
+
+import metrics
+
+_MISSING = object()
+
+
+class UserState:
+    # وضعیت گفت‌وگوی یک کاربر با رابطی شبیه dict؛ هر کلید مهلت خودش را دارد و پس از آن انگار وجود ندارد.
+    # تا اولین نوشتن در Store ثبت نمی‌شود، پس خواندن وضعیت کاربران عادی حافظه‌ای نگه نمی‌دارد.
+    __slots__ = ("user_id", "_store", "_values", "_expires")
+
+    def __init__(self, store, user_id):
+        self.user_id = user_id
+        self._store = store
+        self._values = {}
+        self._expires = {}
+
+    def _expired(self, key, now):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= now:
+            del self._values[key]
+            del self._expires[key]
+            metrics.USER_STATE_EVICTIONS.inc("expired")
+            return True
+        return False
+
+    def get(self, key, default=None):
+        if key not in self._values or self._expired(key, self._store.clock()):
+            return default
+        return self._values[key]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key, value, ttl=None):
+        now = self._store.clock()
+        ttl = self._store.ttl_for(key) if ttl is None else ttl
+        self._values[key] = value
+        if ttl:
+            self._expires[key] = now + ttl
+        else:
+            self._expires.pop(key, None)
+        self._store._touch(self, now)
+
+    __setitem__ = set
+
+    def pop(self, key, default=_MISSING):
+        if key not in self._values or self._expired(key, self._store.clock()):
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        self._expires.pop(key, None)
+        value = self._values.pop(key)
+        if not self._values:
+            self._store._discard(self.user_id)
+        return value
+
+    def clear(self):
+        self._values.clear()
+        self._expires.clear()
+        self._store._discard(self.user_id)
+
+    def sweep(self, now):
+        for key in [k for k, expires in self._expires.items() if expires <= now]:
+            self._expired(key, now)
+        return len(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class UserStateStore:
+    # جایگزین context.user_data: کلیدها با TTL مخصوص جریانشان منقضی می‌شوند (ttls) و تعداد کاربران دارای
+    # وضعیت به max_users محدود است؛ با عبور از سقف، کاربری که دیرتر از همه فعالیت داشته حذف می‌شود (LRU).
+    # sweep() دوره‌ای کلیدهای منقضی و کاربران بیکارتر از idle_ttl را پاک می‌کند.
+    def __init__(self, max_users=10000, idle_ttl=86400.0, ttls=None, clock=time.monotonic):
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.ttls = dict(ttls or {})
+        self.clock = clock
+        # user_id -> (UserState, آخرین فعالیت)؛ به ترتیب استفاده
+        self._users = OrderedDict()
+
+    def ttl_for(self, key):
+        return self.ttls.get(key, self.idle_ttl)
+
+    def get(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None:
+            return UserState(self, user_id)
+        self._users[user_id] = (entry[0], self.clock())
+        self._users.move_to_end(user_id)
+        return entry[0]
+
+    def _touch(self, state, now):
+        self._users[state.user_id] = (state, now)
+        self._users.move_to_end(state.user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+            metrics.USER_STATE_EVICTIONS.inc("lru")
+
+    def _discard(self, user_id):
+        self._users.pop(user_id, None)
+
+    def drop(self, user_id):
+        self._discard(user_id)
+
+    def sweep(self):
+        now = self.clock()
+        removed = 0
+        for user_id, (state, last_seen) in list(self._users.items()):
+            if now - last_seen >= self.idle_ttl:
+                metrics.USER_STATE_EVICTIONS.inc("idle")
+            elif state.sweep(now):
+                continue
+            del self._users[user_id]
+            removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self._users)
+
+    def key_count(self):
+        return sum(len(state._values) for state, _ in self._users.values())